@@ -0,0 +1,304 @@
+"""ASGI entry point for the waiter application.
+
+Serve it with any ASGI server, e.g. uvicorn's gunicorn worker from the asgi
+extra (pip install .[asgi]):
+
+    gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app
+
+Each worker runs one event loop and ASGI_THREADS threads, see settings.py
+for sizing them.
+
+File downloads are streamed natively on the event loop so an idle player only
+holds an open file, not a worker. Every other route is handed to the Flask
+app on a bounded thread pool, which keeps pages, templates and error handling
+identical to the WSGI deployment. Blocking work (upstream MediaViewer calls,
+file reads) always runs on that pool, never on the event loop.
+"""
+
+import io
+import os
+import sys
+import time
+import asyncio
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from settings import (
+    USE_NGINX,
+    ASGI_THREADS,
+    UPSTREAM_REQUEST_BUDGET,
+    SERVER_TIMING,
+    SERVER_TIMING_LOG,
+)
+from upstream import startBudget, endBudget
+from ranges import planResponse, guessMimetype
+from mp4 import fastStartLayout
+from metrics import registry, requestLatency, requestCount, fileSends, fileBytesSent
+from timing import startTimings, endTimings, serverTimingHeader, logTimings
+
+import waiter
+
+CHUNK_SIZE = 256 * 1024
+
+
+def buildEnviron(scope, body):
+    """Translate an ASGI http scope into a WSGI environ"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def resolveDownload(guid, hashPath):
+    """Look up the file behind a download URL or return None on any error"""
+    waiter.mediaWatcher.ensureStarted()
+    budget = startBudget(UPSTREAM_REQUEST_BUDGET)
+    try:
+        token = waiter.getTokenByGUID(guid)
+        if waiter.checkForValidToken(token, guid):
+            return None
+        entry = waiter._getFileEntryFromHash(token, hashPath)
+    except Exception as e:
+        waiter.logger().error(e)
+        return None
+    finally:
+        endBudget(budget)
+    return entry["unhashedPath"]
+
+
+class WaiterASGI:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="asgi"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        route = self._match(scope)
+        if route is not None and route[0] == "send_file_for_download":
+            return await self._sendFile(scope, receive, send, **route[1])
+        return await self._callWsgi(scope, receive, send)
+
+    def _match(self, scope):
+        if USE_NGINX or scope["method"] not in ("GET", "HEAD"):
+            return None
+        adapter = waiter.app.url_map.bind(
+            "", script_name=scope.get("root_path") or None
+        )
+        try:
+            return adapter.match(scope["path"], method=scope["method"])
+        except HTTPException:
+            return None
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                waiter.mediaWatcher.ensureStarted()
+                waiter.offsetStore.ensureStarted()
+                waiter.viewedOutbox.ensureStarted()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _run(self, func, *args):
+        # Like asyncio.to_thread, run in a copy of the caller's context so
+        # spans recorded on the pool reach the request's Timings
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, context.run, func, *args
+        )
+
+    async def _readBody(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    async def _callWsgi(self, scope, receive, send):
+        environ = buildEnviron(scope, await self._readBody(receive))
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+            return lambda data: None
+
+        result = await self._run(self.wsgi_app, environ, start_response)
+        iterator = iter(result)
+        try:
+            chunk = await self._run(next, iterator, None)
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": response["status"],
+                    "headers": response["headers"],
+                }
+            )
+            while chunk is not None:
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+                chunk = await self._run(next, iterator, None)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                await self._run(result.close)
+
+    async def _sendFile(self, scope, receive, send, guid, hashPath):
+        if SERVER_TIMING or SERVER_TIMING_LOG:
+            timings, token = startTimings()
+            try:
+                return await self._sendTimedFile(
+                    scope, receive, send, guid, hashPath, timings
+                )
+            finally:
+                endTimings(token)
+        return await self._sendTimedFile(scope, receive, send, guid, hashPath)
+
+    async def _sendTimedFile(self, scope, receive, send, guid, hashPath, timings=None):
+        registry.ensureStarted()
+        started = time.perf_counter()
+        path = await self._run(resolveDownload, guid, hashPath)
+        if path is None:
+            # Let the Flask app render the exact same error page
+            return await self._callWsgi(scope, receive, send)
+
+        stat = await self._run(os.stat, path)
+        layout = await self._run(fastStartLayout, path, stat)
+        request_headers = Headers(
+            [
+                (name.decode("latin-1"), value.decode("latin-1"))
+                for name, value in scope.get("headers", [])
+            ]
+        )
+        plan = planResponse(
+            stat,
+            request_headers,
+            method=scope["method"],
+            mimetype=guessMimetype(path),
+            layout=layout,
+        )
+        headers = dict(plan.headers)
+        headers["Accept-Ranges"] = "bytes"
+        headers.update(waiter.secure_headers.headers())
+
+        requestLatency.observe(time.perf_counter() - started, route="file")
+        requestCount.inc(route="file", status=plan.status)
+        fileSends.inc(mode="asgi", status=plan.status)
+        if timings is not None:
+            durations = timings.durations()
+            if SERVER_TIMING:
+                headers["Server-Timing"] = serverTimingHeader(durations)
+            if SERVER_TIMING_LOG:
+                logTimings(
+                    durations,
+                    method=scope["method"],
+                    path=scope["path"],
+                    route="file",
+                    status=plan.status,
+                )
+        if plan.status in (304, 416) or scope["method"] == "HEAD":
+            return await self._respond(send, plan.status, headers)
+
+        sent = 0
+        fp = await self._run(open, path, "rb")
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": plan.status,
+                    "headers": self._encodeHeaders(headers),
+                }
+            )
+            for part in plan.parts:
+                if part.prefix:
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": part.prefix,
+                            "more_body": True,
+                        }
+                    )
+                    sent += len(part.prefix)
+                if part.end < part.start:
+                    continue
+
+                await self._run(fp.seek, part.start)
+                remaining = part.end - part.start + 1
+                while remaining > 0:
+                    chunk = await self._run(fp.read, min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+                    sent += len(chunk)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            fileBytesSent.inc(sent, mode="asgi")
+            await self._run(fp.close)
+
+    async def _respond(self, send, status, headers):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": self._encodeHeaders(headers),
+            }
+        )
+        await send({"type": "http.response.body", "body": b""})
+
+    @staticmethod
+    def _encodeHeaders(headers):
+        return [
+            (name.lower().encode("latin-1"), str(value).encode("latin-1"))
+            for name, value in headers.items()
+        ]
+
+
+app = WaiterASGI(waiter.app)
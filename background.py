@@ -0,0 +1,79 @@
+import os
+import threading
+
+from log import logger
+
+
+class BackgroundLoop:
+    """Mixin for objects that run a daemon thread in every worker process.
+
+    ensureStarted() starts the thread at most once per process, so it is
+    cheap to call on every request and starts a new thread after gunicorn
+    forks. By default the thread calls _loopTick() every _loopInterval()
+    seconds, logging whatever it raises, and stop() ends the thread and
+    calls _loopTick() a last time.
+
+    Subclasses call _initLoop() from __init__, set LOOP_NAME and implement
+    _loopInterval() and _loopTick().
+    """
+
+    LOOP_NAME = "background"
+
+    def _initLoop(self):
+        self._pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._loopLock = threading.Lock()
+
+    def _loopInterval(self):
+        raise NotImplementedError
+
+    def _loopTick(self):
+        raise NotImplementedError
+
+    def _loopEnabled(self):
+        return True
+
+    def _loopStart(self):
+        """Prepare the loop and return the function the thread runs"""
+        return self._runLoop
+
+    def _loopFinish(self):
+        """Called by stop() once the thread has ended"""
+        self._safeTick()
+
+    def _runLoop(self):
+        while not self._stop.wait(self._loopInterval()):
+            self._safeTick()
+
+    def _safeTick(self):
+        try:
+            self._loopTick()
+        except Exception as e:
+            logger().error(e, exc_info=True)
+
+    def ensureStarted(self):
+        if self._pid == os.getpid() or not self._loopEnabled():
+            return
+
+        with self._loopLock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            target = self._loopStart()
+            self._thread = threading.Thread(
+                target=target, name=self.LOOP_NAME, daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        if self._pid != os.getpid():
+            return
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self._loopInterval() + 1)
+            self._thread = None
+        self._loopFinish()
+        self._pid = None
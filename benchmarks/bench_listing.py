@@ -0,0 +1,283 @@
+"""Time directory listing, hash lookup and page rendering on synthetic media trees.
+
+Builds movie directories of sparse video files (100, 1k and 10k by default)
+with and without .vtt sidecars, either flat or spread over nested
+subdirectories, and times each stage of serving them:
+
+- scan: building a listing with an empty listing cache
+- listing: getting the cached listing, which re-checks directory mtimes
+- index: building the hash index of a listing
+- entries: buildEntries for the whole directory
+- lookup: _getFileEntryFromHash for one file of a cached listing
+- render: rendering display.html with every entry
+- hashed_filename: hashing a single path
+
+    python benchmarks/bench_listing.py --output baseline.json
+    python benchmarks/bench_listing.py --baseline baseline.json
+
+Each stage is run in rounds of enough calls to take at least --min-time
+seconds and the median time per call over --rounds rounds is reported. With
+--baseline, stages more than --tolerance slower than the baseline are listed
+and the script exits with status 1.
+
+Directory mtimes are moved into the past so listings are not treated as
+racy and rescanned on every request.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import tempfile
+
+from pathlib import Path
+
+TMP = tempfile.mkdtemp(prefix="bench_listing")
+os.environ.setdefault("MW_IGNORE_MEDIA_DIR_CHECKS", "true")
+os.environ.setdefault("MW_SECRET_FILE", os.path.join(TMP, "secret"))
+os.environ["MW_LOG_DIR"] = TMP
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log  # noqa: E402
+import waiter  # noqa: E402
+from flask import render_template  # noqa: E402
+from settings import MINIMUM_FILE_SIZE, EXTERNAL_MEDIAVIEWER_BASE_URL  # noqa: E402
+from utils import hashed_filename  # noqa: E402
+
+FILE_SIZE = MINIMUM_FILE_SIZE + 1024 * 1024
+FILES_PER_DIRECTORY = 25
+SUBTITLE = b"WEBVTT\n\n00:00:01.000 --> 00:00:02.000\nHello\n"
+GUID = "bench-guid"
+
+
+def buildTree(root, count, subtitles, nested):
+    """Create count sparse videos under root and return their waiter filenames"""
+    root.mkdir(parents=True)
+    directories = {root}
+    names = []
+    for i in range(count):
+        directory = root
+        if nested:
+            directory = root / f"Season {i // FILES_PER_DIRECTORY + 1:03d}"
+            if directory not in directories:
+                directory.mkdir()
+                directories.add(directory)
+
+        name = f"Movie.{i:05d}.1080p.mv-encoded.mp4"
+        with open(directory / name, "wb") as fp:
+            fp.truncate(FILE_SIZE)
+        if subtitles:
+            (directory / f"Movie.{i:05d}.1080p.mv-encoded.en.vtt").write_bytes(SUBTITLE)
+        names.append(name)
+
+    past = time.time() - 3600
+    for directory in directories:
+        os.utime(directory, (past, past))
+    return names
+
+
+def movieToken(root):
+    return {
+        "isvalid": True,
+        "ismovie": True,
+        "path": str(root),
+        "filename": root.name,
+        "guid": GUID,
+        "displayname": root.name,
+        "username": "bench",
+        "tv_id": None,
+        "tv_name": None,
+        "videoprogresses": [],
+        "theme": "dark",
+    }
+
+
+def renderPage(token, files):
+    return render_template(
+        "display.html",
+        title=token["displayname"],
+        files=files,
+        username=token["username"],
+        mediaviewer_base_url=EXTERNAL_MEDIAVIEWER_BASE_URL,
+        ismovie=token["ismovie"],
+        tv_id=token["tv_id"],
+        tv_name=token["tv_name"],
+        guid=GUID,
+        offsetUrl=waiter.WAITER_OFFSET_URL,
+        next_link=None,
+        previous_link=None,
+        tv_genres=[],
+        movie_genres=[],
+        collections=[],
+        binge_mode=False,
+        donation_site_name="",
+        donation_site_url="",
+        theme=token["theme"],
+        is_mcp=False,
+        og_title="",
+        og_type="",
+        og_url="",
+        og_image="",
+    )
+
+
+def measure(func, rounds, min_time):
+    """Return the median seconds per call of func over rounds rounds"""
+    func()
+
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+    times = [elapsed / number]
+    for _ in range(rounds - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return statistics.median(times)
+
+
+def stages(root, names):
+    token = movieToken(root)
+    listingCache = waiter.listingCache
+    accept = waiter._isCandidateFile
+    rng = random.Random(0)
+    hashes = [hashed_filename(f"{root.name}/{name}") for name in names]
+
+    def scan():
+        listingCache.clear()
+        listingCache.get(root, accept)
+
+    def listing():
+        listingCache.get(root, accept)
+
+    def index():
+        cached = listingCache.get(root, accept)
+        cached._hashIndexes.clear()
+        cached.hashIndex(token["filename"])
+
+    def entries():
+        list(waiter.buildEntries(token))
+
+    def lookup():
+        waiter._getFileEntryFromHash(token, rng.choice(hashes))
+
+    files = sorted(waiter.buildEntries(token), key=lambda x: x["filename"])
+
+    def render():
+        renderPage(token, files)
+
+    def hashing():
+        hashed_filename(f"{root.name}/{names[0]}")
+
+    return [
+        ("scan", scan),
+        ("listing", listing),
+        ("index", index),
+        ("entries", entries),
+        ("lookup", lookup),
+        ("render", render),
+        ("hashed_filename", hashing),
+    ]
+
+
+def run(args):
+    results = []
+    print(f"{'files':>6} {'subtitles':<10} {'layout':<7} {'stage':<16} {'ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp, waiter.app.test_request_context():
+        for count in args.files:
+            for subtitles in (False, True):
+                for nested in (False, True):
+                    layout = "nested" if nested else "flat"
+                    root = Path(tmp) / f"{count}-{subtitles}-{layout}"
+                    names = buildTree(root, count, subtitles, nested)
+
+                    for stage, func in stages(root, names):
+                        seconds = measure(func, args.rounds, args.min_time)
+                        results.append(
+                            {
+                                "files": count,
+                                "subtitles": subtitles,
+                                "layout": layout,
+                                "stage": stage,
+                                "ms": round(seconds * 1000, 4),
+                            }
+                        )
+                        print(
+                            f"{count:>6} {str(subtitles):<10} {layout:<7} "
+                            f"{stage:<16} {seconds * 1000:>10.4f}"
+                        )
+                    waiter.listingCache.clear()
+    log.LogFile.stop()
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def _key(result):
+    return (result["files"], result["subtitles"], result["layout"], result["stage"])
+
+
+def regressions(report, baseline, tolerance):
+    """Return (result, baseline ms) for every stage slower than the baseline
+    by more than tolerance"""
+    previous = {_key(result): result["ms"] for result in baseline["results"]}
+    slower = []
+    for result in report["results"]:
+        ms = previous.get(_key(result))
+        if ms and result["ms"] > ms * (1 + tolerance):
+            slower.append((result, ms))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--files",
+        type=lambda value: [int(count) for count in value.split(",")],
+        default=[100, 1000, 10000],
+        help="comma separated tree sizes",
+    )
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against a previous --output")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        slower = regressions(report, baseline, args.tolerance)
+        for result, ms in slower:
+            print(
+                f"REGRESSION {result['files']} files, subtitles={result['subtitles']}, "
+                f"{result['layout']}, {result['stage']}: {ms:.4f} ms -> "
+                f"{result['ms']:.4f} ms"
+            )
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Measure the logging overhead of one download request.
+
+Replays the debug logging done while serving a file through nginx
+(logErrorsAndContinue, send_file_partial and xsendfile) against:
+
+- the previous setup: f-string messages and a synchronous
+  RotatingFileHandler on a DEBUG logger
+- log.py: lazy %-style messages through a QueueHandler, at the default
+  INFO level and at DEBUG
+
+    python benchmarks/bench_logging.py --requests 20000
+
+Only the time spent in the request thread is measured. For the queue
+pipeline that excludes the listener thread writing the file.
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+from logging.handlers import RotatingFileHandler
+
+TMP = tempfile.mkdtemp(prefix="bench_logging")
+os.environ.setdefault("MW_IGNORE_MEDIA_DIR_CHECKS", "true")
+os.environ.setdefault("MW_SECRET_FILE", os.path.join(TMP, "secret"))
+os.environ["MW_LOG_DIR"] = TMP
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log  # noqa: E402
+
+PATH = "/mnt/media/Movies/Some Movie (2020)/Some.Movie.2020.1080p.mp4"
+FILENAME = "Some.Movie.2020.1080p.mp4"
+
+
+def eagerRequest(logger):
+    logger.debug(f"Attempting {'send_file_for_download'}")
+    logger.debug(f"Using NGINX to send {FILENAME}")
+    logger.debug(f"path: {PATH}")
+    logger.debug(f"filename: {FILENAME}")
+    redirected_path = f"/download/{PATH.split('/', 3)[-1]}"
+    logger.debug(f"redirected_path is {redirected_path}")
+    headers = {"X-Accel-Redirect": redirected_path, "X-Accel-Buffering": "no"}
+    logger.debug(f"X-Accel-Redirect: {headers['X-Accel-Redirect']}")
+    logger.debug(f"X-Accel-Buffering: {headers['X-Accel-Buffering']}")
+
+
+def lazyRequest(logger):
+    logger.debug("Attempting %s", "send_file_for_download")
+    logger.debug("Using NGINX to send %s", FILENAME)
+    logger.debug("path: %s", PATH)
+    logger.debug("filename: %s", FILENAME)
+    redirected_path = f"/download/{PATH.split('/', 3)[-1]}"
+    logger.debug("redirected_path is %s", redirected_path)
+    headers = {"X-Accel-Redirect": redirected_path, "X-Accel-Buffering": "no"}
+    logger.debug("X-Accel-Redirect: %s", headers["X-Accel-Redirect"])
+    logger.debug("X-Accel-Buffering: %s", headers["X-Accel-Buffering"])
+
+
+def synchronousLogger(level):
+    logger = logging.getLogger("bench.synchronous")
+    logger.handlers.clear()
+    logger.propagate = False
+    logger.setLevel(level)
+    handler = RotatingFileHandler(
+        os.path.join(TMP, "synchronousLog"),
+        mode="a",
+        maxBytes=1000000,
+        backupCount=10,
+    )
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    )
+    logger.addHandler(handler)
+    return logger
+
+
+def queueLogger(level):
+    log.LogFile.stop()
+    logger = log.logger()
+    logger.setLevel(level)
+    return logger
+
+
+def measure(request, logger, requests):
+    # Warm up
+    for _ in range(100):
+        request(logger)
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        request(logger)
+    return (time.perf_counter() - start) / requests
+
+
+def run(args):
+    scenarios = [
+        ("sync handler, f-strings", "DEBUG", synchronousLogger, eagerRequest),
+        ("sync handler, f-strings", "INFO", synchronousLogger, eagerRequest),
+        ("queue handler, lazy", "DEBUG", queueLogger, lazyRequest),
+        ("queue handler, lazy", "INFO", queueLogger, lazyRequest),
+    ]
+
+    print(f"{args.requests} requests per scenario")
+    print(f"{'setup':<26} {'level':<6} {'us/request':>11}")
+    for name, level, setup, request in scenarios:
+        per_request = measure(request, setup(level), args.requests)
+        print(f"{name:<26} {level:<6} {per_request * 1e6:>11.2f}")
+    log.LogFile.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
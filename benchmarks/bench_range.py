@@ -0,0 +1,158 @@
+"""Compare download throughput of Flask send_file against rangeResponse.
+
+Both paths are served by a single sync gunicorn worker. For each scenario
+the wall time and the worker's CPU time are measured while a client streams
+the responses and throws the bytes away.
+
+    python benchmarks/bench_range.py --size-mb 1024 --requests 10
+
+The media file is sparse so creating it is instant, but reads still go
+through the page cache like a real file.
+"""
+
+import os
+import sys
+import time
+import random
+import socket
+import argparse
+import tempfile
+import subprocess
+import http.client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def cpuSeconds(pid):
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def workerPid(master):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        with open(f"/proc/{master}/task/{master}/children") as children:
+            pids = children.read().split()
+        if pids:
+            return int(pids[0])
+        time.sleep(0.1)
+    raise RuntimeError("gunicorn worker did not start")
+
+
+def waitForServer(port):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("gunicorn did not start")
+
+
+def fetch(conn, path, range_header):
+    headers = {"Range": range_header} if range_header else {}
+    conn.request("GET", path, headers=headers)
+    response = conn.getresponse()
+    received = 0
+    while True:
+        chunk = response.read(MB)
+        if not chunk:
+            break
+        received += len(chunk)
+    expected = int(response.getheader("Content-Length"))
+    if received != expected:
+        raise RuntimeError(f"{path}: got {received} of {expected} bytes")
+    return received
+
+
+def scenarios(size, range_size, requests):
+    rng = random.Random(0)
+    bounded = []
+    for _ in range(requests):
+        start = rng.randrange(0, size - range_size)
+        bounded.append(f"bytes={start}-{start + range_size - 1}")
+
+    return [
+        ("whole file", [None] * requests),
+        ("open-ended range", [f"bytes={size // 2}-"] * requests),
+        (f"{range_size // MB} MB ranges", bounded),
+    ]
+
+
+def run(args):
+    size = args.size_mb * MB
+    with tempfile.TemporaryDirectory() as tmp:
+        media = os.path.join(tmp, "movie.mp4")
+        with open(media, "wb") as fp:
+            fp.truncate(size)
+
+        port = freePort()
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                "--workers",
+                "1",
+                "--bind",
+                f"127.0.0.1:{port}",
+                "--log-level",
+                "warning",
+                "range_app:app",
+            ],
+            env=dict(os.environ, BENCH_MEDIA_FILE=media),
+            # Keep gunicorn from loading the app's gunicorn.conf.py
+            cwd=HERE,
+        )
+        try:
+            waitForServer(port)
+            worker = workerPid(server.pid)
+
+            print(f"{args.size_mb} MB file, {args.requests} requests per scenario")
+            print(
+                f"{'scenario':<20} {'path':<8} {'MB/s':>10} {'worker CPU s':>14} "
+                f"{'CPU ms/GB':>10}"
+            )
+            for name, ranges in scenarios(size, args.range_mb * MB, args.requests):
+                for path in ("/flask", "/range"):
+                    conn = http.client.HTTPConnection("127.0.0.1", port)
+                    # Warm the page cache and the connection
+                    fetch(conn, path, ranges[0])
+
+                    cpu_start = cpuSeconds(worker)
+                    start = time.perf_counter()
+                    received = sum(fetch(conn, path, r) for r in ranges)
+                    elapsed = time.perf_counter() - start
+                    cpu = cpuSeconds(worker) - cpu_start
+                    conn.close()
+
+                    print(
+                        f"{name:<20} {path:<8} {received / MB / elapsed:>10.1f} "
+                        f"{cpu:>14.2f} {cpu * 1000 / (received / MB / 1024):>10.1f}"
+                    )
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--range-mb", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=10)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
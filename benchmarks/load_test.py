@@ -0,0 +1,341 @@
+"""Drive realistic viewing sessions against waiter under gunicorn.
+
+Starts stub_mediaviewer.py and the real app with the repo's gunicorn.conf.py,
+serving files itself rather than through nginx, over a tree of sparse movies.
+Each simulated viewer repeatedly:
+
+- opens a movie's directory page
+- reads the playback offset
+- fetches a burst of --ranges Range requests from the video, posting the
+  offset after every --offset-every of them
+- marks the movie viewed
+
+and the throughput and p50/p95/p99 latency of every route is reported.
+
+    python benchmarks/load_test.py --users 16 --duration 30 --latency 20
+
+Latency is measured from sending a request to reading the last byte of its
+response, on a keep-alive connection per viewer.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+from urllib.parse import urlencode, quote
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(HERE)
+MB = 1024 * 1024
+
+TMP = tempfile.mkdtemp(prefix="load_test")
+os.environ.setdefault("MW_IGNORE_MEDIA_DIR_CHECKS", "true")
+os.environ.setdefault("MW_SECRET_FILE", os.path.join(TMP, "secret"))
+os.environ["MW_LOG_DIR"] = TMP
+
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, HERE)
+
+from utils import hashed_filename  # noqa: E402
+from stub_mediaviewer import movieName, movieFilename  # noqa: E402
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def waitForServer(port, process, name):
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} exited with {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{name} did not start")
+
+
+def buildMovies(media_root, count, size):
+    for number in range(count):
+        directory = os.path.join(media_root, "Movies", movieName(number))
+        os.makedirs(directory)
+        with open(os.path.join(directory, movieFilename(number)), "wb") as fp:
+            fp.truncate(size)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+class Results:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, route, seconds, ok, received):
+        with self._lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            self.bytes += received
+
+    def report(self, elapsed):
+        routes = []
+        everything = []
+        for route, samples in sorted(self.samples.items()):
+            everything.extend(samples)
+            routes.append(self._summary(route, samples, elapsed))
+        routes.append(self._summary("total", everything, elapsed))
+        return routes
+
+    def _summary(self, route, samples, elapsed):
+        samples = sorted(samples)
+        if route == "total":
+            errors = sum(self.errors.values())
+        else:
+            errors = self.errors.get(route, 0)
+        return {
+            "route": route,
+            "requests": len(samples),
+            "errors": errors,
+            "rps": round(len(samples) / elapsed, 1),
+            "p50": round(percentile(samples, 0.50) * 1000, 2),
+            "p95": round(percentile(samples, 0.95) * 1000, 2),
+            "p99": round(percentile(samples, 0.99) * 1000, 2),
+            "max": round((samples[-1] if samples else 0) * 1000, 2),
+        }
+
+
+class Viewer(threading.Thread):
+    def __init__(self, port, args, results, deadline, seed):
+        super().__init__(daemon=True)
+        self.port = port
+        self.args = args
+        self.results = results
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.conn = None
+
+    def request(self, route, method, path, body=None, headers=None, expect=(200,)):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+
+        started = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            received = len(response.read())
+            ok = response.status in expect
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            received = 0
+            ok = False
+        self.results.add(route, time.perf_counter() - started, ok, received)
+
+        if self.args.think:
+            time.sleep(self.rng.uniform(0, self.args.think / 1000))
+
+    def session(self):
+        args = self.args
+        number = self.rng.randrange(args.movies)
+        guid = f"movie-{number}"
+        hashed = hashed_filename(f"{movieName(number)}/{movieFilename(number)}")
+        offset_path = f"/waiter/offset/{guid}/{hashed}/"
+        file_path = f"/waiter/file/{guid}/{quote(hashed)}"
+        range_size = args.range_kb * 1024
+        size = args.size_mb * MB
+
+        self.request("GET dir", "GET", f"/waiter/dir/{guid}/")
+        self.request("GET offset", "GET", offset_path)
+
+        position = self.rng.randrange(0, size - range_size * args.ranges)
+        for i in range(args.ranges):
+            self.request(
+                "GET file",
+                "GET",
+                file_path,
+                headers={
+                    "Range": f"bytes={position}-{position + range_size - 1}",
+                },
+                expect=(206,),
+            )
+            position += range_size
+            if (i + 1) % args.offset_every == 0:
+                self.request(
+                    "POST offset",
+                    "POST",
+                    offset_path,
+                    body=urlencode({"offset": position / size * 7200}),
+                    headers={"Content-Type": "application/x-www-form-urlencoded"},
+                )
+
+        self.request("POST viewed", "POST", f"/waiter/viewed/{guid}/")
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            self.session()
+        if self.conn is not None:
+            self.conn.close()
+
+
+def startServers(args, media_root):
+    stub_port = freePort()
+    stub = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(HERE, "stub_mediaviewer.py"),
+            "--port",
+            str(stub_port),
+            "--media-root",
+            media_root,
+            "--latency",
+            str(args.latency),
+            "--jitter",
+            str(args.jitter),
+        ],
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    waitForServer(stub_port, stub, "stub MediaViewer")
+
+    port = freePort()
+    env = dict(
+        os.environ,
+        MW_MEDIAVIEWER_BASE_URL=f"http://127.0.0.1:{stub_port}/mediaviewer",
+        MW_BASE_PATH=media_root,
+        MW_USE_NGINX="false",
+        MW_OFFSET_STORE_PATH=os.path.join(TMP, "offsets.db"),
+        MW_OUTBOX_PATH=os.path.join(TMP, "outbox.db"),
+    )
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--config",
+            "gunicorn.conf.py",
+            "--workers",
+            str(args.workers),
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--log-level",
+            "warning",
+            "waiter:app",
+        ],
+        env=env,
+        cwd=REPO_DIR,
+    )
+    try:
+        waitForServer(port, server, "gunicorn")
+    except RuntimeError:
+        stub.terminate()
+        server.terminate()
+        raise
+    return stub, server, port
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as media_root:
+        buildMovies(media_root, args.movies, args.size_mb * MB)
+        stub, server, port = startServers(args, media_root)
+        try:
+            results = Results()
+            started = time.monotonic()
+            viewers = [
+                Viewer(port, args, results, started + args.duration, seed)
+                for seed in range(args.users)
+            ]
+            for viewer in viewers:
+                viewer.start()
+            for viewer in viewers:
+                viewer.join()
+            elapsed = time.monotonic() - started
+        finally:
+            server.terminate()
+            server.wait()
+            stub.terminate()
+            _, stub_output = stub.communicate()
+
+    try:
+        upstream = json.loads(stub_output.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        upstream = {}
+
+    return {
+        "users": args.users,
+        "workers": args.workers,
+        "duration": round(elapsed, 1),
+        "upstream_latency_ms": args.latency,
+        "mb_per_s": round(results.bytes / MB / elapsed, 1),
+        "routes": results.report(elapsed),
+        "upstream_calls": upstream,
+    }
+
+
+def printReport(report):
+    print(
+        f"{report['users']} users, {report['workers']} workers, "
+        f"{report['duration']} s, MediaViewer latency "
+        f"{report['upstream_latency_ms']} ms, {report['mb_per_s']} MB/s"
+    )
+    print(
+        f"{'route':<12} {'requests':>9} {'errors':>7} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    )
+    for route in report["routes"]:
+        print(
+            f"{route['route']:<12} {route['requests']:>9} {route['errors']:>7} "
+            f"{route['rps']:>8} {route['p50']:>8} {route['p95']:>8} "
+            f"{route['p99']:>8} {route['max']:>8}"
+        )
+    print("MediaViewer calls:")
+    for endpoint, calls in sorted(report["upstream_calls"].items()):
+        print(f"  {endpoint:<24} {calls:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="in secs")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--movies", type=int, default=50)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--ranges", type=int, default=8)
+    parser.add_argument("--range-kb", type=int, default=512)
+    parser.add_argument("--offset-every", type=int, default=2)
+    parser.add_argument("--think", type=float, default=0, help="in ms")
+    parser.add_argument(
+        "--latency", type=float, default=20, help="MediaViewer latency in ms"
+    )
+    parser.add_argument("--jitter", type=float, default=10, help="in ms")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    printReport(report)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""Minimal WSGI app serving BENCH_MEDIA_FILE through both download paths.
+
+/flask is the previous Flask send_file(conditional=True) path and /range is
+ranges.rangeResponse. Run by bench_range.py under gunicorn.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, request, send_file  # noqa: E402
+from ranges import rangeResponse  # noqa: E402
+
+MEDIA_FILE = os.environ["BENCH_MEDIA_FILE"]
+
+app = Flask(__name__)
+
+
+@app.route("/flask")
+def flask_path():
+    return send_file(MEDIA_FILE, conditional=True)
+
+
+@app.route("/range")
+def range_path():
+    return rangeResponse(MEDIA_FILE, request.environ)
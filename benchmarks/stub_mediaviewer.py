@@ -0,0 +1,194 @@
+"""Stand-in for the MediaViewer endpoints waiter calls, for load testing.
+
+Serves, under /mediaviewer:
+
+- GET  /api/downloadtoken/<guid>/
+- GET  /ajaxgenres/<guid>/ and /ajaxcollections/<guid>/
+- GET, POST and DELETE /ajaxvideoprogress/<guid>/<filename>/
+- POST /ajaxsuperviewed/
+
+A GUID of the form movie-<n> gets a valid movie token for the directory
+"Movie <n>" under --media-root, as built by load_test.py. Offsets are kept
+in memory. Every response is delayed by --latency ms plus up to --jitter ms.
+
+    python benchmarks/stub_mediaviewer.py --port 8000 --media-root /tmp/media
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import threading
+
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PREFIX = "/mediaviewer"
+
+TOKEN_RE = re.compile(r"^/api/downloadtoken/(?P<guid>[^/]+)/$")
+GENRES_RE = re.compile(r"^/ajaxgenres/(?P<guid>[^/]+)/$")
+COLLECTIONS_RE = re.compile(r"^/ajaxcollections/(?P<guid>[^/]+)/$")
+PROGRESS_RE = re.compile(r"^/ajaxvideoprogress/(?P<guid>[^/]+)/(?P<filename>.+)/$")
+VIEWED_RE = re.compile(r"^/ajaxsuperviewed/$")
+MOVIE_GUID_RE = re.compile(r"^movie-(?P<number>\d+)$")
+
+
+def movieName(number):
+    return f"Movie {number:04d}"
+
+
+def movieFilename(number):
+    return f"Movie.{number:04d}.1080p.mv-encoded.mp4"
+
+
+class StubMediaViewer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, media_root, latency=0, jitter=0):
+        super().__init__(address, _Handler)
+        self.media_root = media_root
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+
+        self.offsets = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+
+    def delay(self):
+        seconds = self.latency + self._rng.uniform(0, self.jitter)
+        if seconds:
+            time.sleep(seconds)
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def token(self, guid):
+        match = MOVIE_GUID_RE.match(guid)
+        if match is None:
+            return {"isvalid": False, "theme": "dark"}
+
+        number = int(match.group("number"))
+        name = movieName(number)
+        return {
+            "isvalid": True,
+            "ismovie": True,
+            "guid": guid,
+            "path": f"{self.media_root}/Movies/{name}",
+            "filename": name,
+            "displayname": name,
+            "username": "loadtest",
+            "tv_id": None,
+            "tv_name": None,
+            "binge_mode": False,
+            "videoprogresses": [],
+            "theme": "dark",
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _form(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return parse_qs(self.rfile.read(length).decode("utf-8"))
+
+    def _route(self):
+        path = self.path.split("?", 1)[0]
+        if not path.startswith(PREFIX):
+            return None, None
+        path = path[len(PREFIX) :]
+        for name, pattern in (
+            ("downloadtoken", TOKEN_RE),
+            ("ajaxgenres", GENRES_RE),
+            ("ajaxcollections", COLLECTIONS_RE),
+            ("ajaxvideoprogress", PROGRESS_RE),
+            ("ajaxsuperviewed", VIEWED_RE),
+        ):
+            match = pattern.match(path)
+            if match is not None:
+                return name, match.groupdict()
+        return None, None
+
+    def _handle(self):
+        endpoint, params = self._route()
+        form = self._form() if self.command == "POST" else {}
+        if endpoint is None:
+            return self._json({"detail": "Not found"}, 404)
+
+        self.server.count(f"{self.command} {endpoint}")
+        self.server.delay()
+
+        if endpoint == "downloadtoken" and self.command == "GET":
+            return self._json(self.server.token(params["guid"]))
+        if endpoint == "ajaxgenres" and self.command == "GET":
+            return self._json(
+                {
+                    "tv_genres": [[1, "Drama"], [2, "Comedy"]],
+                    "movie_genres": [[3, "Action"], [4, "Documentary"]],
+                }
+            )
+        if endpoint == "ajaxcollections" and self.command == "GET":
+            return self._json({"collections": [[1, "Favorites"]]})
+        if endpoint == "ajaxvideoprogress":
+            key = (params["guid"], params["filename"])
+            if self.command == "GET":
+                offset, edited = self.server.offsets.get(key, (0, None))
+                return self._json({"offset": offset, "date_edited": edited})
+            if self.command == "POST":
+                offset = float(form.get("offset", ["0"])[0])
+                edited = datetime.now(timezone.utc).isoformat()
+                self.server.offsets[key] = (offset, edited)
+                return self._json({"msg": "success"})
+            if self.command == "DELETE":
+                self.server.offsets.pop(key, None)
+                return self._json({"msg": "deleted"})
+        if endpoint == "ajaxsuperviewed" and self.command == "POST":
+            return self._json({"msg": "success"})
+        return self._json({"detail": "Method not allowed"}, 405)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_DELETE = _handle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--media-root", required=True)
+    parser.add_argument("--latency", type=float, default=0, help="in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="in ms")
+    args = parser.parse_args()
+
+    server = StubMediaViewer(
+        (args.host, args.port), args.media_root, args.latency, args.jitter
+    )
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.calls, sort_keys=True), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
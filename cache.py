@@ -0,0 +1,433 @@
+import json
+import time
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from log import logger
+from database import LocalConnection
+from settings import SHARED_CACHE_PATH, SHARED_CACHE_CHECK_INTERVAL
+
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a time-to-live.
+
+    Entries can be stored with their own ttl so callers can cache negative
+    results (e.g. invalid tokens) for a shorter period than good ones.
+
+    If a SharedCache is given, it is consulted on a local miss and written
+    through on every set so all workers on the host see the same entries.
+    Invalidations are logged there per key, and at most every check_interval
+    seconds the keys invalidated by other workers since are dropped from the
+    local entries, so local hits cost no SQLite read.
+
+    With maxbytes, the least recently used entries are also evicted once the
+    sizes of all entries, as measured by sizeof, add up to more than that.
+    Entries larger than maxbytes are not stored.
+    """
+
+    def __init__(
+        self,
+        maxsize=1024,
+        ttl=60,
+        name="cache",
+        shared=None,
+        maxbytes=None,
+        sizeof=None,
+        check_interval=SHARED_CACHE_CHECK_INTERVAL,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.shared = shared
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.check_interval = check_interval
+
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self._lock = threading.Lock()
+        # Latest shared invalidation seen and when it was last looked for
+        self._seen = None
+        self._checked = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        self._dropInvalidated()
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+
+        if self.shared is not None:
+            entry = self.shared.lookup(key)
+            if entry is not None:
+                value, remaining = entry
+                self._store(key, value, remaining)
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+
+        self._dropInvalidated()
+        self._store(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl=ttl)
+
+    def _dropInvalidated(self):
+        if self.shared is None:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            seen = self._seen
+
+        found = self.shared.invalidations(seen)
+        if found is None:
+            # Local entries are served until they expire
+            return
+
+        latest, keys = found
+        with self._lock:
+            if seen is not None:
+                if keys is None:
+                    self._data.clear()
+                    self._sizes.clear()
+                    self.nbytes = 0
+                else:
+                    for key in [key for key in self._data if str(key) in keys]:
+                        self._remove(key)
+            self._seen = latest
+
+    def _store(self, key, value, ttl):
+        if self.maxsize <= 0:
+            return
+
+        size = 0
+        if self.maxbytes is not None:
+            size = self.sizeof(value)
+            if size > self.maxbytes:
+                return
+
+        expires = time.monotonic() + ttl
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, expires)
+            if self.maxbytes is not None:
+                self._sizes[key] = size
+                self.nbytes += size
+            while len(self._data) > self.maxsize or (
+                self.maxbytes is not None and self.nbytes > self.maxbytes
+            ):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        # Callers hold the lock
+        self._data.pop(key, None)
+        self.nbytes -= self._sizes.pop(key, 0)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+        if self.shared is not None:
+            self.shared.invalidate(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+        if self.shared is not None:
+            self.shared.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        stats = {
+            "name": self.name,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+        if self.maxbytes is not None:
+            stats["bytes"] = self.nbytes
+            stats["maxbytes"] = self.maxbytes
+        return stats
+
+
+class StaleWhileRevalidateCache:
+    """Cache that serves stale entries while refreshing them in the background.
+
+    Entries younger than ttl are served as-is. Older entries are still served
+    immediately, and one refresh per key is handed to executor. Entries are
+    kept for max_age so the last good value keeps being served while the
+    loader is failing.
+    """
+
+    def __init__(
+        self,
+        maxsize=1024,
+        ttl=60,
+        max_age=86400,
+        name="cache",
+        shared=None,
+        executor=None,
+    ):
+        self.ttl = ttl
+        self.executor = executor
+        self.entries = TTLCache(maxsize=maxsize, ttl=max_age, name=name, shared=shared)
+
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        self.stale_hits = 0
+        self.refresh_errors = 0
+
+    def get(self, key, loader):
+        entry = self.entries.get(key)
+        if entry is MISSING:
+            return self._load(key, loader)
+
+        if time.time() - entry["fetched"] >= self.ttl:
+            with self._lock:
+                self.stale_hits += 1
+            return self._refresh(key, loader, entry["value"])
+        return entry["value"]
+
+    def _load(self, key, loader):
+        value = loader(key)
+        self.entries.set(key, {"fetched": time.time(), "value": value})
+        return value
+
+    def _refresh(self, key, loader, stale):
+        with self._lock:
+            if key in self._refreshing:
+                return stale
+            self._refreshing.add(key)
+
+        if self.executor is None:
+            return self._revalidate(key, loader, stale)
+
+        try:
+            self.executor().submit(self._revalidate, key, loader, stale)
+        except RuntimeError as e:
+            # The executor is shutting down along with the worker
+            logger().error(e)
+            with self._lock:
+                self._refreshing.discard(key)
+        return stale
+
+    def _revalidate(self, key, loader, stale):
+        try:
+            return self._load(key, loader)
+        except Exception as e:
+            logger().error(e)
+            with self._lock:
+                self.refresh_errors += 1
+            return stale
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def invalidate(self, key):
+        self.entries.invalidate(key)
+
+    def clear(self):
+        self.entries.clear()
+        with self._lock:
+            self.stale_hits = 0
+            self.refresh_errors = 0
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats["stale_hits"] = self.stale_hits
+        stats["refresh_errors"] = self.refresh_errors
+        return stats
+
+
+class SharedCache:
+    """TTL cache shared by every worker process on a host.
+
+    Entries are stored as JSON in a SQLite database running in WAL mode so
+    readers never block the writer. Each upsert is a single statement and
+    therefore atomic. Errors are logged and treated as cache misses; the
+    shared cache must never take a request down with it.
+
+    Every invalidate() or clear() is also logged, for TTLCaches to drop their
+    local copies of the keys concerned. Only the latest maxrows invalidations
+    of all namespaces are kept.
+    """
+
+    SWEEP_INTERVAL = 60  # in secs
+
+    def __init__(self, path, namespace, ttl=60, maxrows=10000):
+        self.path = str(path)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxrows = maxrows
+
+        self._connection = LocalConnection(self.path, setup=self._createTables)
+        self._last_sweep = 0
+
+    @staticmethod
+    def _createTables(conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "value TEXT NOT NULL, "
+            "expires REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS invalidations ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "namespace TEXT NOT NULL, "
+            "key TEXT)"
+        )
+
+    def lookup(self, key):
+        """Return (value, remaining ttl) for a live entry or None"""
+        now = time.time()
+        try:
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT value, expires FROM cache "
+                    "WHERE namespace = ? AND key = ? AND expires > ?",
+                    (self.namespace, str(key), now),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            logger().error(e)
+            return None
+
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1] - now
+
+    def get(self, key, default=MISSING):
+        entry = self.lookup(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT INTO cache (namespace, key, value, expires) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET "
+                "value = excluded.value, expires = excluded.expires",
+                (self.namespace, str(key), json.dumps(value), now + ttl),
+            )
+            if now - self._last_sweep > self.SWEEP_INTERVAL:
+                self._sweep(conn, now)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger().error(e)
+
+    def _sweep(self, conn, now):
+        self._last_sweep = now
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+        conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND key IN ("
+            "SELECT key FROM cache WHERE namespace = ? "
+            "ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.maxrows),
+        )
+        conn.execute(
+            "DELETE FROM invalidations WHERE seq <= "
+            "(SELECT MAX(seq) FROM invalidations) - ?",
+            (self.maxrows,),
+        )
+
+    def invalidations(self, since=None):
+        """Return (latest, keys) where latest is the sequence number of the
+        last invalidation and keys are the keys of the namespace invalidated
+        after since, or None if every key was or their log is gone. Returns
+        None on errors."""
+        try:
+            conn = self._connection()
+            latest, oldest = conn.execute(
+                "SELECT MAX(seq), MIN(seq) FROM invalidations"
+            ).fetchone()
+            latest = latest or 0
+            if since is None or since == latest:
+                return latest, set()
+            if since > latest or oldest > since + 1:
+                return latest, None
+            rows = conn.execute(
+                "SELECT key FROM invalidations "
+                "WHERE namespace = ? AND seq > ? AND seq <= ?",
+                (self.namespace, since, latest),
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger().error(e)
+            return None
+
+        keys = set()
+        for (key,) in rows:
+            if key is None:
+                return latest, None
+            keys.add(key)
+        return latest, keys
+
+    def _logInvalidation(self, conn, key):
+        conn.execute(
+            "INSERT INTO invalidations (namespace, key) VALUES (?, ?)",
+            (self.namespace, key),
+        )
+
+    def invalidate(self, key):
+        try:
+            conn = self._connection()
+            conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, str(key)),
+            )
+            self._logInvalidation(conn, str(key))
+        except sqlite3.Error as e:
+            logger().error(e)
+
+    def clear(self):
+        try:
+            conn = self._connection()
+            conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+            self._logInvalidation(conn, None)
+        except sqlite3.Error as e:
+            logger().error(e)
+
+
+def sharedCache(namespace, ttl=60):
+    """Return a SharedCache for namespace or None if sharing is disabled"""
+    if not SHARED_CACHE_PATH:
+        return None
+    return SharedCache(SHARED_CACHE_PATH, namespace, ttl=ttl)
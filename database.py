@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import threading
+
+
+def connect(path):
+    """Open the SQLite database at path in autocommit and WAL mode, so readers
+    in every worker on the host never block the writer"""
+    conn = sqlite3.connect(str(path), timeout=1, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class LocalConnection:
+    """Callable returning the calling thread's connection to path.
+
+    Connections are not safe to share across threads or to carry over a
+    fork, so one is kept per thread and reopened after gunicorn forks.
+    setup(conn) is run on every new connection, e.g. to create tables.
+    """
+
+    def __init__(self, path, setup=None, row_factory=None):
+        self.path = str(path)
+        self.setup = setup
+        self.row_factory = row_factory
+
+        self._local = threading.local()
+
+    def __call__(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect(self.path)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            if self.setup is not None:
+                self.setup(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -1,7 +1,70 @@
+import os
+import shutil
+import tempfile
+
 # import multiprocessing
 
+# Workers log through a single writer process, see when_ready. Set
+# here so the forked workers inherit it.
+os.environ.setdefault(
+    "MW_LOG_SOCKET",
+    os.path.join(tempfile.gettempdir(), f"waiter-log-{os.getpid()}.sock"),
+)
+# Workers write their metrics here for /waiter/metrics to add up
+os.environ.setdefault(
+    "MW_METRICS_DIR",
+    os.path.join(tempfile.gettempdir(), f"waiter-metrics-{os.getpid()}"),
+)
 
 bind = "0.0.0.0:5000"
 # workers = multiprocessing.cpu_count() * 2 + 1
 workers = 8
 timeout = 60
+
+
+def when_ready(server):
+    from log import SinkProcess
+    from settings import LOG_SOCKET
+
+    # child_exit runs in the SIGCHLD handler, so importing metrics there
+    # for the first time can be interrupted by the next worker exiting
+    import metrics  # noqa: F401
+
+    server.log_sink = SinkProcess(LOG_SOCKET)
+    server.log_sink.start()
+
+    # Counters start from zero with every master
+    shutil.rmtree(os.environ["MW_METRICS_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["MW_METRICS_DIR"], mode=0o700)
+
+
+def on_exit(server):
+    # Missing if the master exits before it was ready
+    log_sink = getattr(server, "log_sink", None)
+    if log_sink is not None:
+        log_sink.stop()
+    shutil.rmtree(os.environ["MW_METRICS_DIR"], ignore_errors=True)
+
+
+def child_exit(server, worker):
+    # Keep the counts of workers that are gone
+    from metrics import registry
+
+    registry.archive(worker.pid)
+
+
+def worker_exit(server, worker):
+    # Send offsets and viewed notifications still waiting for MediaViewer
+    from waiter import offsetStore, viewedOutbox
+
+    offsetStore.stop()
+    viewedOutbox.stop()
+
+    from metrics import registry
+
+    registry.stop()
+
+    # Hand the last records to the log sink before the worker goes away
+    from log import LogFile
+
+    LogFile.stop()
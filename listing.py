@@ -0,0 +1,301 @@
+import os
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+from settings import LISTING_CACHE_SIZE, LISTING_CACHE_MAX_AGE, MINIMUM_FILE_SIZE
+from utils import hashed_filename
+
+MediaFile = namedtuple("MediaFile", "root,filename,size,subtitles")
+
+SUBTITLE_SUFFIX = ".vtt"
+
+# Filesystems only record mtimes with limited precision, so a directory
+# modified within this window of being scanned may change again without its
+# mtime moving. Such listings are rescanned instead of trusted.
+RACY_WINDOW = 2  # in secs
+
+
+class Listing:
+    """Media files found under a directory along with the mtimes of every
+    directory that was read to build it."""
+
+    def __init__(self, path, files, mtimes, built=None):
+        self.path = path
+        self.files = files
+        self.mtimes = mtimes
+        self.built = time.time() if built is None else built
+
+        self._hashIndexes = {}
+        self._version = None
+
+    def hashIndex(self, prefix):
+        """Map hashed waiter paths under prefix to (MediaFile, subtitle path).
+
+        The subtitle path is None for the media file itself. The index is built
+        once per prefix and goes away with the listing when it is rebuilt.
+        """
+        index = self._hashIndexes.get(prefix)
+        if index is None:
+            index = {}
+            for mediaFile in self.files:
+                index.setdefault(
+                    hashed_filename(str(Path(prefix) / mediaFile.filename)),
+                    (mediaFile, None),
+                )
+                for subtitle in mediaFile.subtitles:
+                    index.setdefault(
+                        hashed_filename(str(Path(prefix) / subtitle.name)),
+                        (mediaFile, subtitle),
+                    )
+            self._hashIndexes[prefix] = index
+        return index
+
+    @property
+    def version(self):
+        """Digest of the files in the listing, the same in every process that
+        lists the same directory contents"""
+        if self._version is None:
+            digest = hashlib.sha256()
+            for mediaFile in self.files:
+                digest.update(
+                    repr(
+                        (
+                            str(mediaFile.root),
+                            mediaFile.filename,
+                            mediaFile.size,
+                            [str(subtitle) for subtitle in mediaFile.subtitles],
+                        )
+                    ).encode("utf-8")
+                )
+            self._version = digest.hexdigest()
+        return self._version
+
+    def isRacy(self):
+        return any(
+            self.built - mtime_ns / 1e9 < RACY_WINDOW
+            for mtime_ns in self.mtimes.values()
+            if mtime_ns is not None
+        )
+
+    def isCurrent(self):
+        for directory, mtime_ns in self.mtimes.items():
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime_ns:
+                return False
+        return True
+
+    def hasGrown(self, min_size):
+        """Whether a file smaller than min_size when listed has changed size.
+
+        Writing to a file does not touch the mtime of its directory, so a file
+        still being copied in would otherwise keep its partial size.
+        """
+        for mediaFile in self.files:
+            if mediaFile.size >= min_size:
+                continue
+            try:
+                size = os.stat(mediaFile.root / mediaFile.filename).st_size
+            except OSError:
+                return True
+            if size != mediaFile.size:
+                return True
+        return False
+
+
+def _groupSubtitles(subtitle_paths):
+    """Index subtitles by every dotted prefix of their name.
+
+    Movie.mv-encoded.en.vtt is filed under Movie, Movie.mv-encoded and
+    Movie.mv-encoded.en so a video's subtitles are found with a single lookup
+    of its stem.
+    """
+    grouped = {}
+    for subtitle_path in subtitle_paths:
+        parts = subtitle_path.name[: -len(SUBTITLE_SUFFIX)].split(".")
+        for i in range(1, len(parts) + 1):
+            grouped.setdefault(".".join(parts[:i]), []).append(subtitle_path)
+    return grouped
+
+
+def scanDirectory(path, accept, recursive=True):
+    """Return a Listing of the files under path that pass accept(filename).
+
+    Each directory is read once with os.scandir. The name filter runs before
+    any file is stat-ed and sizes come from the cached DirEntry stat results.
+    """
+    files = []
+    mtimes = {}
+
+    try:
+        top_mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        # Remember that the directory was missing so its creation is noticed
+        top_mtime = None
+
+    pending = [(Path(path), top_mtime)]
+    while pending:
+        root, mtime_ns = pending.pop()
+        # The mtime is taken before the directory is read so changes made
+        # during the scan invalidate the listing on the next request.
+        mtimes[str(root)] = mtime_ns
+        if mtime_ns is None:
+            continue
+
+        candidates = []
+        subtitle_paths = []
+        subdirectories = []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirectories.append(entry)
+                    elif entry.name.endswith(SUBTITLE_SUFFIX):
+                        subtitle_paths.append(root / entry.name)
+                    elif accept(entry.name) and entry.is_file():
+                        candidates.append(entry)
+        except OSError:
+            continue
+
+        subtitles = _groupSubtitles(subtitle_paths)
+        for entry in candidates:
+            files.append(
+                MediaFile(
+                    root=root,
+                    filename=entry.name,
+                    size=entry.stat().st_size,
+                    subtitles=tuple(subtitles.get(Path(entry.name).stem, ())),
+                )
+            )
+
+        for entry in reversed(subdirectories):
+            try:
+                pending.append((root / entry.name, entry.stat().st_mtime_ns))
+            except OSError:
+                continue
+
+    return Listing(Path(path), files, mtimes)
+
+
+class ListingCache:
+    """LRU cache of directory listings keyed by directory path.
+
+    A cached listing is reused for as long as none of the directories it was
+    built from have a new mtime, up to max_age seconds. Files smaller than
+    min_size, which are not served, are re-stat-ed as well so they show up
+    once they have been copied in. Growing files that are already larger keep
+    the size they were listed with for up to max_age.
+
+    When a watcher covers a listing's directory, changes are pushed in through
+    invalidate() and the per-request checks are skipped. Files are then picked
+    up, with their final size, once they are closed after writing.
+    """
+
+    def __init__(
+        self,
+        maxsize=LISTING_CACHE_SIZE,
+        max_age=LISTING_CACHE_MAX_AGE,
+        watcher=None,
+        min_size=MINIMUM_FILE_SIZE,
+    ):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.watcher = watcher
+        self.min_size = min_size
+
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a scan racing with a change is not
+        # stored as if it were current.
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, accept, recursive=True):
+        key = (str(path), recursive)
+        with self._lock:
+            listing = self._listings.get(key)
+
+        if listing is not None and self._isValid(listing):
+            with self._lock:
+                if key in self._listings:
+                    self._listings.move_to_end(key)
+                self.hits += 1
+            return listing
+
+        with self._lock:
+            generation = self._generation
+        listing = scanDirectory(path, accept, recursive=recursive)
+        with self._lock:
+            self.misses += 1
+            if generation != self._generation:
+                return listing
+            self._listings[key] = listing
+            self._listings.move_to_end(key)
+            while len(self._listings) > self.maxsize:
+                self._listings.popitem(last=False)
+        return listing
+
+    def _isValid(self, listing):
+        if time.time() - listing.built > self.max_age:
+            return False
+        if self.watcher is not None and self.watcher.covers(listing.path):
+            return True
+        return self._isUnchanged(listing)
+
+    def _isUnchanged(self, listing):
+        return (
+            not listing.isRacy()
+            and listing.isCurrent()
+            and not listing.hasGrown(self.min_size)
+        )
+
+    def revalidate(self):
+        """Drop every cached listing whose directories have changed"""
+        with self._lock:
+            listings = list(self._listings.items())
+
+        for key, listing in listings:
+            if not self._isUnchanged(listing):
+                with self._lock:
+                    if self._listings.get(key) is listing:
+                        del self._listings[key]
+
+    def invalidate(self, path=None):
+        """Drop cached listings for path and anything beneath it, or everything"""
+        with self._lock:
+            self._generation += 1
+            if path is None:
+                self._listings.clear()
+                return
+
+            path = Path(path)
+            for key, listing in list(self._listings.items()):
+                if (
+                    listing.path == path
+                    or path in listing.path.parents
+                    or str(path) in listing.mtimes
+                ):
+                    del self._listings[key]
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "name": "listing",
+            "size": len(self._listings),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,15 +1,325 @@
+import os
+import sys
+import json
+import queue
+import select
+import signal
+import struct
+import atexit
 import logging
+import threading
+import subprocess
+import socketserver
 
-from logging.handlers import RotatingFileHandler
-from settings import LOG_FILE_NAME, LOG_PATH
+from logging.handlers import (
+    RotatingFileHandler,
+    SocketHandler,
+    QueueHandler,
+    QueueListener,
+)
+from settings import LOG_FILE_NAME, LOG_PATH, LOG_LEVEL, LOG_SOCKET, LOG_QUEUE_SIZE
 
 fullLogPath = LOG_PATH / LOG_FILE_NAME
 
 
+def _fileHandler(path):
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    rfh = RotatingFileHandler(
+        path,
+        mode="a",
+        maxBytes=1000000,
+        backupCount=10,
+    )
+    rfh.setFormatter(formatter)
+    return rfh
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock handler formats every record before queueing it so it can be
+    pickled. The queue never leaves the process, so the record is queued as
+    is and its arguments are only rendered when it is written.
+
+    The queue is bounded. Records that do not fit are counted and dropped
+    rather than holding up the request that logged them.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room rather than fail when the queue is full
+        self.queue.put(self._sentinel)
+
+
+class SinkHandler(SocketHandler):
+    """Send records to a LogSink over its unix socket.
+
+    Records are sent as length-prefixed JSON with their message already
+    rendered. While the sink cannot be reached records are dropped and the
+    connection is retried with backoff. Dropped records are counted and a
+    warning with the count is sent once the sink can be reached again.
+    """
+
+    def __init__(self, path):
+        super().__init__(str(path), None)
+        self.dropped = 0
+        self._unreported = 0
+
+    def send(self, s):
+        if self.sock is None:
+            self.createSocket()
+            if self.sock is not None and self._unreported:
+                self._reportDropped()
+        if self.sock is None:
+            self._drop()
+            return
+
+        try:
+            self.sock.sendall(s)
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            self._drop()
+
+    def _drop(self):
+        self.dropped += 1
+        self._unreported += 1
+
+    def _reportDropped(self):
+        record = logging.makeLogRecord(
+            {
+                "name": "waiter",
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": "Dropped %s log records while the log sink was unreachable",
+                "args": (self._unreported,),
+            }
+        )
+        try:
+            self.sock.sendall(self.makePickle(record))
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            return
+        self._unreported = 0
+
+    def makePickle(self, record):
+        data = {
+            "name": record.name,
+            "levelno": record.levelno,
+            "levelname": record.levelname,
+            "msg": record.getMessage(),
+            "created": record.created,
+            "msecs": record.msecs,
+            "process": record.process,
+            "thread": record.thread,
+            "threadName": record.threadName,
+        }
+        if record.exc_info:
+            data["exc_text"] = logging.Formatter().formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc_text"] = record.exc_text
+        if record.stack_info:
+            data["stack_info"] = record.stack_info
+
+        payload = json.dumps(data).encode("utf-8")
+        return struct.pack(">L", len(payload)) + payload
+
+
+class _SinkConnection(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            (length,) = struct.unpack(">L", header)
+            payload = self.rfile.read(length)
+            if len(payload) < length:
+                return
+
+            try:
+                record = logging.makeLogRecord(json.loads(payload))
+            except ValueError:
+                continue
+            self.server.sink.write(record)
+
+
+class LogSink:
+    """The single writer of the log file for every gunicorn worker.
+
+    Runs in a process of its own started by the gunicorn master with
+    SinkProcess (see gunicorn.conf.py). Workers send their
+    records to it over a unix socket with SinkHandler, and it appends them
+    to the rotating log file. Only one process ever writes or rotates the
+    file, so lines are neither interleaved nor lost to racing rotations.
+    """
+
+    POLL_INTERVAL = 0.1  # in secs
+
+    def __init__(self, path, logfile=None):
+        self.path = str(path)
+        self.logfile = fullLogPath if logfile is None else logfile
+
+        self.handler = None
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.written = 0
+
+    def start(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        self.handler = _fileHandler(self.logfile)
+        # Only the user running waiter may send records
+        umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(
+                self.path, _SinkConnection
+            )
+        finally:
+            os.umask(umask)
+        # Connection threads are joined on stop so records already sent by
+        # workers that have exited are still written
+        self._server.daemon_threads = False
+        self._server.block_on_close = True
+        self._server.sink = self
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            args=(self.POLL_INTERVAL,),
+            name="log-sink",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def write(self, record):
+        # The handler's lock serializes writes and rotation across connections
+        self.handler.handle(record)
+        with self._lock:
+            self.written += 1
+
+    def stop(self):
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        # Connections still waiting to be accepted may hold the last records
+        while select.select([self._server.socket], [], [], 0)[0]:
+            self._server.handle_request()
+        self._server.server_close()
+        self._thread.join()
+        self.handler.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._server = None
+
+
+def _runSink(path, logfile, parent):
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+    # Ctrl-C reaches the whole process group. Keep writing until the master
+    # is done with its workers and stops the sink.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    sink = LogSink(path, logfile)
+    sink.start()
+    print("ready", flush=True)
+    # Stop with the master even if it dies without stopping the sink
+    while not stopping.wait(SinkProcess.PARENT_CHECK_INTERVAL):
+        if os.getppid() != parent:
+            break
+    sink.stop()
+
+
+class SinkProcess:
+    """Run a LogSink in a process of its own, for the gunicorn master.
+
+    The master forks every worker, and threads running in it at the time
+    (and any locks they hold) do not carry over a fork cleanly, so the sink
+    runs this module in a separate interpreter instead. start() returns once
+    the sink is accepting records.
+    """
+
+    PARENT_CHECK_INTERVAL = 1  # in secs
+    START_TIMEOUT = 10  # in secs
+    STOP_TIMEOUT = 10  # in secs
+
+    def __init__(self, path, logfile=None):
+        self.path = str(path)
+        self.logfile = fullLogPath if logfile is None else logfile
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                self.path,
+                str(self.logfile),
+                str(os.getpid()),
+            ],
+            stdout=subprocess.PIPE,
+        )
+        ready, _, _ = select.select([self.process.stdout], [], [], self.START_TIMEOUT)
+        started = ready and self.process.stdout.readline()
+        self.process.stdout.close()
+        if not started:
+            self.stop()
+            raise RuntimeError(f"Log sink did not start on {self.path}")
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        self.process.terminate()
+        try:
+            self.process.wait(self.STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
 class LogFile:
+    """The waiter logger.
+
+    Records are put on an in-memory queue by the calling thread and
+    formatted and written by a QueueListener thread, so requests never wait
+    on the disk. Records below LOG_LEVEL are dropped before anything is
+    formatted, as long as callers pass arguments %-style instead of
+    formatting the message themselves.
+
+    When LOG_SOCKET is set, as it is under gunicorn, the listener sends the
+    records to the LogSink instead of writing the file itself.
+    """
+
     logger = None
+    listener = None
 
     _instance = None
+    _pid = None
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
@@ -18,25 +328,48 @@ class LogFile:
 
     @classmethod
     def getLogger(cls):
-        if not cls.logger:
-            formatter = logging.Formatter(
-                "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-            )
+        # The listener thread does not survive a fork, so a forked worker
+        # starts its own
+        if not cls.logger or cls._pid != os.getpid():
             log = logging.getLogger("waiter")
-            log.setLevel(logging.DEBUG)
-            rfh = RotatingFileHandler(
-                fullLogPath,
-                mode="a",
-                maxBytes=1000000,
-                backupCount=10,
-            )
-            rfh.setFormatter(formatter)
-            log.addHandler(rfh)
+            log.setLevel(LOG_LEVEL)
+            if LOG_SOCKET:
+                handler = SinkHandler(LOG_SOCKET)
+            else:
+                handler = _fileHandler(fullLogPath)
+
+            records = queue.Queue(LOG_QUEUE_SIZE)
+            for old in list(log.handlers):
+                if isinstance(old, QueueHandler):
+                    log.removeHandler(old)
+            log.addHandler(DeferredQueueHandler(records))
+
+            cls.listener = _Listener(records, handler, respect_handler_level=True)
+            cls.listener.start()
             cls.logger = log
+            cls._pid = os.getpid()
 
         return cls.logger
 
+    @classmethod
+    def stop(cls):
+        """Write out every queued record and stop the listener thread"""
+        if cls.listener is not None and cls._pid == os.getpid():
+            cls.listener.stop()
+            for handler in cls.listener.handlers:
+                handler.close()
+        cls.listener = None
+        cls.logger = None
+        cls._pid = None
+
+
+atexit.register(LogFile.stop)
+
 
 def logger():
     log = LogFile.getLogger()
     return log
+
+
+if __name__ == "__main__":
+    _runSink(sys.argv[1], sys.argv[2], int(sys.argv[3]))
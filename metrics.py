@@ -0,0 +1,325 @@
+import os
+import json
+import math
+import threading
+
+from pathlib import Path
+from log import logger
+from background import BackgroundLoop
+from settings import METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+ARCHIVE_NAME = "archive.json"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def describe(self):
+        return {"type": self.type, "help": self.help, "labelnames": self.labelnames}
+
+    def samples(self):
+        with self._lock:
+            return [
+                [list(key), self._copy(value)] for key, value in self._values.items()
+            ]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    @staticmethod
+    def merge(ours, theirs):
+        return ours + theirs
+
+    def render(self, samples):
+        for key, value in samples:
+            yield f"{self.name}{_labels(self.labelnames, key)} {_formatValue(value)}"
+
+
+class Histogram(Metric):
+    """Histogram stored as per-bucket counts followed by the sum"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def describe(self):
+        return {**super().describe(), "buckets": self.buckets[:-1]}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def count(self, **labels):
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return sum(counts[:-1]) if counts else 0
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    @staticmethod
+    def merge(ours, theirs):
+        return [a + b for a, b in zip(ours, theirs)]
+
+    def render(self, samples):
+        for key, counts in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels(self.labelnames, key, [("le", _formatValue(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_formatValue(counts[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry(BackgroundLoop):
+    """Counters and histograms shared by every gunicorn worker on the host.
+
+    Each worker keeps its metrics in memory and a daemon thread writes them
+    to its own file in directory every flush_interval seconds. A scrape adds
+    the files of the other workers to the live values of the worker serving
+    it, so one scrape covers the whole host, at most flush_interval seconds
+    behind for the other workers.
+
+    The master folds the file of a worker that exits into a single archive
+    file (see gunicorn.conf.py) so counters never go backwards when workers
+    are replaced. Without a directory metrics only cover the current
+    process.
+    """
+
+    LOOP_NAME = "metrics-flush"
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = Path(directory) if directory else None
+        self.flush_interval = flush_interval
+
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._initLoop()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            metric.name: {**metric.describe(), "samples": metric.samples()}
+            for metric in metrics
+        }
+
+    def workerPath(self, pid=None):
+        return self.directory / f"worker-{os.getpid() if pid is None else pid}.json"
+
+    @staticmethod
+    def _write(path, snapshot):
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(json.dumps(snapshot))
+        os.replace(tmp, path)
+
+    def flush(self):
+        if self.directory is None:
+            return
+        self._write(self.workerPath(), self.snapshot())
+
+    def _merge(self, merged, snapshot):
+        with self._lock:
+            metrics = dict(self._metrics)
+
+        for name, data in snapshot.items():
+            metric = metrics.get(name)
+            if metric is None:
+                continue
+            samples = merged.setdefault(name, {})
+            for key, value in data["samples"]:
+                key = tuple(key)
+                if key in samples:
+                    samples[key] = metric.merge(samples[key], value)
+                else:
+                    samples[key] = value
+
+    def collect(self):
+        """Return every metric's samples summed over all workers, keyed by
+        metric name and then label values"""
+        merged = {}
+        self._merge(merged, self.snapshot())
+        if self.directory is None:
+            return merged
+
+        own = self.workerPath()
+        for path in sorted(self.directory.glob("*.json")):
+            if path == own:
+                continue
+            try:
+                self._merge(merged, json.loads(path.read_text()))
+            except (OSError, ValueError) as e:
+                # Worker files are replaced atomically, so this is a worker
+                # that has just been archived
+                logger().debug("Skipping metrics file %s: %s", path, e)
+        return merged
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        collected = self.collect()
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            samples = sorted(collected.get(metric.name, {}).items())
+            lines.extend(metric.render(samples))
+        return "\n".join(lines) + "\n"
+
+    def archive(self, pid):
+        """Fold the file of the exited worker pid into the archive"""
+        if self.directory is None:
+            return
+
+        path = self.workerPath(pid)
+        try:
+            snapshot = json.loads(path.read_text())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger().error(e)
+            return
+
+        archive = self.directory / ARCHIVE_NAME
+        merged = {}
+        try:
+            self._merge(merged, json.loads(archive.read_text()))
+        except FileNotFoundError:
+            pass
+        self._merge(merged, snapshot)
+
+        with self._lock:
+            metrics = dict(self._metrics)
+        self._write(
+            archive,
+            {
+                name: {
+                    **metrics[name].describe(),
+                    "samples": [[list(key), value] for key, value in samples.items()],
+                }
+                for name, samples in merged.items()
+            },
+        )
+        path.unlink()
+
+    def _loopEnabled(self):
+        return self.directory is not None
+
+    def _loopInterval(self):
+        return self.flush_interval
+
+    def _loopTick(self):
+        self.flush()
+
+
+registry = MetricsRegistry()
+
+requestLatency = registry.histogram(
+    "waiter_request_duration_seconds",
+    "Time to build the response to a request, by route",
+    ["route"],
+)
+requestCount = registry.counter(
+    "waiter_requests_total",
+    "Requests served, by route and status code",
+    ["route", "status"],
+)
+upstreamLatency = registry.histogram(
+    "waiter_upstream_request_duration_seconds",
+    "Duration of calls to MediaViewer, by endpoint",
+    ["endpoint"],
+)
+upstreamErrors = registry.counter(
+    "waiter_upstream_errors_total",
+    "Failed calls to MediaViewer, by endpoint and reason",
+    ["endpoint", "reason"],
+)
+fileSends = registry.counter(
+    "waiter_file_sends_total",
+    "File downloads answered, by how they were sent and status code",
+    ["mode", "status"],
+)
+fileBytesSent = registry.counter(
+    "waiter_file_sent_bytes_total",
+    "Bytes of file downloads written to clients by waiter itself, by how they "
+    "were sent",
+    ["mode"],
+)
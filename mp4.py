@@ -0,0 +1,219 @@
+import os
+import struct
+
+from collections import namedtuple
+from cache import TTLCache, MISSING
+from log import logger
+from ranges import Part, fileETag
+from timing import timed
+from settings import (
+    FASTSTART_MP4,
+    FASTSTART_CACHE_SIZE,
+    FASTSTART_CACHE_BYTES,
+    FASTSTART_CACHE_TTL,
+    FASTSTART_MAX_MOOV,
+)
+
+FASTSTART_SUFFIXES = {".mp4", ".m4v", ".mov"}
+
+# Boxes walked on the way down to the chunk offset tables
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+Box = namedtuple("Box", "type,offset,size,header")
+
+# A stretch of the virtual file, either bytes held in memory (data) or the
+# file's own bytes starting at source
+Segment = namedtuple("Segment", "start,end,data,source")
+
+
+def _layoutBytes(layout):
+    # Files that are served as they are cache None
+    return 0 if layout is None else layout.nbytes
+
+
+layoutCache = TTLCache(
+    maxsize=FASTSTART_CACHE_SIZE,
+    ttl=FASTSTART_CACHE_TTL,
+    name="faststart",
+    maxbytes=FASTSTART_CACHE_BYTES,
+    sizeof=_layoutBytes,
+)
+
+
+def _boxHeader(data, pos, end):
+    if end - pos < 8:
+        raise ValueError(f"Truncated box header at {pos}")
+
+    size, box_type = struct.unpack_from(">I4s", data, pos)
+    header = 8
+    if size == 1:
+        if end - pos < 16:
+            raise ValueError(f"Truncated box header at {pos}")
+        (size,) = struct.unpack_from(">Q", data, pos + 8)
+        header = 16
+    elif size == 0:
+        # The box runs to the end of its parent
+        size = end - pos
+
+    if size < header or pos + size > end:
+        raise ValueError(f"Bad size for {box_type!r} box at {pos}")
+    return box_type, size, header
+
+
+def readBoxes(fp, size):
+    """Return the top-level boxes of an MP4 file of the given size.
+
+    Raises ValueError if they do not exactly cover the file.
+    """
+    boxes = []
+    offset = 0
+    while offset < size:
+        fp.seek(offset)
+        data = fp.read(16)
+        box_type, box_size, header = _boxHeader(data, 0, size - offset)
+        boxes.append(Box(box_type, offset, box_size, header))
+        offset += box_size
+    return boxes
+
+
+def _shiftTable(moov, pos, end, fmt, delta, low, high):
+    width = struct.calcsize(fmt)
+    (count,) = struct.unpack_from(">I", moov, pos + 4)
+    entries = pos + 8
+    if entries + count * width > end:
+        raise ValueError("Truncated chunk offset table")
+
+    table = f">{count}{fmt}"
+    offsets = [
+        offset + delta if low <= offset < high else offset
+        for offset in struct.unpack_from(table, moov, entries)
+    ]
+    if fmt == "I" and offsets and max(offsets) > 0xFFFFFFFF:
+        raise ValueError("Relocated chunk offsets do not fit in stco")
+    struct.pack_into(table, moov, entries, *offsets)
+
+
+def shiftChunkOffsets(moov, delta, low, high, start=0, end=None):
+    """Add delta to every stco/co64 chunk offset in moov that falls in
+    [low, high). moov is a bytearray and is patched in place."""
+    end = len(moov) if end is None else end
+    pos = start
+    while pos < end:
+        box_type, size, header = _boxHeader(moov, pos, end)
+        body = pos + header
+        if box_type in CONTAINERS:
+            shiftChunkOffsets(moov, delta, low, high, body, pos + size)
+        elif box_type == b"stco":
+            _shiftTable(moov, body, pos + size, "I", delta, low, high)
+        elif box_type == b"co64":
+            _shiftTable(moov, body, pos + size, "Q", delta, low, high)
+        pos += size
+
+
+class FastStartLayout:
+    """Virtual fast-start view of an MP4 file whose moov box follows its
+    media data.
+
+    The file is served as if the moov box sat just before the first mdat box,
+    with its chunk offsets patched to match. Everything else is read from the
+    file on disk as-is, so the virtual file has the same size as the real one.
+    """
+
+    def __init__(self, stat, moov, mdat, data):
+        self.size = stat.st_size
+        # Memory held by the relocated moov
+        self.nbytes = len(data)
+        # Same bytes in a different order, so the ETag has to differ from the
+        # one of the file served as-is
+        self.etag = f'{fileETag(stat)[:-1]}-faststart"'
+
+        self.segments = []
+        for start, end, chunk in (
+            (0, mdat.offset, None),
+            (None, None, bytes(data)),
+            (mdat.offset, moov.offset, None),
+            (moov.offset + moov.size, self.size, None),
+        ):
+            length = end - start if chunk is None else len(chunk)
+            if length:
+                position = self.segments[-1].end + 1 if self.segments else 0
+                self.segments.append(
+                    Segment(position, position + length - 1, chunk, start)
+                )
+
+    def mapParts(self, parts):
+        """Translate Parts addressing the virtual file into Parts of the real
+        one, carrying the relocated moov along as part prefixes."""
+        mapped = []
+        for part in parts:
+            prefix = part.prefix
+            for segment in self.segments:
+                if part.end < part.start:
+                    break
+                if segment.end < part.start or segment.start > part.end:
+                    continue
+
+                start = max(part.start, segment.start) - segment.start
+                end = min(part.end, segment.end) - segment.start
+                if segment.data is not None:
+                    prefix += segment.data[start : end + 1]
+                else:
+                    mapped.append(
+                        Part(prefix, segment.source + start, segment.source + end)
+                    )
+                    prefix = b""
+
+            if prefix:
+                mapped.append(Part(prefix, 0, -1))
+        return mapped
+
+
+@timed("faststart")
+def buildFastStart(path, stat):
+    """Return a FastStartLayout for the MP4 file at path, or None if it
+    already starts with its moov box or cannot be relocated"""
+    with open(path, "rb") as fp:
+        boxes = readBoxes(fp, stat.st_size)
+        types = [box.type for box in boxes]
+        if b"moov" not in types or b"mdat" not in types or b"moof" in types:
+            # Fragmented files carry their own offsets in each fragment
+            return None
+
+        moov = boxes[types.index(b"moov")]
+        mdat = boxes[types.index(b"mdat")]
+        if moov.offset < mdat.offset:
+            return None
+        if moov.size > FASTSTART_MAX_MOOV:
+            logger().debug("moov of %s is too large to relocate: %s", path, moov.size)
+            return None
+
+        fp.seek(moov.offset)
+        data = bytearray(fp.read(moov.size))
+
+    # Media stored between the first mdat and the moov moves down by the
+    # size of the moov. Anything after the moov keeps its place.
+    shiftChunkOffsets(data, moov.size, mdat.offset, moov.offset)
+    return FastStartLayout(stat, moov, mdat, data)
+
+
+def fastStartLayout(path, stat=None):
+    """Return the cached FastStartLayout for path, or None when the file
+    should be served as it is"""
+    path = str(path)
+    if not FASTSTART_MP4 or os.path.splitext(path)[1].lower() not in FASTSTART_SUFFIXES:
+        return None
+
+    stat = os.stat(path) if stat is None else stat
+    key = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    layout = layoutCache.get(key)
+    if layout is not MISSING:
+        return layout
+
+    try:
+        layout = buildFastStart(path, stat)
+    except (OSError, ValueError, struct.error) as e:
+        logger().debug("Unable to read MP4 boxes of %s: %s", path, e)
+        layout = None
+
+    layoutCache.set(key, layout)
+    return layout
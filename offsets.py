@@ -0,0 +1,417 @@
+import time
+import sqlite3
+import threading
+
+from datetime import datetime, timezone
+from log import logger
+from background import BackgroundLoop
+from database import LocalConnection
+from upstream import isUnavailable
+from settings import (
+    OFFSET_SYNC_INTERVAL,
+    OFFSET_WRITE_INTERVAL,
+    OFFSET_REFRESH_INTERVAL,
+    OFFSET_STORE_RETENTION,
+)
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _parseDate(value):
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _sameDate(a, b):
+    parsedA, parsedB = _parseDate(a), _parseDate(b)
+    if parsedA is None or parsedB is None:
+        return a == b
+    return parsedA == parsedB
+
+
+def hasChanged(current, seen_edited):
+    """Whether MediaViewer's copy current was edited since the date_edited
+    seen at the last read. If nothing was seen the local write stands."""
+    if seen_edited is None:
+        return False
+    return not _sameDate(current.get("date_edited"), seen_edited)
+
+
+class OffsetStore(BackgroundLoop):
+    """Local write-behind store for playback offsets.
+
+    Offsets live in a SQLite database in WAL mode shared by every worker on
+    the host. Writes and deletes commit locally and are marked dirty, and a
+    daemon thread in each worker looks for dirty rows every sync_interval
+    seconds. A row is only sent once write_interval seconds have passed since
+    it was last sent, so the writes a player makes in between coalesce into
+    one, and stop() sends everything still pending. Reads are answered locally for dirty rows, so a
+    player always reads its own writes, and for rows confirmed with
+    MediaViewer less than refresh_interval seconds ago. Anything else is
+    read from MediaViewer, falling back to the local row if it cannot be
+    reached.
+
+    Each row also keeps the date_edited of MediaViewer's copy as last read.
+    Conflicts are settled when a read goes to MediaViewer anyway: a local
+    write that is not synced yet is dropped if MediaViewer's copy was edited
+    since (e.g. progress recorded through another waiter), and is otherwise
+    served and synced as usual. Syncing only writes, without reading first.
+    Only MediaViewer's own stamps are compared, never against the local
+    clock or the offsets, which MediaViewer may normalize. The stamp given
+    to a synced write is unknown until it is read again, so a write made
+    before then always stands.
+
+    Rows are claimed for LEASE seconds while being synced so two workers
+    never send the same write. SQLite errors are logged and the store falls
+    back to calling MediaViewer directly.
+    """
+
+    LEASE = 300  # in secs
+    BATCH_SIZE = 50
+    LOOP_NAME = "offset-sync"
+
+    def __init__(
+        self,
+        path,
+        reader,
+        writer,
+        deleter,
+        sync_interval=OFFSET_SYNC_INTERVAL,
+        write_interval=OFFSET_WRITE_INTERVAL,
+        refresh_interval=OFFSET_REFRESH_INTERVAL,
+        retention=OFFSET_STORE_RETENTION,
+    ):
+        self.path = str(path)
+        self.reader = reader
+        self.writer = writer
+        self.deleter = deleter
+        self.sync_interval = sync_interval
+        self.write_interval = write_interval
+        self.refresh_interval = refresh_interval
+        self.retention = retention
+
+        self._connection = LocalConnection(
+            self.path, setup=self._createTable, row_factory=sqlite3.Row
+        )
+        self._lock = threading.Lock()
+        self._syncLock = threading.Lock()
+        self._initLoop()
+
+        self.accepted = 0
+        self.synced = 0
+        self.conflicts = 0
+        self.failed = 0
+
+    @classmethod
+    def _createTable(cls, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS offsets ("
+            "guid TEXT NOT NULL, "
+            "filename TEXT NOT NULL, "
+            "offset NUMERIC, "
+            "date_edited TEXT, "
+            "deleted INTEGER NOT NULL DEFAULT 0, "
+            "dirty INTEGER NOT NULL DEFAULT 0, "
+            "synced REAL NOT NULL DEFAULT 0, "
+            "claimed REAL NOT NULL DEFAULT 0, "
+            "written REAL NOT NULL DEFAULT 0, "
+            "upstream_edited TEXT, "
+            "PRIMARY KEY (guid, filename))"
+        )
+        cls._addMissingColumns(conn)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS offsets_dirty ON offsets (dirty, claimed)"
+        )
+
+    @staticmethod
+    def _addMissingColumns(conn):
+        # Databases created before these columns existed
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(offsets)")}
+        for column, kind in (
+            ("written", "REAL NOT NULL DEFAULT 0"),
+            ("upstream_edited", "TEXT"),
+        ):
+            if column in columns:
+                continue
+            try:
+                conn.execute(f"ALTER TABLE offsets ADD COLUMN {column} {kind}")
+            except sqlite3.OperationalError as e:
+                # Another worker added it first
+                if "duplicate column" not in str(e):
+                    raise
+
+    def _row(self, guid, filename):
+        return (
+            self._connection()
+            .execute(
+                "SELECT * FROM offsets WHERE guid = ? AND filename = ?",
+                (guid, filename),
+            )
+            .fetchone()
+        )
+
+    def _saveLocal(self, guid, filename, offset, deleted):
+        self._connection().execute(
+            "INSERT INTO offsets (guid, filename, offset, date_edited, deleted, dirty) "
+            "VALUES (?, ?, ?, ?, ?, 1) "
+            "ON CONFLICT (guid, filename) DO UPDATE SET "
+            "offset = excluded.offset, "
+            "date_edited = excluded.date_edited, "
+            "deleted = excluded.deleted, "
+            "dirty = 1, "
+            "claimed = 0",
+            (guid, filename, offset, _now(), int(deleted)),
+        )
+
+    def _saveUpstream(self, guid, filename, data):
+        # A read must never replace a write made while it was in flight
+        self._connection().execute(
+            "INSERT INTO offsets (guid, filename, offset, date_edited, synced, "
+            "upstream_edited) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (guid, filename) DO UPDATE SET "
+            "offset = excluded.offset, "
+            "date_edited = excluded.date_edited, "
+            "deleted = 0, "
+            "synced = excluded.synced, "
+            "upstream_edited = excluded.upstream_edited "
+            "WHERE offsets.dirty = 0",
+            (
+                guid,
+                filename,
+                data["offset"],
+                data.get("date_edited"),
+                time.time(),
+                data.get("date_edited"),
+            ),
+        )
+
+    def _saveWritten(self, row):
+        # Recorded even if the row was written again during the sync, so the
+        # newer write waits for the next window. MediaViewer's stamp for the
+        # write is unknown until it is read again.
+        self._connection().execute(
+            "UPDATE offsets SET written = ?, upstream_edited = NULL "
+            "WHERE guid = ? AND filename = ?",
+            (time.time(), row["guid"], row["filename"]),
+        )
+
+    @staticmethod
+    def _data(row):
+        if row["deleted"]:
+            return {"offset": 0, "date_edited": None}
+        return {"offset": row["offset"], "date_edited": row["date_edited"]}
+
+    def read(self, guid, filename):
+        try:
+            row = self._row(guid, filename)
+        except sqlite3.Error as e:
+            logger().error(e)
+            return self.reader(filename, guid)
+
+        if row is not None and (
+            # Nothing to check a local write against
+            (row["dirty"] and row["upstream_edited"] is None)
+            or time.time() - row["synced"] < self.refresh_interval
+        ):
+            return self._data(row)
+
+        try:
+            data = self.reader(filename, guid)
+        except Exception as e:
+            if row is not None and isUnavailable(e):
+                return self._data(row)
+            raise
+
+        try:
+            if row is not None and row["dirty"]:
+                return self._reconcile(row, data)
+            self._saveUpstream(guid, filename, data)
+        except sqlite3.Error as e:
+            logger().error(e)
+        return data
+
+    def _reconcile(self, row, current):
+        """Settle a local write that is not synced yet against MediaViewer's
+        copy current and return the winner"""
+        if not hasChanged(current, row["upstream_edited"]):
+            self._connection().execute(
+                "UPDATE offsets SET synced = ? WHERE guid = ? AND filename = ?",
+                (time.time(), row["guid"], row["filename"]),
+            )
+            return self._data(row)
+
+        if row["claimed"] >= time.time():
+            # Already being sent
+            return self._data(row)
+
+        with self._lock:
+            self.conflicts += 1
+        self._settle(
+            row,
+            "UPDATE offsets SET offset = ?, date_edited = ?, deleted = 0, "
+            "dirty = 0, synced = ?, upstream_edited = ?",
+            (
+                current["offset"],
+                current.get("date_edited"),
+                time.time(),
+                current.get("date_edited"),
+            ),
+        )
+        return current
+
+    def write(self, guid, filename, offset):
+        self._accept(guid, filename, offset, deleted=False)
+
+    def delete(self, guid, filename):
+        self._accept(guid, filename, None, deleted=True)
+
+    def _accept(self, guid, filename, offset, deleted):
+        self.ensureStarted()
+        try:
+            self._saveLocal(guid, filename, offset, deleted)
+        except sqlite3.Error as e:
+            logger().error(e)
+            if deleted:
+                self.deleter(filename, guid)
+            else:
+                self.writer(filename, guid, offset)
+            return
+
+        with self._lock:
+            self.accepted += 1
+
+    def _claim(self, flush=False):
+        now = time.time()
+        written = now if flush else now - self.write_interval
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT * FROM offsets WHERE dirty = 1 AND claimed < ? "
+                "AND written <= ? ORDER BY date_edited LIMIT ?",
+                (now, written, self.BATCH_SIZE),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE offsets SET claimed = ? WHERE guid = ? AND filename = ?",
+                [(now + self.LEASE, row["guid"], row["filename"]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _settle(self, row, sql, params=()):
+        """Apply sql to a claimed row unless it was written again since"""
+        self._connection().execute(
+            f"{sql} WHERE guid = ? AND filename = ? AND dirty = 1 AND date_edited IS ?",
+            (*params, row["guid"], row["filename"], row["date_edited"]),
+        )
+
+    def _syncRow(self, row):
+        guid, filename = row["guid"], row["filename"]
+        if row["deleted"]:
+            self.deleter(filename, guid)
+        else:
+            self.writer(filename, guid, row["offset"])
+        self._saveWritten(row)
+        # Deletes are kept until the retention runs out so repeated ones
+        # coalesce as well
+        self._settle(
+            row,
+            "UPDATE offsets SET dirty = 0, synced = ?, claimed = 0",
+            (time.time(),),
+        )
+
+    def sync(self, flush=False):
+        """Send dirty rows whose write_interval has passed to MediaViewer, or
+        all of them with flush, until none are left or it fails"""
+        with self._syncLock:
+            self._connection().execute(
+                "DELETE FROM offsets WHERE dirty = 0 AND synced < ?",
+                (time.time() - self.retention,),
+            )
+
+            while True:
+                rows = self._claim(flush=flush)
+                for row in rows:
+                    try:
+                        self._syncRow(row)
+                    except Exception as e:
+                        logger().error(e)
+                        with self._lock:
+                            self.failed += 1
+                        if isUnavailable(e):
+                            # Keep the rest for the next sync
+                            for unsynced in rows:
+                                self._settle(unsynced, "UPDATE offsets SET claimed = 0")
+                            return
+                        # MediaViewer refused the write, read its copy next time
+                        self._settle(
+                            row, "UPDATE offsets SET dirty = 0, synced = 0, claimed = 0"
+                        )
+                        continue
+
+                    with self._lock:
+                        self.synced += 1
+
+                if len(rows) < self.BATCH_SIZE:
+                    return
+
+    def _loopInterval(self):
+        return self.sync_interval
+
+    def _loopTick(self):
+        self.sync()
+
+    def _loopFinish(self):
+        # Send everything still pending, however recent
+        try:
+            self.sync(flush=True)
+        except Exception as e:
+            logger().error(e, exc_info=True)
+
+    def pending(self):
+        """Return the number of unsynced rows and the age of the oldest"""
+        row = (
+            self._connection()
+            .execute(
+                "SELECT COUNT(*) AS count, MIN(date_edited) AS oldest "
+                "FROM offsets WHERE dirty = 1"
+            )
+            .fetchone()
+        )
+        oldest = _parseDate(row["oldest"])
+        if oldest is None:
+            return row["count"], 0
+        return row["count"], (datetime.now(timezone.utc) - oldest).total_seconds()
+
+    def clear(self):
+        self._connection().execute("DELETE FROM offsets")
+
+    def stats(self):
+        try:
+            pending, oldest = self.pending()
+        except sqlite3.Error as e:
+            logger().error(e)
+            pending, oldest = None, None
+        return {
+            "pending": pending,
+            "oldest_pending": oldest,
+            "accepted": self.accepted,
+            "synced": self.synced,
+            "conflicts": self.conflicts,
+            "failed": self.failed,
+            "sync_interval": self.sync_interval,
+            "write_interval": self.write_interval,
+        }
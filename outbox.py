@@ -0,0 +1,215 @@
+import time
+import sqlite3
+import threading
+
+from log import logger
+from background import BackgroundLoop
+from database import LocalConnection
+from upstream import RetryPolicy, isUnavailable
+from settings import (
+    OUTBOX_SEND_INTERVAL,
+    OUTBOX_BATCH_SIZE,
+    OUTBOX_RETRY_BASE,
+    OUTBOX_RETRY_MAX,
+    OUTBOX_MAX_ATTEMPTS,
+)
+
+
+class ViewedOutbox(BackgroundLoop):
+    """Persistent queue of "viewed" notifications for MediaViewer.
+
+    Notifications are appended to a SQLite table (WAL mode, shared by every
+    worker on the host) and acknowledged immediately. A daemon thread in each
+    worker delivers them every send_interval seconds, up to batch_size at a
+    time over the pooled upstream connection.
+
+    There is at most one queued notification per GUID since marking a GUID
+    viewed twice means the same thing. Deliveries that fail because
+    MediaViewer is unavailable are retried with jittered exponential backoff
+    up to max_attempts. Notifications MediaViewer rejects are dropped.
+    """
+
+    LEASE = 300  # in secs
+    LOOP_NAME = "viewed-outbox"
+
+    def __init__(
+        self,
+        path,
+        sender,
+        send_interval=OUTBOX_SEND_INTERVAL,
+        batch_size=OUTBOX_BATCH_SIZE,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        retry=None,
+    ):
+        self.path = str(path)
+        self.sender = sender
+        self.send_interval = send_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry = (
+            RetryPolicy(base=OUTBOX_RETRY_BASE, max_delay=OUTBOX_RETRY_MAX)
+            if retry is None
+            else retry
+        )
+
+        self._connection = LocalConnection(
+            self.path, setup=self._createTable, row_factory=sqlite3.Row
+        )
+        self._lock = threading.Lock()
+        self._sendLock = threading.Lock()
+        self._initLoop()
+
+        self.queued = 0
+        self.delivered = 0
+        self.retried = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _createTable(conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS viewed_outbox ("
+            "guid TEXT PRIMARY KEY, "
+            "created REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL DEFAULT 0, "
+            "claimed REAL NOT NULL DEFAULT 0, "
+            "last_error TEXT)"
+        )
+
+    def add(self, guid):
+        """Queue guid to be marked viewed. Returns False if the outbox could
+        not be written and the caller has to deliver it itself."""
+        self.ensureStarted()
+        try:
+            self._connection().execute(
+                "INSERT INTO viewed_outbox (guid, created) VALUES (?, ?) "
+                "ON CONFLICT (guid) DO NOTHING",
+                (guid, time.time()),
+            )
+        except sqlite3.Error as e:
+            logger().error(e)
+            return False
+
+        with self._lock:
+            self.queued += 1
+        return True
+
+    def _claim(self):
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT * FROM viewed_outbox "
+                "WHERE next_attempt <= ? AND claimed < ? "
+                "ORDER BY created LIMIT ?",
+                (now, now, self.batch_size),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE viewed_outbox SET claimed = ? WHERE guid = ?",
+                [(now + self.LEASE, row["guid"]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _remove(self, guid):
+        self._connection().execute("DELETE FROM viewed_outbox WHERE guid = ?", (guid,))
+
+    def _reschedule(self, row, error):
+        attempts = row["attempts"] + 1
+        if attempts >= self.max_attempts:
+            logger().error(
+                "Giving up marking GUID %s viewed after %s attempts: %s",
+                row["guid"],
+                attempts,
+                error,
+            )
+            with self._lock:
+                self.dropped += 1
+            self._remove(row["guid"])
+            return
+
+        with self._lock:
+            self.retried += 1
+        self._connection().execute(
+            "UPDATE viewed_outbox SET attempts = ?, next_attempt = ?, claimed = 0, "
+            "last_error = ? WHERE guid = ?",
+            (
+                attempts,
+                time.time() + self.retry.backoff(attempts),
+                str(error),
+                row["guid"],
+            ),
+        )
+
+    def _release(self, rows):
+        self._connection().executemany(
+            "UPDATE viewed_outbox SET claimed = 0 WHERE guid = ?",
+            [(row["guid"],) for row in rows],
+        )
+
+    def send(self):
+        """Deliver every notification that is due"""
+        with self._sendLock:
+            while True:
+                rows = self._claim()
+                for i, row in enumerate(rows):
+                    try:
+                        self.sender(row["guid"])
+                    except Exception as e:
+                        logger().error(e)
+                        if not isUnavailable(e):
+                            with self._lock:
+                                self.dropped += 1
+                            self._remove(row["guid"])
+                            continue
+
+                        self._reschedule(row, e)
+                        # Leave the rest of the batch for the next round
+                        self._release(rows[i + 1 :])
+                        return
+
+                    self._remove(row["guid"])
+                    with self._lock:
+                        self.delivered += 1
+
+                if len(rows) < self.batch_size:
+                    return
+
+    def _loopInterval(self):
+        return self.send_interval
+
+    def _loopTick(self):
+        self.send()
+
+    def depth(self):
+        """Return the number of queued notifications and the age in seconds of
+        the oldest one"""
+        row = (
+            self._connection()
+            .execute(
+                "SELECT COUNT(*) AS count, MIN(created) AS oldest FROM viewed_outbox"
+            )
+            .fetchone()
+        )
+        if row["oldest"] is None:
+            return row["count"], 0
+        return row["count"], max(time.time() - row["oldest"], 0)
+
+    def stats(self):
+        try:
+            depth, oldest = self.depth()
+        except sqlite3.Error as e:
+            logger().error(e)
+            depth, oldest = None, None
+        return {
+            "depth": depth,
+            "oldest": oldest,
+            "queued": self.queued,
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,333 @@
+import os
+import secrets
+import mimetypes
+
+from collections import namedtuple
+from datetime import datetime, timezone
+from flask import Response
+from werkzeug.datastructures import EnvironHeaders
+from werkzeug.http import http_date, parse_date
+
+BLOCK_SIZE = 256 * 1024
+
+# More ranges than this in one request are ignored and the whole file is sent
+MAX_RANGES = 16
+
+# A response body is a sequence of parts: bytes written as-is followed by the
+# file's bytes from start to end inclusive (none when end < start).
+Part = namedtuple("Part", "prefix,start,end")
+Plan = namedtuple("Plan", "status,headers,parts,length")
+
+
+def fileETag(stat):
+    """Strong ETag fingerprinting a file by inode, size and mtime"""
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def nginxETag(stat):
+    """The ETag nginx gives a static file, from its mtime in seconds and its
+    size, for files nginx sends on waiter's behalf"""
+    return f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+
+
+def parseRanges(header, size):
+    """Return the byte ranges requested by a Range header as a list of
+    (start, end) tuples, None when the whole file should be sent, or raise
+    ValueError when none of the ranges can be satisfied.
+
+    Malformed headers are ignored as RFC 7233 requires. Overlapping and
+    adjacent ranges are merged.
+    """
+    if not header:
+        return None
+
+    unit, _, spec = header.partition("=")
+    specs = spec.split(",")
+    if unit.strip().lower() != "bytes" or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for byte_range in specs:
+        first, sep, last = (x.strip() for x in byte_range.partition("-"))
+        if (
+            not sep
+            or not (first or last)
+            or (first and not first.isdigit())
+            or (last and not last.isdigit())
+        ):
+            return None
+
+        if not first:
+            # Suffix range, the last N bytes
+            if int(last) and size:
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            end = int(last) if last else size - 1
+            ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise ValueError(header)
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _etagMatches(header, etag, strong=False):
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            if strong:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _notModified(headers, etag, last_modified):
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match:
+        # If-Modified-Since is ignored whenever If-None-Match is sent
+        return _etagMatches(if_none_match, etag)
+
+    since = parse_date(headers.get("If-Modified-Since"))
+    return since is not None and last_modified <= since
+
+
+def _rangeApplies(headers, etag, last_modified):
+    if_range = headers.get("If-Range")
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return _etagMatches(if_range, etag, strong=True)
+    return parse_date(if_range) == last_modified
+
+
+def planResponse(stat, headers, method="GET", mimetype=None, layout=None, etag=None):
+    """Decide how to answer a request for a file.
+
+    headers are the request headers (anything with a case-insensitive
+    get()). Returns a Plan with the status, the response headers and the
+    body parts. Handles If-None-Match and If-Modified-Since (304), If-Range,
+    single and multiple byte ranges (206, multipart/byteranges) and
+    unsatisfiable ranges (416).
+
+    A layout (see mp4.FastStartLayout) serves a virtual rearrangement of the
+    file of the same size. Ranges address the virtual file and the parts
+    returned are translated back to the real one.
+
+    etag replaces the file's own ETag, e.g. with nginxETag when nginx sends
+    the body.
+    """
+    mimetype = mimetype or "application/octet-stream"
+    size = stat.st_size
+    if etag is None:
+        etag = fileETag(stat) if layout is None else layout.etag
+    # HTTP dates only have second precision
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+
+    response_headers = {"ETag": etag, "Last-Modified": http_date(last_modified)}
+
+    if method in ("GET", "HEAD") and _notModified(headers, etag, last_modified):
+        return Plan(304, response_headers, [], 0)
+
+    ranges = None
+    if method == "GET" and _rangeApplies(headers, etag, last_modified):
+        try:
+            ranges = parseRanges(headers.get("Range"), size)
+        except ValueError:
+            response_headers["Content-Range"] = f"bytes */{size}"
+            response_headers["Content-Length"] = "0"
+            return Plan(416, response_headers, [], 0)
+
+    if ranges is None:
+        status = 200
+        parts = [Part(b"", 0, size - 1)]
+        response_headers["Content-Type"] = mimetype
+    elif len(ranges) == 1:
+        status = 206
+        start, end = ranges[0]
+        parts = [Part(b"", start, end)]
+        response_headers["Content-Type"] = mimetype
+        response_headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    else:
+        status = 206
+        boundary = secrets.token_hex(16)
+        parts = []
+        for start, end in ranges:
+            delimiter = "\r\n" if parts else ""
+            prefix = (
+                f"{delimiter}--{boundary}\r\n"
+                f"Content-Type: {mimetype}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            )
+            parts.append(Part(prefix.encode("latin-1"), start, end))
+        parts.append(Part(f"\r\n--{boundary}--\r\n".encode("latin-1"), 0, -1))
+        response_headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+
+    length = sum(len(part.prefix) + max(part.end - part.start + 1, 0) for part in parts)
+    response_headers["Content-Length"] = str(length)
+    if layout is not None:
+        parts = layout.mapParts(parts)
+    return Plan(status, response_headers, parts, length)
+
+
+class FileParts:
+    """Iterate over the body parts of a Plan, reading the file in blocks.
+
+    sent counts the bytes the server has written, i.e. every block it asked
+    for the next one after, and is passed to onClose when it closes the body.
+    """
+
+    def __init__(self, fp, parts, block_size=BLOCK_SIZE, onClose=None):
+        self.fp = fp
+        self.parts = parts
+        self.block_size = block_size
+        self.onClose = onClose
+        self.sent = 0
+
+    def __iter__(self):
+        for part in self.parts:
+            if part.prefix:
+                yield part.prefix
+                self.sent += len(part.prefix)
+            if part.end < part.start:
+                continue
+
+            self.fp.seek(part.start)
+            remaining = part.end - part.start + 1
+            while remaining > 0:
+                data = self.fp.read(min(self.block_size, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+                self.sent += len(data)
+
+    def close(self):
+        self.fp.close()
+        _reportSent(self)
+
+
+class SentFile:
+    """File handed to wsgi.file_wrapper that keeps track of how much of it was
+    sent, which is passed to onClose when the server closes it.
+
+    Servers either read() it or give it to socket.sendfile, which seeks it
+    past the bytes it sent, also when the client goes away mid-transfer.
+    """
+
+    def __init__(self, fp, onClose=None):
+        self.fp = fp
+        self.onClose = onClose
+        self.start = self.position = fp.tell()
+
+    @property
+    def sent(self):
+        return max(self.position - self.start, 0)
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.position = self.fp.seek(offset, whence)
+        return self.position
+
+    def tell(self):
+        return self.fp.tell()
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.fp.close()
+        _reportSent(self)
+
+
+def _reportSent(body):
+    # Servers may close a body more than once
+    onClose, body.onClose = body.onClose, None
+    if onClose is not None:
+        onClose(body.sent)
+
+
+def _canWrapFile(environ, parts, size):
+    # Only a single stretch of the file can go through wsgi.file_wrapper.
+    # gunicorn sends it with sendfile(2) and stops at the Content-Length.
+    # Other servers may stream it to EOF, so they only get it when the range
+    # runs to the end of the file anyway.
+    if "wsgi.file_wrapper" not in environ or len(parts) != 1 or parts[0].prefix:
+        return False
+    if environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):
+        return True
+    return parts[0].end == size - 1
+
+
+def guessMimetype(path):
+    return mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+
+
+def rangeResponse(path, environ, mimetype=None, layout=None, onClose=None):
+    """Serve path according to planResponse.
+
+    A single stretch of the file is handed to the server's wsgi.file_wrapper
+    whenever it is safe to, letting gunicorn transfer it with sendfile(2)
+    without copying it through Python. Otherwise it is read in BLOCK_SIZE
+    chunks.
+
+    onClose is called with the number of body bytes sent once the server is
+    done with the response.
+    """
+    path = str(path)
+    stat = os.stat(path)
+    plan = planResponse(
+        stat,
+        EnvironHeaders(environ),
+        method=environ.get("REQUEST_METHOD", "GET"),
+        mimetype=mimetype or guessMimetype(path),
+        layout=layout,
+    )
+
+    if plan.status in (304, 416):
+        headers = dict(plan.headers)
+        headers.pop("Content-Length", None)
+        return Response(status=plan.status, headers=headers)
+
+    fp = open(path, "rb")
+    try:
+        fp.seek(plan.parts[0].start)
+    except OSError:
+        fp.close()
+        raise
+
+    if _canWrapFile(environ, plan.parts, stat.st_size):
+        body = environ["wsgi.file_wrapper"](SentFile(fp, onClose), BLOCK_SIZE)
+    else:
+        body = FileParts(fp, plan.parts, onClose=onClose)
+
+    headers = dict(plan.headers)
+    content_type = headers.pop("Content-Type")
+    response = Response(
+        body,
+        status=plan.status,
+        headers=headers,
+        content_type=content_type,
+        direct_passthrough=True,
+    )
+    response.content_length = plan.length
+    return response
@@ -61,6 +61,13 @@ LOG_PATH = (
     else Path("/path/to/log/folder")
 )
 LOG_FILE_NAME = "waiterLog"
+LOG_LEVEL = os.getenv("MW_LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+# Records waiting to be written. Any more are dropped instead of blocking.
+LOG_QUEUE_SIZE = int(os.getenv("MW_LOG_QUEUE_SIZE", 10000))
+# Unix socket of the single process writing the log file. gunicorn.conf.py
+# sets it so every worker logs through the master. Unset, each process
+# writes the log file itself.
+LOG_SOCKET = Path(os.getenv("MW_LOG_SOCKET")) if os.getenv("MW_LOG_SOCKET") else None
 
 EXTERNAL_MEDIAVIEWER_BASE_URL = os.getenv(
     "MW_EXTERNAL_MEDIAVIEWER_BASE_URL", "http://localhost:8000/mediaviewer"
@@ -89,6 +96,160 @@ MEDIAWAITER_PROTOCOL = os.getenv("MW_MEDIAWAITER_PROTOCOL", "https://")
 
 REQUESTS_TIMEOUT = 3  # in secs
 
+# Keep-alive connection pool used for MediaViewer requests
+UPSTREAM_POOL_CONNECTIONS = int(os.getenv("MW_UPSTREAM_POOL_CONNECTIONS", 4))
+UPSTREAM_POOL_MAXSIZE = int(os.getenv("MW_UPSTREAM_POOL_MAXSIZE", 16))
+
+# Token, genre and collection lookups for a page run concurrently on a small
+# thread pool and must all finish within PAGE_LOOKUP_TIMEOUT.
+LOOKUP_POOL_SIZE = int(os.getenv("MW_LOOKUP_POOL_SIZE", 8))
+PAGE_LOOKUP_TIMEOUT = float(
+    os.getenv("MW_PAGE_LOOKUP_TIMEOUT", 2 * REQUESTS_TIMEOUT)
+)  # in secs
+
+# Every MediaViewer call made while serving one request shares this budget.
+# Timeouts are shortened and retries stop once it is spent, keeping workers
+# well clear of gunicorn's timeout.
+UPSTREAM_REQUEST_BUDGET = float(os.getenv("MW_UPSTREAM_REQUEST_BUDGET", 10))  # in secs
+
+# Transient upstream failures are retried with capped exponential backoff
+# and full jitter
+RETRY_ATTEMPTS = int(os.getenv("MW_RETRY_ATTEMPTS", 4))
+RETRY_BACKOFF_BASE = float(os.getenv("MW_RETRY_BACKOFF_BASE", 0.25))  # in secs
+RETRY_BACKOFF_MAX = float(os.getenv("MW_RETRY_BACKOFF_MAX", 2))  # in secs
+
+# After UPSTREAM_BREAKER_THRESHOLD consecutive failures, calls to MediaViewer
+# fail fast for UPSTREAM_BREAKER_RESET seconds before a single probe is let
+# through to test whether it has recovered.
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv("MW_UPSTREAM_BREAKER_THRESHOLD", 5))
+UPSTREAM_BREAKER_RESET = float(os.getenv("MW_UPSTREAM_BREAKER_RESET", 30))  # in secs
+
+# Playback offsets are kept in a local SQLite database shared by all workers
+# and synced to MediaViewer in the background, which looks for pending writes
+# every OFFSET_SYNC_INTERVAL seconds. An offset is written to MediaViewer at
+# most once every OFFSET_WRITE_INTERVAL seconds and only its latest value is
+# sent, so this should be well above the 15 secs between the player's POSTs.
+# Synced offsets are re-read from MediaViewer once they are older than
+# OFFSET_REFRESH_INTERVAL and dropped after OFFSET_STORE_RETENTION.
+OFFSET_STORE_PATH = (
+    Path(os.getenv("MW_OFFSET_STORE_PATH"))
+    if os.getenv("MW_OFFSET_STORE_PATH")
+    else REPO_DIR / "offsets.db"
+)
+OFFSET_SYNC_INTERVAL = float(os.getenv("MW_OFFSET_SYNC_INTERVAL", 5))  # in secs
+OFFSET_WRITE_INTERVAL = float(os.getenv("MW_OFFSET_WRITE_INTERVAL", 60))  # in secs
+OFFSET_REFRESH_INTERVAL = int(os.getenv("MW_OFFSET_REFRESH_INTERVAL", 30))  # in secs
+OFFSET_STORE_RETENTION = int(
+    os.getenv("MW_OFFSET_STORE_RETENTION", 7 * 24 * 60 * 60)
+)  # in secs
+
+# "Viewed" notifications are queued in a local SQLite outbox and delivered to
+# MediaViewer in the background. Failed deliveries are retried with backoff
+# between OUTBOX_RETRY_BASE and OUTBOX_RETRY_MAX seconds.
+OUTBOX_PATH = (
+    Path(os.getenv("MW_OUTBOX_PATH"))
+    if os.getenv("MW_OUTBOX_PATH")
+    else REPO_DIR / "outbox.db"
+)
+OUTBOX_SEND_INTERVAL = float(os.getenv("MW_OUTBOX_SEND_INTERVAL", 2))  # in secs
+OUTBOX_BATCH_SIZE = int(os.getenv("MW_OUTBOX_BATCH_SIZE", 50))
+OUTBOX_RETRY_BASE = float(os.getenv("MW_OUTBOX_RETRY_BASE", 5))  # in secs
+OUTBOX_RETRY_MAX = float(os.getenv("MW_OUTBOX_RETRY_MAX", 600))  # in secs
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("MW_OUTBOX_MAX_ATTEMPTS", 50))
+
+# MP4 files whose moov box comes after their media data are served with it
+# moved to the front, so players can start without first fetching the end of
+# the file. Relocated moov boxes up to FASTSTART_MAX_MOOV bytes are cached, up
+# to FASTSTART_CACHE_SIZE files and FASTSTART_CACHE_BYTES in every worker.
+# Only applies when waiter serves files itself, not through nginx.
+FASTSTART_MP4 = strtobool(os.getenv("MW_FASTSTART_MP4", "true").lower())
+FASTSTART_MAX_MOOV = int(os.getenv("MW_FASTSTART_MAX_MOOV", 32 * 1024 * 1024))
+FASTSTART_CACHE_SIZE = int(os.getenv("MW_FASTSTART_CACHE_SIZE", 32))
+FASTSTART_CACHE_BYTES = int(os.getenv("MW_FASTSTART_CACHE_BYTES", 64 * 1024 * 1024))
+FASTSTART_CACHE_TTL = int(os.getenv("MW_FASTSTART_CACHE_TTL", 3600))  # in secs
+
+# Each worker writes its metrics to a file in METRICS_DIR every
+# METRICS_FLUSH_INTERVAL seconds so /waiter/metrics reports the whole host.
+# gunicorn.conf.py sets it. Unset, metrics only cover the current process.
+METRICS_DIR = Path(os.getenv("MW_METRICS_DIR")) if os.getenv("MW_METRICS_DIR") else None
+METRICS_FLUSH_INTERVAL = float(os.getenv("MW_METRICS_FLUSH_INTERVAL", 5))  # in secs
+
+# Time spent on the token, directory listing, navigation lookups and template
+# rendering is reported in a Server-Timing header on every response. With
+# SERVER_TIMING_LOG the same breakdown is logged as a JSON line per request.
+SERVER_TIMING = strtobool(os.getenv("MW_SERVER_TIMING", "true").lower())
+SERVER_TIMING_LOG = strtobool(os.getenv("MW_SERVER_TIMING_LOG", "false").lower())
+
+# Threads used by the ASGI entry point (asgi.py) for blocking work, per
+# worker. Downloads only use a thread to open and read each chunk of the file,
+# so a worker streams to far more players than it has threads. Pages and
+# every other route hold a thread for the whole request, including the
+# MediaViewer calls behind it, so a worker serves at most ASGI_THREADS of
+# them at once. One or two workers per CPU with the default 32 threads each
+# suit most hosts. Raise the threads when pages queue behind slow MediaViewer
+# calls, and the workers when the CPUs are busy. The upstream connection pool
+# (UPSTREAM_POOL_MAXSIZE) should allow about as many connections as threads.
+ASGI_THREADS = int(os.getenv("MW_ASGI_THREADS", 32))
+
+# Download tokens are cached per worker to avoid a MediaViewer round-trip on
+# every request. Invalid or expired tokens are cached for a shorter period.
+TOKEN_CACHE_TTL = int(os.getenv("MW_TOKEN_CACHE_TTL", 30))  # in secs
+TOKEN_CACHE_NEGATIVE_TTL = int(os.getenv("MW_TOKEN_CACHE_NEGATIVE_TTL", 5))  # in secs
+TOKEN_CACHE_SIZE = int(os.getenv("MW_TOKEN_CACHE_SIZE", 1024))
+
+# The last good copy of each token is kept this long and served when
+# MediaViewer cannot be reached
+TOKEN_STALE_MAX_AGE = int(os.getenv("MW_TOKEN_STALE_MAX_AGE", 3600))  # in secs
+
+# Rendered listing and player pages are cached by an ETag computed from the
+# token, the directory listing and the navigation data, so unchanged pages are
+# answered with a 304 or the cached HTML instead of being rendered again.
+PAGE_CACHE = strtobool(os.getenv("MW_PAGE_CACHE", "true").lower())
+PAGE_CACHE_SIZE = int(os.getenv("MW_PAGE_CACHE_SIZE", 256))
+PAGE_CACHE_TTL = int(os.getenv("MW_PAGE_CACHE_TTL", 300))  # in secs
+
+# Genre and collection lists shown in the navigation bar. Entries older than
+# NAVIGATION_CACHE_TTL are served stale while being refreshed in the
+# background, and are kept for NAVIGATION_CACHE_MAX_AGE so the last good value
+# survives MediaViewer errors.
+NAVIGATION_CACHE_TTL = int(os.getenv("MW_NAVIGATION_CACHE_TTL", 60))  # in secs
+NAVIGATION_CACHE_MAX_AGE = int(
+    os.getenv("MW_NAVIGATION_CACHE_MAX_AGE", 24 * 60 * 60)
+)  # in secs
+NAVIGATION_CACHE_SIZE = int(os.getenv("MW_NAVIGATION_CACHE_SIZE", 1024))
+
+# Media directory listings are reused until the mtime of a directory they were
+# built from changes, and are rebuilt at least every LISTING_CACHE_MAX_AGE.
+# Files under MINIMUM_FILE_SIZE are re-stat-ed on every use so they appear once
+# copied in, but a listed file that keeps growing in place shows the size it
+# had when listed for up to LISTING_CACHE_MAX_AGE.
+LISTING_CACHE_SIZE = int(os.getenv("MW_LISTING_CACHE_SIZE", 256))
+LISTING_CACHE_MAX_AGE = int(os.getenv("MW_LISTING_CACHE_MAX_AGE", 300))  # in secs
+
+# Watch the media directories for changes (inotify, falling back to polling
+# every MEDIA_WATCH_POLL_INTERVAL) instead of checking mtimes per request.
+# Every worker watches every directory in every media tree, subdirectories
+# included, so fs.inotify.max_user_watches has to allow workers times the
+# total number of directories under the media roots.
+WATCH_MEDIA_DIRS = strtobool(os.getenv("MW_WATCH_MEDIA_DIRS", "false").lower())
+MEDIA_WATCH_POLL_INTERVAL = int(
+    os.getenv("MW_MEDIA_WATCH_POLL_INTERVAL", 10)
+)  # in secs
+
+# SQLite database shared by all gunicorn workers on a host. Token and
+# navigation lookups made by one worker are then visible to the others.
+# Leave unset to keep caches per worker.
+SHARED_CACHE_PATH = (
+    Path(os.getenv("MW_SHARED_CACHE_PATH"))
+    if os.getenv("MW_SHARED_CACHE_PATH")
+    else None
+)
+# Workers look for keys invalidated by other workers at most this often, and
+# may serve their own copy of an invalidated entry until then.
+SHARED_CACHE_CHECK_INTERVAL = float(
+    os.getenv("MW_SHARED_CACHE_CHECK_INTERVAL", 1)
+)  # in secs
+
 DEFAULT_THEME = "dark"
 
 JITSI_JWT_APP_ID = os.environ.get("JITSI_JWT_APP_ID", "")
@@ -23,7 +23,64 @@ def temp_directory(tmp_path, counter):
         shutil.rmtree(dir)
 
 
+@pytest.fixture
+def request_context():
+    from waiter import app
+
+    with app.test_request_context():
+        yield
+
+
 @pytest.fixture(autouse=True)
 def patch_logger(mocker):
     mocker.patch("utils.logger")
     mocker.patch("waiter.logger")
+    mocker.patch("cache.logger")
+    mocker.patch("watcher.logger")
+    mocker.patch("upstream.logger")
+    mocker.patch("offsets.logger")
+    mocker.patch("outbox.logger")
+    mocker.patch("mp4.logger")
+    mocker.patch("metrics.logger")
+    mocker.patch("timing.logger")
+    mocker.patch("background.logger")
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    from waiter import tokenCache, staleTokenCache, listingCache
+    from utils import navigationCache
+    from mp4 import layoutCache
+
+    tokenCache.clear()
+    staleTokenCache.clear()
+    navigationCache.clear()
+    listingCache.clear()
+    layoutCache.clear()
+
+
+@pytest.fixture(autouse=True)
+def offset_store(mocker, tmp_path):
+    import waiter
+    from offsets import OffsetStore
+
+    store = OffsetStore(
+        tmp_path / "offsets.db",
+        reader=waiter.offsetStore.reader,
+        writer=waiter.offsetStore.writer,
+        deleter=waiter.offsetStore.deleter,
+    )
+    mocker.patch("waiter.offsetStore", store)
+    yield store
+    store.stop()
+
+
+@pytest.fixture(autouse=True)
+def viewed_outbox(mocker, tmp_path):
+    import waiter
+    from outbox import ViewedOutbox
+
+    outbox = ViewedOutbox(tmp_path / "outbox.db", sender=waiter.sendViewed)
+    mocker.patch("waiter.viewedOutbox", outbox)
+    yield outbox
+    outbox.stop()
@@ -0,0 +1,218 @@
+import asyncio
+import pytest
+from pathlib import Path
+from asgi import WaiterASGI, buildEnviron
+from waiter import app as flask_app
+from timing import currentTimings
+
+
+def call(asgi_app, method, path, headers=(), body=b""):
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 1234),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+
+    start = sent[0]
+    assert start["type"] == "http.response.start"
+    assert sent[-1].get("more_body", False) is False
+    headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return start["status"], headers, body
+
+
+class TestBuildEnviron:
+    def test_headers(self):
+        scope = {
+            "method": "POST",
+            "path": "/waiter/viewed/guid/",
+            "headers": [
+                (b"content-type", b"application/x-www-form-urlencoded"),
+                (b"x-forwarded-for", b"1.2.3.4"),
+                (b"accept", b"a"),
+                (b"accept", b"b"),
+            ],
+        }
+
+        environ = buildEnviron(scope, b"viewed=true")
+
+        assert environ["REQUEST_METHOD"] == "POST"
+        assert environ["PATH_INFO"] == "/waiter/viewed/guid/"
+        assert environ["CONTENT_TYPE"] == "application/x-www-form-urlencoded"
+        assert environ["HTTP_X_FORWARDED_FOR"] == "1.2.3.4"
+        assert environ["HTTP_ACCEPT"] == "a,b"
+        assert environ["wsgi.input"].read() == b"viewed=true"
+
+
+class TestWaiterASGI:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.dir = temp_directory
+        mocker.patch("asgi.USE_NGINX", False)
+        mocker.patch("waiter.USE_NGINX", False)
+        mocker.patch("waiter.BASE_PATH", str(self.dir))
+        mocker.patch("waiter.MEDIA_DIRS", [])
+
+        self.file = self.dir / "movie.mp4"
+        self.file.write_bytes(bytes(range(256)) * 4)
+
+        self.mock_getTokenByGUID = mocker.patch("waiter.getTokenByGUID")
+        self.mock_getTokenByGUID.return_value = {"isvalid": True}
+        self.mock_getFileEntryFromHash = mocker.patch("waiter._getFileEntryFromHash")
+        self.mock_getFileEntryFromHash.return_value = {
+            "unhashedPath": Path(self.file),
+            "rawSize": 1024,
+        }
+
+        self.app = WaiterASGI(flask_app, threads=4)
+        self.client = flask_app.test_client()
+
+    def test_status_matches_flask(self):
+        status, headers, body = call(self.app, "GET", "/waiter/status/")
+        expected = self.client.get("/waiter/status/")
+
+        assert status == expected.status_code == 200
+        assert body == expected.data
+        assert headers["content-type"] == expected.headers["Content-Type"]
+
+    def test_download_range(self):
+        status, headers, body = call(
+            self.app,
+            "GET",
+            "/waiter/file/guid/hash",
+            headers=[("Range", "bytes=10-19")],
+        )
+
+        assert status == 206
+        assert body == self.file.read_bytes()[10:20]
+        assert headers["content-range"] == "bytes 10-19/1024"
+        assert headers["content-length"] == "10"
+        assert headers["content-type"] == "video/mp4"
+        assert headers["x-frame-options"] == "SAMEORIGIN"
+
+    def test_server_timing(self):
+        def getTokenByGUID(guid):
+            # Runs on the thread pool
+            currentTimings().record("token", 0.002)
+            return {"isvalid": True}
+
+        self.mock_getTokenByGUID.side_effect = getTokenByGUID
+
+        status, headers, body = call(self.app, "GET", "/waiter/file/guid/hash")
+
+        assert status == 200
+        assert headers["server-timing"].startswith("token;dur=2.0, ")
+        assert ", total;dur=" in headers["server-timing"]
+        assert currentTimings() is None
+
+    def test_download_matches_flask(self):
+        for range_header in ("bytes=0-", "bytes=-100", "bytes=1000-2000"):
+            status, headers, body = call(
+                self.app,
+                "GET",
+                "/waiter/file/guid/hash",
+                headers=[("Range", range_header)],
+            )
+            expected = self.client.get(
+                "/waiter/file/guid/hash", headers={"Range": range_header}
+            )
+
+            assert status == expected.status_code
+            assert body == expected.data
+            assert headers["content-range"] == expected.headers["Content-Range"]
+
+    def test_download_whole_file(self):
+        status, headers, body = call(self.app, "GET", "/waiter/file/guid/hash")
+
+        assert status == 200
+        assert body == self.file.read_bytes()
+
+    def test_download_unsatisfiable(self):
+        status, headers, body = call(
+            self.app,
+            "GET",
+            "/waiter/file/guid/hash",
+            headers=[("Range", "bytes=5000-")],
+        )
+
+        assert status == 416
+        assert headers["content-range"] == "bytes */1024"
+
+    def test_download_multiple_ranges_matches_flask(self):
+        status, headers, body = call(
+            self.app,
+            "GET",
+            "/waiter/file/guid/hash",
+            headers=[("Range", "bytes=0-9,100-109")],
+        )
+        expected = self.client.get(
+            "/waiter/file/guid/hash", headers={"Range": "bytes=0-9,100-109"}
+        )
+        boundary = headers["content-type"].split("boundary=")[1]
+        expected_boundary = expected.mimetype_params["boundary"]
+
+        assert status == expected.status_code == 206
+        assert headers["content-length"] == str(len(body))
+        assert body == expected.data.replace(
+            expected_boundary.encode(), boundary.encode()
+        )
+
+    def test_download_not_modified(self):
+        status, headers, body = call(self.app, "GET", "/waiter/file/guid/hash")
+
+        status, headers, body = call(
+            self.app,
+            "GET",
+            "/waiter/file/guid/hash",
+            headers=[("If-None-Match", headers["etag"])],
+        )
+
+        assert status == 304
+        assert body == b""
+
+    def test_head(self):
+        status, headers, body = call(self.app, "HEAD", "/waiter/file/guid/hash")
+
+        assert status == 200
+        assert headers["content-length"] == "1024"
+        assert body == b""
+
+    def test_invalid_download_uses_flask_error_page(self, mocker):
+        mocker.patch("waiter.render_template", return_value="error page")
+        self.mock_getFileEntryFromHash.side_effect = Exception("Unable to find")
+
+        status, headers, body = call(self.app, "GET", "/waiter/file/guid/hash")
+
+        assert status == 400
+        assert body == b"error page"
+
+    def test_lifespan(self):
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        asyncio.run(self.app({"type": "lifespan"}, receive, send))
+
+        assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
@@ -0,0 +1,82 @@
+import os
+import pytest
+import threading
+from background import BackgroundLoop
+
+
+class Ticker(BackgroundLoop):
+    LOOP_NAME = "ticker"
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.ticks = 0
+        self.ticked = threading.Event()
+        self._initLoop()
+
+    def _loopInterval(self):
+        return self.interval
+
+    def _loopTick(self):
+        self.ticks += 1
+        self.ticked.set()
+
+
+class TestBackgroundLoop:
+    @pytest.fixture(autouse=True)
+    def setUp(self, patch_logger):
+        self.loop = Ticker()
+
+    def test_starts_once_per_process(self):
+        self.loop.ensureStarted()
+        thread = self.loop._thread
+        self.loop.ensureStarted()
+
+        assert self.loop._thread is thread
+        assert thread.name == "ticker"
+        assert thread.daemon
+        self.loop.stop()
+
+    def test_restarts_after_fork(self):
+        self.loop.ensureStarted()
+        thread = self.loop._thread
+        self.loop._pid = os.getpid() + 1
+
+        self.loop.ensureStarted()
+
+        assert self.loop._thread is not thread
+        self.loop.stop()
+
+    def test_ticks_every_interval(self):
+        self.loop.interval = 0.01
+        self.loop.ensureStarted()
+
+        assert self.loop.ticked.wait(5)
+        self.loop.stop()
+
+    def test_stop_ticks_a_last_time(self):
+        self.loop.ensureStarted()
+        self.loop.stop()
+
+        assert self.loop.ticks == 1
+        assert self.loop._thread is None
+
+    def test_stop_without_start(self):
+        self.loop.stop()
+
+        assert self.loop.ticks == 0
+
+    def test_errors_are_logged(self, mocker):
+        logger = mocker.patch("background.logger")
+        mocker.patch.object(self.loop, "_loopTick", side_effect=ValueError("boom"))
+        self.loop.ensureStarted()
+
+        self.loop.stop()
+
+        logger.return_value.error.assert_called_once()
+
+    def test_disabled(self, mocker):
+        mocker.patch.object(self.loop, "_loopEnabled", return_value=False)
+
+        self.loop.ensureStarted()
+
+        assert self.loop._thread is None
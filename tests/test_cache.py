@@ -0,0 +1,327 @@
+import time
+import pytest
+import mock
+from cache import TTLCache, SharedCache, StaleWhileRevalidateCache, MISSING
+
+
+class TestTTLCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_monotonic = mocker.patch("cache.time.monotonic")
+        self.mock_monotonic.return_value = 100
+
+        self.cache = TTLCache(maxsize=2, ttl=10)
+
+    def test_missing(self):
+        assert self.cache.get("key") is MISSING
+        assert self.cache.get("key", None) is None
+        assert self.cache.misses == 2
+
+    def test_hit(self):
+        self.cache.set("key", "value")
+
+        assert self.cache.get("key") == "value"
+        assert self.cache.hits == 1
+
+    def test_expired(self):
+        self.cache.set("key", "value")
+        self.mock_monotonic.return_value = 110
+
+        assert self.cache.get("key") is MISSING
+        assert len(self.cache) == 0
+
+    def test_per_entry_ttl(self):
+        self.cache.set("key", "value", ttl=2)
+        self.mock_monotonic.return_value = 101
+        assert self.cache.get("key") == "value"
+
+        self.mock_monotonic.return_value = 102
+        assert self.cache.get("key") is MISSING
+
+    def test_zero_ttl_not_stored(self):
+        self.cache.set("key", "value", ttl=0)
+        assert self.cache.get("key") is MISSING
+
+    def test_lru_eviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        assert self.cache.get("a") == 1
+        assert self.cache.get("b") is MISSING
+        assert self.cache.get("c") == 3
+
+    def test_invalidate(self):
+        self.cache.set("key", "value")
+        self.cache.invalidate("key")
+        self.cache.invalidate("not_a_key")
+
+        assert self.cache.get("key") is MISSING
+
+    def test_byte_eviction(self):
+        cache = TTLCache(maxsize=10, ttl=10, maxbytes=10, sizeof=len)
+        cache.set("a", b"x" * 4)
+        cache.set("b", b"x" * 4)
+        cache.get("a")
+        cache.set("c", b"x" * 4)
+
+        assert cache.get("a") == b"x" * 4
+        assert cache.get("b") is MISSING
+        assert cache.get("c") == b"x" * 4
+        assert cache.stats()["bytes"] == 8
+
+    def test_larger_than_maxbytes_not_stored(self):
+        cache = TTLCache(maxsize=10, ttl=10, maxbytes=10, sizeof=len)
+        cache.set("a", b"x" * 4)
+        cache.set("b", b"x" * 11)
+
+        assert cache.get("a") == b"x" * 4
+        assert cache.get("b") is MISSING
+
+    def test_bytes_released(self):
+        cache = TTLCache(maxsize=10, ttl=10, maxbytes=10, sizeof=len)
+        cache.set("a", b"x" * 4)
+        cache.set("a", b"x" * 6)
+        cache.set("b", b"x" * 3)
+        cache.invalidate("b")
+        self.mock_monotonic.return_value = 110
+        cache.get("a")
+
+        assert cache.nbytes == 0
+
+
+class TestSharedCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "cache.sqlite3"
+        self.cache = SharedCache(self.path, "token", ttl=10)
+
+    def test_missing(self):
+        assert self.cache.get("key") is MISSING
+        assert self.cache.lookup("key") is None
+
+    def test_roundtrip(self):
+        self.cache.set("key", {"isvalid": True, "files": [1, 2]})
+
+        assert self.cache.get("key") == {"isvalid": True, "files": [1, 2]}
+
+    def test_remaining_ttl(self):
+        self.cache.set("key", "value", ttl=5)
+
+        value, remaining = self.cache.lookup("key")
+        assert value == "value"
+        assert 0 < remaining <= 5
+
+    def test_expired(self):
+        self.cache.set("key", "value", ttl=-1)
+
+        assert self.cache.get("key") is MISSING
+
+    def test_visible_to_other_connections(self):
+        self.cache.set("key", "value")
+
+        other = SharedCache(self.path, "token")
+        assert other.get("key") == "value"
+
+    def test_namespaces_are_separate(self):
+        self.cache.set("key", "value")
+
+        other = SharedCache(self.path, "navigation")
+        assert other.get("key") is MISSING
+
+    def test_invalidate(self):
+        self.cache.set("key", "value")
+        self.cache.invalidate("key")
+
+        assert self.cache.get("key") is MISSING
+
+    def test_invalidations(self):
+        other = SharedCache(self.path, "navigation")
+        latest, keys = self.cache.invalidations()
+        assert keys == set()
+
+        self.cache.invalidate("a")
+        other.invalidate("b")
+        self.cache.invalidate("c")
+
+        assert self.cache.invalidations(latest) == (latest + 3, {"a", "c"})
+        assert other.invalidations(latest) == (latest + 3, {"b"})
+        assert self.cache.invalidations(latest + 3) == (latest + 3, set())
+
+    def test_clear_invalidates_everything(self):
+        latest, _ = self.cache.invalidations()
+
+        self.cache.clear()
+
+        assert self.cache.invalidations(latest) == (latest + 1, None)
+
+    def test_swept_invalidations_invalidate_everything(self):
+        cache = SharedCache(self.path, "token", maxrows=2)
+        latest, _ = cache.invalidations()
+        for key in "abcd":
+            cache.invalidate(key)
+
+        cache._sweep(cache._connection(), time.time())
+
+        assert cache.invalidations(latest) == (latest + 4, None)
+        assert cache.invalidations(latest + 2) == (latest + 4, {"c", "d"})
+
+    def test_unserializable_value_is_ignored(self):
+        self.cache.set("key", object())
+
+        assert self.cache.get("key") is MISSING
+
+
+class TestTTLCacheWithSharedCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "cache.sqlite3"
+        self.cache = self.makeCache()
+
+    def makeCache(self, check_interval=0):
+        return TTLCache(
+            ttl=10,
+            shared=SharedCache(self.path, "token"),
+            check_interval=check_interval,
+        )
+
+    def test_write_through(self):
+        self.cache.set("key", "value")
+
+        other = self.makeCache()
+        assert other.get("key") == "value"
+        assert len(other) == 1
+
+    def test_invalidate_shared(self):
+        self.cache.set("key", "value")
+        self.cache.invalidate("key")
+
+        other = self.makeCache()
+        assert other.get("key") is MISSING
+
+    def test_invalidate_reaches_other_workers(self):
+        other = self.makeCache()
+        self.cache.set("key", "value")
+        assert other.get("key") == "value"
+
+        self.cache.invalidate("key")
+
+        assert other.get("key") is MISSING
+        assert len(other) == 0
+
+    def test_invalidate_keeps_other_keys(self, mocker):
+        other = self.makeCache()
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        assert other.get("a") == 1
+        assert other.get("b") == 2
+
+        self.cache.invalidate("b")
+        lookup = mocker.spy(other.shared, "lookup")
+
+        assert other.get("a") == 1
+        assert other.get("b") is MISSING
+        lookup.assert_called_once_with("b")
+
+    def test_clear_reaches_other_workers(self):
+        other = self.makeCache()
+        self.cache.set("key", "value")
+        assert other.get("key") == "value"
+
+        self.cache.clear()
+
+        assert other.get("key") is MISSING
+
+    def test_invalidations_checked_once_per_interval(self, mocker):
+        other = self.makeCache(check_interval=60)
+        self.cache.set("key", "value")
+        assert other.get("key") == "value"
+        invalidations = mocker.spy(other.shared, "invalidations")
+
+        self.cache.invalidate("key")
+        for _ in range(3):
+            assert other.get("key") == "value"
+        assert not invalidations.called
+
+        mocker.patch("cache.time.monotonic", return_value=time.monotonic() + 61)
+        assert other.get("key") is MISSING
+        invalidations.assert_called_once()
+
+    def test_local_copy_served_when_shared_fails(self, mocker):
+        self.cache.set("key", "value")
+        mocker.patch.object(self.cache.shared, "invalidations", return_value=None)
+
+        assert self.cache.get("key") == "value"
+
+
+class TestStaleWhileRevalidateCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_time = mocker.patch("cache.time.time")
+        self.mock_time.return_value = 1000
+        self.mock_monotonic = mocker.patch("cache.time.monotonic")
+        self.mock_monotonic.return_value = 1000
+
+        self.loader = mock.MagicMock()
+        self.loader.side_effect = ["first", "second"]
+        self.cache = StaleWhileRevalidateCache(ttl=10, max_age=100)
+
+    def advance(self, seconds):
+        self.mock_time.return_value += seconds
+        self.mock_monotonic.return_value += seconds
+
+    def test_miss_loads(self):
+        assert self.cache.get("key", self.loader) == "first"
+        self.loader.assert_called_once_with("key")
+
+    def test_fresh_hit(self):
+        self.cache.get("key", self.loader)
+        self.advance(5)
+
+        assert self.cache.get("key", self.loader) == "first"
+        self.loader.assert_called_once_with("key")
+
+    def test_stale_hit_refreshes(self):
+        self.cache.get("key", self.loader)
+        self.advance(20)
+
+        assert self.cache.get("key", self.loader) == "second"
+        assert self.cache.get("key", self.loader) == "second"
+        assert self.loader.call_count == 2
+        assert self.cache.stale_hits == 1
+
+    def test_stale_served_while_refreshing_in_background(self):
+        mock_executor = mock.MagicMock()
+        self.cache.executor = lambda: mock_executor
+        self.cache.get("key", self.loader)
+        self.advance(20)
+
+        assert self.cache.get("key", self.loader) == "first"
+        assert self.cache.get("key", self.loader) == "first"
+        mock_executor.submit.assert_called_once_with(
+            self.cache._revalidate, "key", self.loader, "first"
+        )
+
+        mock_executor.submit.call_args[0][0](*mock_executor.submit.call_args[0][1:])
+        assert self.cache.get("key", self.loader) == "second"
+
+    def test_stale_if_error(self):
+        self.loader.side_effect = ["first", Exception("upstream error")]
+        self.cache.get("key", self.loader)
+        self.advance(20)
+
+        assert self.cache.get("key", self.loader) == "first"
+        assert self.cache.refresh_errors == 1
+
+    def test_miss_error_raises(self):
+        self.loader.side_effect = Exception("upstream error")
+
+        with pytest.raises(Exception):
+            self.cache.get("key", self.loader)
+
+    def test_max_age(self):
+        self.cache.get("key", self.loader)
+        self.advance(200)
+
+        assert self.cache.get("key", self.loader) == "second"
@@ -0,0 +1,45 @@
+import os
+import pytest
+import sqlite3
+import threading
+from database import connect, LocalConnection
+
+
+class TestConnect:
+    def test_wal(self, temp_directory):
+        conn = connect(temp_directory / "test.db")
+
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.isolation_level is None
+
+
+class TestLocalConnection:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory, mocker):
+        self.setup = mocker.MagicMock()
+        self.connection = LocalConnection(
+            temp_directory / "test.db", setup=self.setup, row_factory=sqlite3.Row
+        )
+
+    def test_reused_in_thread(self):
+        conn = self.connection()
+
+        assert self.connection() is conn
+        assert conn.row_factory is sqlite3.Row
+        self.setup.assert_called_once_with(conn)
+
+    def test_one_per_thread(self):
+        conn = self.connection()
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.connection()))
+        thread.start()
+        thread.join()
+
+        assert other[0] is not conn
+        assert self.setup.call_count == 2
+
+    def test_reopened_after_fork(self):
+        conn = self.connection()
+        self.connection._local.pid = os.getpid() + 1
+
+        assert self.connection() is not conn
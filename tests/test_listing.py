@@ -0,0 +1,269 @@
+import os
+import time
+import pytest
+from listing import ListingCache, scanDirectory, _groupSubtitles
+from pathlib import Path
+
+
+def accept(filename):
+    return filename.endswith(".mp4")
+
+
+def age(path, seconds=60):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+class TestScanDirectory:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.dir = temp_directory
+        (self.dir / "movie.mp4").write_bytes(b"x" * 10)
+        (self.dir / "movie.en.vtt").write_text("WEBVTT")
+        (self.dir / "other.vtt").write_text("WEBVTT")
+        (self.dir / "notes.txt").write_text("notes")
+
+        self.sub = self.dir / "extras"
+        self.sub.mkdir()
+        (self.sub / "extra.mp4").write_bytes(b"x" * 20)
+
+    def test_recursive(self):
+        listing = scanDirectory(self.dir, accept)
+
+        files = {(f.root, f.filename, f.size, f.subtitles) for f in listing.files}
+        assert files == {
+            (self.dir, "movie.mp4", 10, (self.dir / "movie.en.vtt",)),
+            (self.sub, "extra.mp4", 20, ()),
+        }
+        assert set(listing.mtimes) == {str(self.dir), str(self.sub)}
+
+    def test_not_recursive(self):
+        listing = scanDirectory(self.dir, accept, recursive=False)
+
+        assert [f.filename for f in listing.files] == ["movie.mp4"]
+        assert set(listing.mtimes) == {str(self.dir)}
+
+    def test_version(self):
+        version = scanDirectory(self.dir, accept).version
+
+        assert scanDirectory(self.dir, accept).version == version
+        (self.sub / "extra.mp4").write_bytes(b"x" * 30)
+        assert scanDirectory(self.dir, accept).version != version
+
+    def test_subtitles_grouped_by_stem(self):
+        (self.dir / "movie 2.mp4").write_bytes(b"x")
+        (self.dir / "movie 2.vtt").write_text("WEBVTT")
+        (self.dir / "movie 2.forced.en.vtt").write_text("WEBVTT")
+
+        listing = scanDirectory(self.dir, accept, recursive=False)
+
+        subtitles = {f.filename: set(f.subtitles) for f in listing.files}
+        assert subtitles == {
+            "movie.mp4": {self.dir / "movie.en.vtt"},
+            "movie 2.mp4": {
+                self.dir / "movie 2.vtt",
+                self.dir / "movie 2.forced.en.vtt",
+            },
+        }
+
+    def test_rejected_files_not_stat_ed(self, mocker):
+        mock_accept = mocker.MagicMock(return_value=False)
+
+        listing = scanDirectory(self.dir, mock_accept, recursive=False)
+
+        assert listing.files == []
+        mock_accept.assert_any_call("notes.txt")
+        assert not any(
+            call.args[0].endswith(".vtt") for call in mock_accept.call_args_list
+        )
+
+    def test_missing_directory(self):
+        missing = self.dir / "missing"
+
+        listing = scanDirectory(missing, accept)
+
+        assert listing.files == []
+        assert listing.mtimes == {str(missing): None}
+        assert listing.isCurrent()
+
+        missing.mkdir()
+        assert not listing.isCurrent()
+
+    def test_has_grown(self):
+        listing = scanDirectory(self.dir, accept)
+
+        assert not listing.hasGrown(min_size=15)
+        (self.dir / "movie.mp4").write_bytes(b"x" * 12)
+        (self.sub / "extra.mp4").write_bytes(b"x" * 25)
+        assert listing.hasGrown(min_size=15)
+        assert not listing.hasGrown(min_size=10)
+
+    def test_has_grown_when_small_file_removed(self):
+        listing = scanDirectory(self.dir, accept)
+
+        (self.dir / "movie.mp4").unlink()
+
+        assert listing.hasGrown(min_size=15)
+
+
+class TestGroupSubtitles:
+    def test_group(self):
+        paths = [Path("/a/Movie.mv-encoded.en.vtt"), Path("/a/Movie.vtt")]
+
+        grouped = _groupSubtitles(paths)
+
+        assert grouped == {
+            "Movie": paths,
+            "Movie.mv-encoded": [paths[0]],
+            "Movie.mv-encoded.en": [paths[0]],
+        }
+
+
+class TestListingCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory, mocker):
+        self.dir = temp_directory
+        (self.dir / "movie.mp4").write_bytes(b"x" * 10)
+        age(self.dir)
+
+        self.cache = ListingCache(maxsize=2, max_age=300)
+
+    def test_hit(self):
+        first = self.cache.get(self.dir, accept)
+        second = self.cache.get(self.dir, accept)
+
+        assert first is second
+        assert self.cache.hits == 1
+        assert self.cache.misses == 1
+
+    def test_rebuilt_when_directory_changes(self):
+        self.cache.get(self.dir, accept)
+        (self.dir / "new.mp4").write_bytes(b"x")
+        age(self.dir, seconds=30)
+
+        listing = self.cache.get(self.dir, accept)
+
+        assert {f.filename for f in listing.files} == {"movie.mp4", "new.mp4"}
+        assert self.cache.misses == 2
+
+    def test_recently_modified_directory_not_trusted(self):
+        os.utime(self.dir)
+
+        self.cache.get(self.dir, accept)
+        self.cache.get(self.dir, accept)
+
+        assert self.cache.misses == 2
+
+    def test_max_age(self, mocker):
+        self.cache.get(self.dir, accept)
+        mocker.patch("listing.time.time", return_value=time.time() + 301)
+
+        self.cache.get(self.dir, accept)
+
+        assert self.cache.misses == 2
+
+    def test_small_file_growing_in_place(self):
+        self.cache.get(self.dir, accept)
+        with open(self.dir / "movie.mp4", "ab") as fp:
+            fp.write(b"x" * 10)
+
+        listing = self.cache.get(self.dir, accept)
+
+        assert [f.size for f in listing.files] == [20]
+        assert self.cache.misses == 2
+
+    def test_large_file_growing_in_place(self):
+        cache = ListingCache(maxsize=2, max_age=300, min_size=10)
+        cache.get(self.dir, accept)
+        with open(self.dir / "movie.mp4", "ab") as fp:
+            fp.write(b"x" * 10)
+
+        listing = cache.get(self.dir, accept)
+
+        assert [f.size for f in listing.files] == [10]
+        assert cache.hits == 1
+
+    def test_invalidate(self):
+        self.cache.get(self.dir, accept)
+        self.cache.invalidate(self.dir)
+        self.cache.get(self.dir, accept)
+
+        assert self.cache.misses == 2
+
+    def test_invalidate_parent(self):
+        self.cache.get(self.dir, accept)
+        self.cache.invalidate(self.dir.parent)
+        self.cache.get(self.dir, accept)
+
+        assert self.cache.misses == 2
+
+    def test_lru(self, temp_directory):
+        others = []
+        for name in ("a", "b"):
+            other = self.dir / name
+            other.mkdir()
+            age(other)
+            others.append(other)
+        age(self.dir)
+
+        self.cache.get(self.dir, accept)
+        self.cache.get(others[0], accept)
+        self.cache.get(others[1], accept)
+        self.cache.get(self.dir, accept)
+
+        assert self.cache.misses == 4
+
+
+class TestListingCacheWithWatcher:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory, mocker):
+        self.dir = temp_directory
+        (self.dir / "movie.mp4").write_bytes(b"x" * 10)
+
+        self.watcher = mocker.MagicMock()
+        self.watcher.covers.return_value = True
+        self.cache = ListingCache(maxsize=2, max_age=300, watcher=self.watcher)
+
+    def test_watched_listing_skips_mtime_checks(self, mocker):
+        self.cache.get(self.dir, accept)
+        mock_isCurrent = mocker.patch("listing.Listing.isCurrent")
+
+        self.cache.get(self.dir, accept)
+
+        assert not mock_isCurrent.called
+        assert self.cache.hits == 1
+        self.watcher.covers.assert_called_with(self.dir)
+
+    def test_scan_racing_invalidation_not_stored(self, mocker):
+        scan = scanDirectory
+
+        def racingScan(*args, **kwargs):
+            listing = scan(*args, **kwargs)
+            self.cache.invalidate(self.dir)
+            return listing
+
+        mocker.patch("listing.scanDirectory", side_effect=racingScan)
+        self.cache.get(self.dir, accept)
+        self.cache.get(self.dir, accept)
+
+        assert self.cache.misses == 2
+
+    def test_revalidate(self):
+        age(self.dir)
+        self.cache.get(self.dir, accept)
+        self.cache.revalidate()
+        assert len(self.cache._listings) == 1
+
+        (self.dir / "new.mp4").write_bytes(b"x")
+        age(self.dir, seconds=30)
+        self.cache.revalidate()
+        assert len(self.cache._listings) == 0
+
+    def test_revalidate_small_file_growing_in_place(self):
+        age(self.dir)
+        self.cache.get(self.dir, accept)
+
+        (self.dir / "movie.mp4").write_bytes(b"x" * 20)
+        self.cache.revalidate()
+
+        assert len(self.cache._listings) == 0
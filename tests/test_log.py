@@ -0,0 +1,215 @@
+import os
+import sys
+import time
+import queue
+import logging
+import pytest
+from logging.handlers import QueueHandler
+from log import (
+    LogFile,
+    LogSink,
+    SinkHandler,
+    SinkProcess,
+    DeferredQueueHandler,
+    logger,
+)
+
+
+class TestLogFile:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.path = temp_directory / "waiterLog"
+        mocker.patch("log.fullLogPath", self.path)
+        LogFile.stop()
+        yield
+        LogFile.stop()
+
+    def test_queue_handler(self):
+        handlers = logger().handlers
+
+        assert len(handlers) == 1
+        assert isinstance(handlers[0], QueueHandler)
+
+    def test_written_by_listener(self):
+        logger().info("Sending %s", "movie.mp4")
+        LogFile.stop()
+
+        assert "INFO - Sending movie.mp4" in self.path.read_text()
+
+    def test_exception(self):
+        try:
+            raise ValueError("bad box")
+        except ValueError as e:
+            logger().error(e, exc_info=True)
+        LogFile.stop()
+
+        text = self.path.read_text()
+        assert "ERROR - bad box" in text
+        assert "Traceback" in text
+
+    def test_level(self, mocker):
+        mocker.patch("log.LOG_LEVEL", "WARNING")
+        arg = mocker.MagicMock()
+
+        logger().info("Sending %s", arg)
+        logger().warning("Slow")
+        LogFile.stop()
+
+        assert not logger().isEnabledFor(logging.INFO)
+        assert arg.__str__.call_count == 0
+        assert self.path.read_text().endswith("WARNING - Slow\n")
+
+    def test_restarted_after_fork(self, mocker):
+        log = logger()
+        listener = LogFile.listener
+        mocker.patch("log.os.getpid", return_value=-1)
+
+        assert logger() is log
+        assert LogFile.listener is not listener
+        assert len(log.handlers) == 1
+        listener.stop()
+
+    def test_sink(self, mocker, temp_directory):
+        sink = LogSink(temp_directory / "s", logfile=self.path)
+        sink.start()
+        mocker.patch("log.LOG_SOCKET", sink.path)
+
+        logger()
+        assert isinstance(LogFile.listener.handlers[0], SinkHandler)
+        logger().info("From a worker %s", 1)
+        LogFile.stop()
+        sink.stop()
+
+        assert "INFO - From a worker 1" in self.path.read_text()
+
+
+class TestDeferredQueueHandler:
+    def test_full_queue_drops(self):
+        handler = DeferredQueueHandler(queue.Queue(1))
+        record = logging.makeLogRecord({"msg": "hello"})
+
+        handler.handle(record)
+        handler.handle(record)
+
+        assert handler.queue.qsize() == 1
+        assert handler.dropped == 1
+
+
+class TestLogSink:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "waiterLog"
+        self.sink = LogSink(temp_directory / "s", logfile=self.path)
+        self.sink.start()
+        yield
+        self.sink.stop()
+
+    def send(self, *records):
+        expected = self.sink.written + len(records)
+        handler = SinkHandler(self.sink.path)
+        for record in records:
+            handler.handle(record)
+        handler.close()
+
+        deadline = time.monotonic() + 5
+        while self.sink.written < expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_records_from_many_handlers(self):
+        for worker in range(4):
+            self.send(
+                *(
+                    logging.makeLogRecord(
+                        {
+                            "name": "waiter",
+                            "msg": "worker %s line %s",
+                            "args": (worker, i),
+                        }
+                    )
+                    for i in range(25)
+                )
+            )
+
+        lines = self.path.read_text().splitlines()
+        assert len(lines) == 100
+        assert lines[0].endswith("worker 0 line 0")
+        assert lines[-1].endswith("worker 3 line 24")
+
+    def test_exception(self):
+        try:
+            raise ValueError("bad box")
+        except ValueError:
+            record = logging.getLogger("waiter").makeRecord(
+                "waiter", logging.ERROR, __file__, 1, "failed", (), sys.exc_info()
+            )
+        self.send(record)
+
+        text = self.path.read_text()
+        assert "ERROR - failed" in text
+        assert "ValueError: bad box" in text
+
+    def test_socket_is_private(self):
+        assert oct(os.stat(self.sink.path).st_mode & 0o777) == "0o600"
+
+    def test_rotation(self, mocker):
+        self.sink.handler.maxBytes = 200
+
+        self.send(*(logging.makeLogRecord({"msg": "x" * 50}) for i in range(20)))
+
+        rotated = sorted(p.name for p in self.path.parent.glob("waiterLog*"))
+        assert rotated[:2] == ["waiterLog", "waiterLog.1"]
+        assert (
+            sum(
+                len(p.read_text().splitlines())
+                for p in self.path.parent.glob("waiterLog*")
+            )
+            == 20
+        )
+
+    def test_stop_removes_socket(self):
+        self.sink.stop()
+
+        assert not os.path.exists(self.sink.path)
+
+    def test_dropped_while_unreachable(self):
+        handler = SinkHandler(self.sink.path)
+        handler.retryStart = 0
+        self.sink.stop()
+
+        handler.handle(logging.makeLogRecord({"msg": "lost"}))
+        handler.handle(logging.makeLogRecord({"msg": "lost"}))
+        assert handler.dropped == 2
+
+        self.sink.start()
+        handler.handle(logging.makeLogRecord({"msg": "found"}))
+        handler.close()
+        deadline = time.monotonic() + 5
+        while self.sink.written < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        lines = self.path.read_text().splitlines()
+        assert lines[-2].endswith(
+            "WARNING - Dropped 2 log records while the log sink was unreachable"
+        )
+        assert lines[-1].endswith("found")
+        assert handler.dropped == 2
+
+
+class TestSinkProcess:
+    def test_writes_in_own_process(self, temp_directory):
+        path = temp_directory / "waiterLog"
+        sink = SinkProcess(temp_directory / "s", logfile=path)
+        sink.start()
+        try:
+            assert sink.process.pid != os.getpid()
+            handler = SinkHandler(sink.path)
+            handler.handle(logging.makeLogRecord({"msg": "From a worker"}))
+            handler.close()
+        finally:
+            sink.stop()
+
+        assert path.read_text().endswith("From a worker\n")
+        assert not os.path.exists(sink.path)
+
+    def test_stop_without_start(self, temp_directory):
+        SinkProcess(temp_directory / "s").stop()
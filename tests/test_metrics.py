@@ -0,0 +1,234 @@
+import json
+import pytest
+import requests
+from metrics import (
+    MetricsRegistry,
+    upstreamErrors,
+    upstreamLatency,
+    fileSends,
+    fileBytesSent,
+)
+from upstream import UpstreamClient, endpointName
+from waiter import app, routeName
+
+
+class TestMetricsRegistry:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.dir = temp_directory
+
+    def registry(self, directory=None):
+        registry = MetricsRegistry(directory=directory)
+        counter = registry.counter("test_total", "Test counter", ["route"])
+        histogram = registry.histogram(
+            "test_seconds", "Test histogram", ["route"], buckets=(0.1, 1)
+        )
+        return registry, counter, histogram
+
+    def test_render(self):
+        registry, counter, histogram = self.registry()
+        counter.inc(route="dir")
+        counter.inc(2, route='a"b')
+        histogram.observe(0.05, route="dir")
+        histogram.observe(0.5, route="dir")
+        histogram.observe(5, route="dir")
+
+        assert registry.render() == (
+            "# HELP test_total Test counter\n"
+            "# TYPE test_total counter\n"
+            'test_total{route="a\\"b"} 2\n'
+            'test_total{route="dir"} 1\n'
+            "# HELP test_seconds Test histogram\n"
+            "# TYPE test_seconds histogram\n"
+            'test_seconds_bucket{route="dir",le="0.1"} 1\n'
+            'test_seconds_bucket{route="dir",le="1"} 2\n'
+            'test_seconds_bucket{route="dir",le="+Inf"} 3\n'
+            'test_seconds_sum{route="dir"} 5.55\n'
+            'test_seconds_count{route="dir"} 3\n'
+        )
+
+    def test_duplicate_metric(self):
+        registry, counter, histogram = self.registry()
+
+        with pytest.raises(ValueError):
+            registry.counter("test_total", "Again")
+
+    def test_aggregates_workers(self, mocker):
+        registry, counter, histogram = self.registry(self.dir)
+        counter.inc(route="dir")
+        histogram.observe(0.5, route="dir")
+        mocker.patch("metrics.os.getpid", return_value=1)
+        registry.flush()
+
+        other, other_counter, other_histogram = self.registry(self.dir)
+        other_counter.inc(3, route="dir")
+        other_counter.inc(route="file")
+        other_histogram.observe(0.05, route="dir")
+        mocker.patch("metrics.os.getpid", return_value=2)
+
+        collected = other.collect()
+
+        assert collected["test_total"] == {("dir",): 4, ("file",): 1}
+        assert collected["test_seconds"][("dir",)] == [1, 1, 0, 0.55]
+
+    def test_own_file_is_not_counted_twice(self):
+        registry, counter, histogram = self.registry(self.dir)
+        counter.inc(route="dir")
+        registry.flush()
+
+        assert registry.collect()["test_total"] == {("dir",): 1}
+
+    def test_archive(self, mocker):
+        registry, counter, histogram = self.registry(self.dir)
+        for pid in (1, 2):
+            mocker.patch("metrics.os.getpid", return_value=pid)
+            counter.clear()
+            counter.inc(pid, route="dir")
+            registry.flush()
+        counter.clear()
+
+        registry.archive(1)
+        registry.archive(2)
+        registry.archive(3)
+
+        assert not registry.workerPath(1).exists()
+        assert not registry.workerPath(2).exists()
+        archive = json.loads((self.dir / "archive.json").read_text())
+        assert archive["test_total"]["samples"] == [[["dir"], 3]]
+        assert registry.collect()["test_total"] == {("dir",): 3}
+
+    def test_corrupt_file_is_skipped(self):
+        registry, counter, histogram = self.registry(self.dir)
+        (self.dir / "worker-1.json").write_text("{")
+        counter.inc(route="dir")
+
+        assert registry.collect()["test_total"] == {("dir",): 1}
+
+    def test_flush_thread(self, mocker):
+        registry, counter, histogram = self.registry(self.dir)
+        counter.inc(route="dir")
+
+        registry.ensureStarted()
+        registry.stop()
+
+        snapshot = json.loads(registry.workerPath().read_text())
+        assert snapshot["test_total"]["samples"] == [[["dir"], 1]]
+
+    def test_no_directory(self):
+        registry, counter, histogram = self.registry()
+        counter.inc(route="dir")
+
+        registry.flush()
+        registry.ensureStarted()
+
+        assert registry.collect()["test_total"] == {("dir",): 1}
+
+
+class TestRouteName:
+    @pytest.mark.parametrize(
+        "path,method,expected",
+        [
+            ("/waiter/dir/guid/", "GET", "dir"),
+            ("/waiter/file/guid/hash", "GET", "file"),
+            ("/waiter/file/guid/", "GET", "file"),
+            ("/waiter/stream/guid/hash", "GET", "stream"),
+            ("/waiter/viewed/guid", "POST", "viewed"),
+            ("/waiter/metrics", "GET", "metrics"),
+            ("/nothing/here", "GET", "unmatched"),
+        ],
+    )
+    def test_route(self, path, method, expected):
+        with app.test_request_context(path, method=method):
+            from flask import request
+
+            assert routeName(request.url_rule) == expected
+
+
+class TestUpstreamMetrics:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.client = UpstreamClient()
+        self.mock_request = mocker.patch.object(self.client.session, "request")
+        self.url = "http://mediaviewer:8000/mediaviewer/api/downloadtoken/guid/"
+
+    @pytest.mark.parametrize(
+        "url,expected",
+        [
+            (
+                "http://mediaviewer:8000/mediaviewer/api/downloadtoken/guid/",
+                "downloadtoken",
+            ),
+            (
+                "http://mediaviewer:8000/mediaviewer/ajaxvideoprogress/g/f/",
+                "ajaxvideoprogress",
+            ),
+            ("http://mediaviewer:8000/mediaviewer/ajaxsuperviewed/", "ajaxsuperviewed"),
+            ("http://mediaviewer:8000/mediaviewer/", "root"),
+        ],
+    )
+    def test_endpoint_name(self, url, expected):
+        assert endpointName(url) == expected
+
+    def test_latency(self):
+        self.mock_request.return_value.ok = True
+        before = upstreamLatency.count(endpoint="downloadtoken")
+
+        self.client.get(self.url)
+
+        assert upstreamLatency.count(endpoint="downloadtoken") == before + 1
+
+    def test_status_error(self):
+        self.mock_request.return_value.ok = False
+        self.mock_request.return_value.status_code = 404
+        before = upstreamErrors.value(endpoint="downloadtoken", reason="404")
+
+        self.client.get(self.url)
+
+        assert (
+            upstreamErrors.value(endpoint="downloadtoken", reason="404") == before + 1
+        )
+
+    def test_timeout(self):
+        self.mock_request.side_effect = requests.Timeout("slow")
+        before = upstreamErrors.value(endpoint="downloadtoken", reason="timeout")
+
+        with pytest.raises(requests.Timeout):
+            self.client.get(self.url)
+
+        assert (
+            upstreamErrors.value(endpoint="downloadtoken", reason="timeout")
+            == before + 1
+        )
+
+
+class TestMetricsEndpoint:
+    def test_metrics(self):
+        client = app.test_client()
+        client.get("/waiter/status/")
+
+        response = client.get("/waiter/metrics")
+
+        assert response.status_code == 200
+        assert response.mimetype == "text/plain"
+        text = response.get_data(as_text=True)
+        assert "# TYPE waiter_request_duration_seconds histogram" in text
+        assert 'waiter_requests_total{route="status",status="200"}' in text
+        assert 'waiter_request_duration_seconds_count{route="status"}' in text
+
+    def test_file_sends(self, mocker, temp_directory):
+        from waiter import send_file_partial
+
+        mocker.patch("waiter.USE_NGINX", False)
+        path = temp_directory / "movie.mkv"
+        path.write_bytes(b"x" * 100)
+        before = fileSends.value(mode="wsgi", status=206)
+        sent = fileBytesSent.value(mode="wsgi")
+
+        with app.test_request_context(headers={"Range": "bytes=0-9"}):
+            response = send_file_partial(path, "movie.mkv")
+            assert fileBytesSent.value(mode="wsgi") == sent
+            assert b"".join(response.response) == b"x" * 10
+            response.close()
+
+        assert fileSends.value(mode="wsgi", status=206) == before + 1
+        assert fileBytesSent.value(mode="wsgi") == sent + 10
@@ -0,0 +1,253 @@
+import struct
+import pytest
+from werkzeug.test import EnvironBuilder
+from mp4 import (
+    readBoxes,
+    shiftChunkOffsets,
+    buildFastStart,
+    fastStartLayout,
+    layoutCache,
+)
+from ranges import Part, FileParts, rangeResponse
+
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def table(box_type, fmt, offsets):
+    payload = struct.pack(">II", 0, len(offsets))
+    payload += struct.pack(f">{len(offsets)}{fmt}", *offsets)
+    return box(box_type, payload)
+
+
+def moov(stco, co64=()):
+    stbl = box(b"stbl", table(b"stco", "I", stco) + table(b"co64", "Q", co64))
+    trak = box(b"trak", box(b"mdia", box(b"minf", stbl)))
+    return box(b"moov", box(b"mvhd", b"\0" * 20) + trak)
+
+
+def offsets(data, box_type, fmt):
+    pos = data.index(box_type) + 4
+    (count,) = struct.unpack_from(">I", data, pos + 4)
+    return list(struct.unpack_from(f">{count}{fmt}", data, pos + 8))
+
+
+def virtualBytes(layout, path, start=0, end=None):
+    end = layout.size - 1 if end is None else end
+    body = FileParts(open(path, "rb"), layout.mapParts([Part(b"", start, end)]))
+    try:
+        return b"".join(body)
+    finally:
+        body.close()
+
+
+class TestReadBoxes:
+    def test_boxes(self, temp_directory):
+        path = temp_directory / "movie.mp4"
+        path.write_bytes(box(b"ftyp", b"isom") + box(b"mdat", b"x" * 10))
+
+        with open(path, "rb") as fp:
+            boxes = readBoxes(fp, path.stat().st_size)
+
+        assert [(b.type, b.offset, b.size) for b in boxes] == [
+            (b"ftyp", 0, 12),
+            (b"mdat", 12, 18),
+        ]
+
+    def test_large_size(self, temp_directory):
+        path = temp_directory / "movie.mp4"
+        path.write_bytes(struct.pack(">I4sQ", 1, b"mdat", 20) + b"x" * 4)
+
+        with open(path, "rb") as fp:
+            boxes = readBoxes(fp, 20)
+
+        assert boxes[0].size == 20
+        assert boxes[0].header == 16
+
+    def test_size_to_end_of_file(self, temp_directory):
+        path = temp_directory / "movie.mp4"
+        path.write_bytes(box(b"ftyp") + struct.pack(">I4s", 0, b"mdat") + b"x" * 10)
+
+        with open(path, "rb") as fp:
+            boxes = readBoxes(fp, 26)
+
+        assert boxes[1].size == 18
+
+    @pytest.mark.parametrize("data", [b"\0\0\0\x20mdat", b"\0\0\0\x04mdat", b"abc"])
+    def test_malformed(self, temp_directory, data):
+        path = temp_directory / "movie.mp4"
+        path.write_bytes(data)
+
+        with open(path, "rb") as fp, pytest.raises(ValueError):
+            readBoxes(fp, len(data))
+
+
+class TestShiftChunkOffsets:
+    def test_shift(self):
+        data = bytearray(moov([10, 100, 200], co64=[50, 150, 2**40]))
+
+        shiftChunkOffsets(data, 1000, 100, 2**40)
+
+        assert offsets(data, b"stco", "I") == [10, 1100, 1200]
+        assert offsets(data, b"co64", "Q") == [50, 1150, 2**40]
+
+    def test_stco_overflow(self):
+        data = bytearray(moov([0xFFFFFFF0]))
+
+        with pytest.raises(ValueError):
+            shiftChunkOffsets(data, 0x100, 0, 2**40)
+
+    def test_truncated_table(self):
+        data = bytearray(moov([1, 2, 3]))
+        pos = data.index(b"stco") + 8
+        struct.pack_into(">I", data, pos, 100)
+
+        with pytest.raises(ValueError):
+            shiftChunkOffsets(data, 10, 0, 100)
+
+
+class TestFastStart:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.ftyp = box(b"ftyp", b"isom\0\0\0\0")
+        self.media = bytes(range(256)) * 4
+        self.mdat = box(b"mdat", self.media)
+        self.media_offset = len(self.ftyp) + 8
+        # Chunk offsets of the media as stored in the file
+        self.chunks = [self.media_offset, self.media_offset + 512]
+        self.moov = moov(self.chunks)
+        self.free = box(b"free", b"\0" * 4)
+
+        self.path = temp_directory / "movie.mp4"
+        self.path.write_bytes(self.ftyp + self.mdat + self.moov + self.free)
+
+    def test_layout(self):
+        layout = buildFastStart(self.path, self.path.stat())
+
+        data = virtualBytes(layout, self.path)
+        moov_end = len(self.ftyp) + len(self.moov)
+
+        assert len(data) == self.path.stat().st_size
+        assert data[: len(self.ftyp)] == self.ftyp
+        assert data[len(self.ftyp) + 4 : len(self.ftyp) + 8] == b"moov"
+        assert data[moov_end:] == self.mdat + self.free
+
+    def test_chunks_point_at_media(self):
+        layout = buildFastStart(self.path, self.path.stat())
+        data = virtualBytes(layout, self.path)
+        relocated = data[len(self.ftyp) : len(self.ftyp) + len(self.moov)]
+
+        first, second = offsets(relocated, b"stco", "I")
+
+        assert data[first : first + 512] == self.media[:512]
+        assert data[second : second + 512] == self.media[512:]
+
+    @pytest.mark.parametrize("start,end", [(0, 9), (15, 40), (30, 300), (100, 1100)])
+    def test_ranges(self, start, end):
+        layout = buildFastStart(self.path, self.path.stat())
+        whole = virtualBytes(layout, self.path)
+
+        assert virtualBytes(layout, self.path, start, end) == whole[start : end + 1]
+
+    def test_range_within_media_reads_file(self):
+        layout = buildFastStart(self.path, self.path.stat())
+        start = len(self.ftyp) + len(self.moov) + 8
+
+        parts = layout.mapParts([Part(b"", start, start + 99)])
+
+        assert parts == [Part(b"", self.media_offset, self.media_offset + 99)]
+
+    def test_prefixes_are_kept(self):
+        layout = buildFastStart(self.path, self.path.stat())
+
+        parts = layout.mapParts([Part(b"head", 0, 3), Part(b"tail", 0, -1)])
+
+        assert parts == [Part(b"head", 0, 3), Part(b"tail", 0, -1)]
+
+    def test_etag_differs(self):
+        layout = buildFastStart(self.path, self.path.stat())
+
+        response = rangeResponse(
+            self.path, EnvironBuilder().get_environ(), layout=layout
+        )
+        plain = rangeResponse(self.path, EnvironBuilder().get_environ())
+
+        assert response.headers["ETag"] == layout.etag
+        assert response.headers["ETag"] != plain.headers["ETag"]
+        response.close()
+        plain.close()
+
+    def test_range_response(self):
+        layout = buildFastStart(self.path, self.path.stat())
+        whole = virtualBytes(layout, self.path)
+        environ = EnvironBuilder(headers={"Range": "bytes=10-49,-20"}).get_environ()
+
+        response = rangeResponse(self.path, environ, layout=layout)
+        body = b"".join(response.response)
+        response.close()
+
+        assert response.status_code == 206
+        assert len(body) == response.content_length
+        assert whole[10:50] in body
+        assert whole[-20:] in body
+
+    def test_already_fast_start(self):
+        self.path.write_bytes(self.ftyp + self.moov + self.mdat)
+
+        assert buildFastStart(self.path, self.path.stat()) is None
+
+    def test_fragmented(self):
+        self.path.write_bytes(self.ftyp + self.mdat + box(b"moof") + self.moov)
+
+        assert buildFastStart(self.path, self.path.stat()) is None
+
+    def test_moov_too_large(self, mocker):
+        mocker.patch("mp4.FASTSTART_MAX_MOOV", 10)
+
+        assert buildFastStart(self.path, self.path.stat()) is None
+
+    def test_cached(self, mocker):
+        mock_build = mocker.patch("mp4.buildFastStart", wraps=buildFastStart)
+
+        layout = fastStartLayout(self.path)
+
+        assert fastStartLayout(self.path) is layout
+        assert mock_build.call_count == 1
+        assert layoutCache.stats()["hits"] == 1
+
+    def test_cache_bounded_by_bytes(self, mocker):
+        layout = fastStartLayout(self.path)
+        mocker.patch.object(layoutCache, "maxbytes", layout.nbytes)
+        layoutCache.clear()
+        other = self.path.with_name("other.mp4")
+        other.write_bytes(self.path.read_bytes())
+
+        fastStartLayout(self.path)
+        fastStartLayout(other)
+
+        assert layoutCache.stats()["bytes"] == layout.nbytes
+        assert len(layoutCache) == 1
+
+    def test_rebuilt_when_file_changes(self):
+        layout = fastStartLayout(self.path)
+        self.path.write_bytes(self.ftyp + self.moov + self.mdat)
+
+        assert layout is not None
+        assert fastStartLayout(self.path) is None
+
+    def test_malformed_file(self):
+        self.path.write_bytes(b"not an mp4 at all")
+
+        assert fastStartLayout(self.path) is None
+
+    def test_disabled(self, mocker):
+        mocker.patch("mp4.FASTSTART_MP4", False)
+
+        assert fastStartLayout(self.path) is None
+
+    def test_other_files(self, temp_directory):
+        path = temp_directory / "movie.mkv"
+        path.write_bytes(self.path.read_bytes())
+
+        assert fastStartLayout(path) is None
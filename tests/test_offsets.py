@@ -0,0 +1,337 @@
+import time
+import pytest
+import sqlite3
+import threading
+import requests
+from offsets import OffsetStore, hasChanged
+
+
+class TestHasChanged:
+    @pytest.mark.parametrize(
+        "current,seen_edited,expected",
+        [
+            (
+                {"offset": 5, "date_edited": "2024-01-01T00:00:00Z"},
+                "2024-01-01T00:00:00+00:00",
+                False,
+            ),
+            (
+                {"offset": 5, "date_edited": "2024-01-02T00:00:00Z"},
+                "2024-01-01T00:00:00+00:00",
+                True,
+            ),
+            ({"offset": 13, "date_edited": "2024-01-02T00:00:00Z"}, None, False),
+            ({"offset": 13, "date_edited": None}, "2024-01-01T00:00:00Z", True),
+        ],
+    )
+    def test_hasChanged(self, current, seen_edited, expected):
+        assert hasChanged(current, seen_edited) is expected
+
+
+class TestOffsetStore:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.path = temp_directory / "offsets.db"
+        self.reader = mocker.MagicMock()
+        self.reader.return_value = {"offset": 7, "date_edited": None}
+        self.writer = mocker.MagicMock()
+        self.deleter = mocker.MagicMock()
+        self.store = self.makeStore()
+        yield
+        self.store.stop()
+
+    def makeStore(self, **kwargs):
+        kwargs.setdefault("sync_interval", 60)
+        kwargs.setdefault("write_interval", 0)
+        kwargs.setdefault("refresh_interval", 30)
+        return OffsetStore(
+            self.path,
+            reader=self.reader,
+            writer=self.writer,
+            deleter=self.deleter,
+            **kwargs,
+        )
+
+    def test_read_your_writes(self):
+        self.store.write("guid", "file", "12.5")
+
+        data = self.store.read("guid", "file")
+
+        assert data["offset"] == 12.5
+        assert data["date_edited"] is not None
+        assert not self.reader.called
+        assert not self.writer.called
+
+    def test_read_through(self):
+        assert self.store.read("guid", "file") == {"offset": 7, "date_edited": None}
+        assert self.store.read("guid", "file") == {"offset": 7, "date_edited": None}
+
+        self.reader.assert_called_once_with("file", "guid")
+
+    def test_refresh_after_interval(self):
+        store = self.makeStore(refresh_interval=0)
+
+        store.read("guid", "file")
+        store.read("guid", "file")
+
+        assert self.reader.call_count == 2
+
+    def test_serves_local_copy_when_unavailable(self):
+        store = self.makeStore(refresh_interval=0)
+        store.read("guid", "file")
+        self.reader.side_effect = requests.ConnectionError()
+
+        assert store.read("guid", "file") == {"offset": 7, "date_edited": None}
+
+    def test_unavailable_without_local_copy(self):
+        self.reader.side_effect = requests.ConnectionError()
+
+        with pytest.raises(requests.ConnectionError):
+            self.store.read("guid", "file")
+
+    def test_shared_between_stores(self):
+        self.store.write("guid", "file", 3)
+
+        assert self.makeStore().read("guid", "file")["offset"] == 3
+
+    def test_sync_sends_latest_write(self):
+        self.store.write("guid", "file", 10)
+        self.store.write("guid", "file", 20)
+
+        self.store.sync()
+
+        self.writer.assert_called_once_with("file", "guid", 20)
+        assert self.store.stats()["pending"] == 0
+        assert self.store.stats()["synced"] == 1
+
+    def test_writes_within_window_coalesce(self, mocker):
+        store = self.makeStore(write_interval=60)
+        store.write("guid", "file", 10)
+        store.sync()
+        self.writer.reset_mock()
+
+        for offset in (25, 40, 55):
+            store.write("guid", "file", offset)
+            store.sync()
+
+        assert not self.writer.called
+        assert store.stats()["pending"] == 1
+
+        mocker.patch("offsets.time.time", return_value=time.time() + 61)
+        store.sync()
+
+        self.writer.assert_called_once_with("file", "guid", 55)
+        assert store.stats()["pending"] == 0
+
+    def test_window_is_per_offset(self):
+        store = self.makeStore(write_interval=60)
+        store.write("guid", "file", 10)
+        store.sync()
+
+        store.write("guid", "other", 20)
+        store.sync()
+
+        assert self.writer.call_count == 2
+
+    def test_deletes_within_window_coalesce(self):
+        store = self.makeStore(write_interval=60)
+        for _ in range(3):
+            store.delete("guid", "file")
+            store.sync()
+
+        self.deleter.assert_called_once_with("file", "guid")
+
+    def test_stop_flushes_window(self):
+        store = self.makeStore(write_interval=60)
+        store.write("guid", "file", 10)
+        store.sync()
+        store.write("guid", "file", 20)
+        store.ensureStarted()
+
+        store.stop()
+
+        self.writer.assert_called_with("file", "guid", 20)
+        assert self.writer.call_count == 2
+
+    def test_sync_delete(self):
+        self.store.write("guid", "file", 10)
+        self.store.delete("guid", "file")
+
+        assert self.store.read("guid", "file") == {"offset": 0, "date_edited": None}
+
+        self.store.sync()
+
+        self.deleter.assert_called_once_with("file", "guid")
+        assert not self.writer.called
+        assert self.store.stats()["pending"] == 0
+
+    def test_sync_does_not_read(self):
+        self.store.write("guid", "file", 10)
+
+        self.store.sync()
+
+        self.writer.assert_called_once_with("file", "guid", 10)
+        assert not self.reader.called
+
+    def test_upstream_changed_since_read_wins(self):
+        store = self.makeStore(refresh_interval=0)
+        self.reader.return_value = {"offset": 7, "date_edited": "2024-01-01T00:00:00Z"}
+        store.read("guid", "file")
+        store.write("guid", "file", 10)
+        self.reader.return_value = {"offset": 99, "date_edited": "2024-01-02T00:00:00Z"}
+
+        assert store.read("guid", "file")["offset"] == 99
+        store.sync()
+
+        assert not self.writer.called
+        assert store.stats()["conflicts"] == 1
+        assert store.stats()["pending"] == 0
+
+    def test_unchanged_upstream_loses(self):
+        store = self.makeStore(refresh_interval=0)
+        self.reader.return_value = {"offset": 7, "date_edited": "2999-01-01T00:00:00Z"}
+        store.read("guid", "file")
+        store.write("guid", "file", 10)
+
+        assert store.read("guid", "file")["offset"] == 10
+        store.sync()
+
+        self.writer.assert_called_once_with("file", "guid", 10)
+        assert store.stats()["conflicts"] == 0
+
+    def test_normalized_offset_is_not_a_conflict(self):
+        store = self.makeStore(refresh_interval=0)
+        store.write("guid", "file", 10)
+        store.sync()
+        # MediaViewer stores our write rounded, stamped with its own clock
+        self.reader.return_value = {"offset": "10.00", "date_edited": "2999-01-01"}
+        store.read("guid", "file")
+        store.write("guid", "file", 20)
+
+        assert store.read("guid", "file")["offset"] == 20
+        store.sync()
+
+        self.writer.assert_called_with("file", "guid", 20)
+        assert store.stats()["conflicts"] == 0
+
+    def test_write_after_sync_stands_until_read(self):
+        store = self.makeStore(refresh_interval=0)
+        store.write("guid", "file", 10)
+        store.sync()
+        self.reader.return_value = {"offset": 50, "date_edited": "2000-01-01T00:00:00Z"}
+        store.write("guid", "file", 20)
+
+        assert store.read("guid", "file")["offset"] == 20
+        assert not self.reader.called
+
+    def test_upstream_changed_since_own_write_wins(self):
+        store = self.makeStore(refresh_interval=0)
+        store.write("guid", "file", 10)
+        store.sync()
+        self.reader.return_value = {"offset": 10, "date_edited": "2000-01-01T00:00:00Z"}
+        store.read("guid", "file")
+        self.reader.return_value = {"offset": 50, "date_edited": "2000-01-02T00:00:00Z"}
+        store.write("guid", "file", 20)
+
+        assert store.read("guid", "file")["offset"] == 50
+        store.sync()
+
+        assert self.writer.call_count == 1
+        assert store.stats()["conflicts"] == 1
+
+    def test_claimed_write_is_not_dropped(self):
+        store = self.makeStore(refresh_interval=0)
+        self.reader.return_value = {"offset": 7, "date_edited": "2024-01-01T00:00:00Z"}
+        store.read("guid", "file")
+        store.write("guid", "file", 10)
+        self.makeStore()._claim()
+        self.reader.return_value = {"offset": 99, "date_edited": "2024-01-02T00:00:00Z"}
+
+        assert store.read("guid", "file")["offset"] == 10
+        assert store.stats()["conflicts"] == 0
+
+    def test_adds_upstream_columns_to_old_databases(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE offsets (guid TEXT NOT NULL, filename TEXT NOT NULL, "
+            "offset NUMERIC, date_edited TEXT, "
+            "deleted INTEGER NOT NULL DEFAULT 0, dirty INTEGER NOT NULL DEFAULT 0, "
+            "synced REAL NOT NULL DEFAULT 0, claimed REAL NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (guid, filename))"
+        )
+        conn.close()
+
+        self.store.write("guid", "file", 10)
+        self.store.sync()
+
+        self.writer.assert_called_once_with("file", "guid", 10)
+
+    def test_unavailable_sync_is_retried(self):
+        self.store.write("guid", "file", 10)
+        self.writer.side_effect = requests.ConnectionError()
+
+        self.store.sync()
+
+        assert self.store.stats()["pending"] == 1
+        assert self.store.stats()["failed"] == 1
+
+        self.writer.side_effect = None
+        self.store.sync()
+
+        assert self.store.stats()["pending"] == 0
+
+    def test_rejected_write_is_dropped(self):
+        self.store.write("guid", "file", "abc")
+        self.writer.side_effect = ValueError("bad offset")
+
+        self.store.sync()
+
+        assert self.store.stats()["pending"] == 0
+        self.store.read("guid", "file")
+        self.reader.assert_called_with("file", "guid")
+
+    def test_write_during_sync_is_kept(self):
+        def write(filename, guid, offset):
+            self.store.write(guid, filename, 20)
+
+        self.store.write("guid", "file", 10)
+        self.writer.side_effect = write
+
+        self.store.sync()
+
+        assert self.store.stats()["pending"] == 1
+        assert self.store.read("guid", "file")["offset"] == 20
+
+    def test_claimed_rows_are_skipped(self):
+        self.store.write("guid", "file", 10)
+        self.makeStore()._claim()
+
+        self.store.sync()
+
+        assert not self.writer.called
+
+    def test_falls_back_to_upstream_on_sqlite_errors(self, mocker):
+        mocker.patch.object(
+            self.store, "_saveLocal", side_effect=sqlite3.OperationalError("locked")
+        )
+
+        self.store.write("guid", "file", 10)
+
+        self.writer.assert_called_once_with("file", "guid", 10)
+
+    def test_stop_syncs(self):
+        self.store.write("guid", "file", 10)
+
+        self.store.stop()
+
+        self.writer.assert_called_once_with("file", "guid", 10)
+
+    def test_background_sync(self):
+        synced = threading.Event()
+        self.writer.side_effect = lambda *args: synced.set()
+        store = self.makeStore(sync_interval=0.01)
+        try:
+            store.write("guid", "file", 10)
+            assert synced.wait(timeout=1)
+        finally:
+            store.stop()
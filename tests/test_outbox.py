@@ -0,0 +1,144 @@
+import pytest
+import sqlite3
+import threading
+import requests
+from outbox import ViewedOutbox
+
+
+class TestViewedOutbox:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.path = temp_directory / "outbox.db"
+        self.sender = mocker.MagicMock()
+        self.retry = mocker.MagicMock()
+        self.retry.backoff.return_value = 0
+        self.outbox = self.makeOutbox()
+        yield
+        self.outbox.stop()
+
+    def makeOutbox(self, **kwargs):
+        kwargs.setdefault("send_interval", 60)
+        kwargs.setdefault("retry", self.retry)
+        return ViewedOutbox(self.path, sender=self.sender, **kwargs)
+
+    def test_add_is_queued(self):
+        assert self.outbox.add("guid")
+
+        assert not self.sender.called
+        assert self.outbox.stats()["depth"] == 1
+
+    def test_dedupe_per_guid(self):
+        self.outbox.add("guid")
+        self.outbox.add("guid")
+        self.outbox.add("other")
+
+        self.outbox.send()
+
+        assert self.sender.call_count == 2
+        self.sender.assert_any_call("guid")
+        self.sender.assert_any_call("other")
+        assert self.outbox.stats()["delivered"] == 2
+        assert self.outbox.stats()["depth"] == 0
+
+    def test_batches(self):
+        outbox = self.makeOutbox(batch_size=2)
+        for i in range(5):
+            outbox.add(f"guid{i}")
+
+        outbox.send()
+
+        assert self.sender.call_count == 5
+
+    def test_unavailable_is_retried_later(self, mocker):
+        self.outbox.add("guid")
+        self.outbox.add("other")
+        self.sender.side_effect = requests.ConnectionError()
+        self.retry.backoff.return_value = 60
+
+        self.outbox.send()
+
+        self.sender.assert_called_once_with("guid")
+        assert self.outbox.stats()["depth"] == 2
+        assert self.outbox.stats()["retried"] == 1
+        self.retry.backoff.assert_called_once_with(1)
+
+        self.sender.reset_mock()
+        self.sender.side_effect = None
+        self.outbox.send()
+
+        # guid is waiting for its backoff, other is sent right away
+        self.sender.assert_called_once_with("other")
+
+    def test_retry_after_backoff(self):
+        self.outbox.add("guid")
+        self.sender.side_effect = [requests.ConnectionError(), None]
+
+        self.outbox.send()
+        self.outbox.send()
+
+        assert self.sender.call_count == 2
+        assert self.outbox.stats()["depth"] == 0
+
+    def test_gives_up_after_max_attempts(self):
+        outbox = self.makeOutbox(max_attempts=2)
+        outbox.add("guid")
+        self.sender.side_effect = requests.ConnectionError()
+
+        outbox.send()
+        outbox.send()
+
+        assert self.sender.call_count == 2
+        assert outbox.stats()["depth"] == 0
+        assert outbox.stats()["dropped"] == 1
+
+    def test_rejected_is_dropped(self):
+        response = requests.Response()
+        response.status_code = 404
+        self.sender.side_effect = requests.HTTPError(response=response)
+        self.outbox.add("guid")
+        self.outbox.add("other")
+
+        self.outbox.send()
+
+        assert self.sender.call_count == 2
+        assert self.outbox.stats()["depth"] == 0
+        assert self.outbox.stats()["dropped"] == 2
+
+    def test_claimed_are_skipped(self):
+        self.outbox.add("guid")
+        self.makeOutbox()._claim()
+
+        self.outbox.send()
+
+        assert not self.sender.called
+
+    def test_survives_restart(self):
+        self.outbox.add("guid")
+
+        self.makeOutbox().send()
+
+        self.sender.assert_called_once_with("guid")
+
+    def test_add_fails(self, mocker):
+        mocker.patch.object(
+            self.outbox, "_connection", side_effect=sqlite3.OperationalError("locked")
+        )
+
+        assert not self.outbox.add("guid")
+
+    def test_oldest(self, mocker):
+        mock_time = mocker.patch("outbox.time.time", return_value=100)
+        self.outbox.add("guid")
+        mock_time.return_value = 130
+
+        assert self.outbox.depth() == (1, 30)
+
+    def test_background_send(self):
+        sent = threading.Event()
+        self.sender.side_effect = lambda guid: sent.set()
+        outbox = self.makeOutbox(send_interval=0.01)
+        try:
+            outbox.add("guid")
+            assert sent.wait(timeout=1)
+        finally:
+            outbox.stop()
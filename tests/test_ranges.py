@@ -0,0 +1,287 @@
+import os
+import socket
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import FileWrapper
+from ranges import (
+    parseRanges,
+    rangeResponse,
+    fileETag,
+    FileParts,
+    SentFile,
+    Part,
+    MAX_RANGES,
+)
+
+
+class TestParseRanges:
+    @pytest.mark.parametrize(
+        "header,expected",
+        [
+            ("", None),
+            ("bytes=0-", [(0, 99)]),
+            ("bytes=10-19", [(10, 19)]),
+            ("bytes=90-200", [(90, 99)]),
+            ("bytes=-10", [(90, 99)]),
+            ("bytes=-200", [(0, 99)]),
+            ("bytes=abc", None),
+            ("bytes=20-10", None),
+            ("items=0-1", None),
+            ("bytes=0-1,5-6", [(0, 1), (5, 6)]),
+            ("bytes=5-6, 0-1", [(0, 1), (5, 6)]),
+            ("bytes=0-10,5-20", [(0, 20)]),
+            ("bytes=0-1,2-3", [(0, 3)]),
+            ("bytes=0-1,200-300", [(0, 1)]),
+            ("bytes=0-1,x-3", None),
+        ],
+    )
+    def test_valid(self, header, expected):
+        assert parseRanges(header, 100) == expected
+
+    @pytest.mark.parametrize("header", ["bytes=100-", "bytes=-0", "bytes=100-110,200-"])
+    def test_unsatisfiable(self, header):
+        with pytest.raises(ValueError):
+            parseRanges(header, 100)
+
+    def test_too_many_ranges(self):
+        header = "bytes=" + ",".join(
+            f"{i}-{i}" for i in range(0, 2 * MAX_RANGES + 2, 2)
+        )
+
+        assert parseRanges(header, 100) is None
+
+
+class TestRangeResponse:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.content = bytes(range(256)) * 4
+        self.file = temp_directory / "movie.mp4"
+        self.file.write_bytes(self.content)
+
+    def respond(self, headers=None, server="Werkzeug", file_wrapper=True, onClose=None):
+        environ = EnvironBuilder(headers=headers).get_environ()
+        environ["SERVER_SOFTWARE"] = server
+        if file_wrapper:
+            environ["wsgi.file_wrapper"] = FileWrapper
+        return rangeResponse(self.file, environ, onClose=onClose)
+
+    def body(self, response):
+        try:
+            return b"".join(response.response)
+        finally:
+            response.close()
+
+    def test_whole_file(self):
+        response = self.respond()
+
+        assert response.status_code == 200
+        assert response.content_length == 1024
+        assert response.mimetype == "video/mp4"
+        assert "Last-Modified" in response.headers
+        assert isinstance(response.response, FileWrapper)
+        assert self.body(response) == self.content
+
+    def test_open_ended_range_uses_file_wrapper(self):
+        response = self.respond({"Range": "bytes=1000-"})
+
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 1000-1023/1024"
+        assert response.content_length == 24
+        assert isinstance(response.response, FileWrapper)
+        assert self.body(response) == self.content[1000:]
+
+    def test_bounded_range_is_read_in_chunks(self):
+        response = self.respond({"Range": "bytes=10-19"})
+
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 10-19/1024"
+        assert response.content_length == 10
+        assert isinstance(response.response, FileParts)
+        assert self.body(response) == self.content[10:20]
+
+    def test_bounded_range_on_gunicorn_uses_file_wrapper(self):
+        response = self.respond({"Range": "bytes=10-19"}, server="gunicorn/23.0.0")
+
+        assert isinstance(response.response, FileWrapper)
+        assert response.response.file.tell() == 10
+        assert response.content_length == 10
+        response.close()
+
+    def test_no_file_wrapper(self):
+        response = self.respond(file_wrapper=False)
+
+        assert isinstance(response.response, FileParts)
+        assert self.body(response) == self.content
+
+    def test_suffix_range(self):
+        response = self.respond({"Range": "bytes=-100"})
+
+        assert response.headers["Content-Range"] == "bytes 924-1023/1024"
+        assert self.body(response) == self.content[-100:]
+
+    def test_unsatisfiable(self):
+        response = self.respond({"Range": "bytes=2000-"})
+
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == "bytes */1024"
+
+    def test_not_modified(self):
+        last_modified = self.respond().headers["Last-Modified"]
+
+        response = self.respond({"If-Modified-Since": last_modified})
+
+        assert response.status_code == 304
+
+    def test_etag(self):
+        response = self.respond()
+
+        assert response.headers["ETag"] == fileETag(self.file.stat())
+        response.close()
+
+    def test_etag_changes_with_file(self):
+        etag = self.respond().headers["ETag"]
+        self.file.write_bytes(self.content * 2)
+
+        assert self.respond().headers["ETag"] != etag
+
+    def test_if_none_match(self):
+        etag = self.respond().headers["ETag"]
+
+        response = self.respond({"If-None-Match": f'"other", W/{etag}'})
+
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+    def test_if_none_match_overrides_if_modified_since(self):
+        last_modified = self.respond().headers["Last-Modified"]
+
+        response = self.respond(
+            {"If-None-Match": '"other"', "If-Modified-Since": last_modified}
+        )
+
+        assert response.status_code == 200
+        response.close()
+
+    def test_if_range_matches(self):
+        etag = self.respond().headers["ETag"]
+
+        response = self.respond({"Range": "bytes=10-19", "If-Range": etag})
+
+        assert response.status_code == 206
+        assert self.body(response) == self.content[10:20]
+
+    def test_if_range_date_matches(self):
+        last_modified = self.respond().headers["Last-Modified"]
+
+        response = self.respond({"Range": "bytes=10-19", "If-Range": last_modified})
+
+        assert response.status_code == 206
+        response.close()
+
+    @pytest.mark.parametrize("if_range", ['"stale"', "Thu, 01 Jan 2015 00:00:00 GMT"])
+    def test_if_range_mismatch_sends_whole_file(self, if_range):
+        response = self.respond({"Range": "bytes=10-19", "If-Range": if_range})
+
+        assert response.status_code == 200
+        assert self.body(response) == self.content
+
+    def test_if_range_weak_etag_never_matches(self):
+        etag = self.respond().headers["ETag"]
+
+        response = self.respond({"Range": "bytes=10-19", "If-Range": f"W/{etag}"})
+
+        assert response.status_code == 200
+        response.close()
+
+    def test_multiple_ranges(self):
+        response = self.respond({"Range": "bytes=0-9,100-109"})
+
+        assert response.status_code == 206
+        assert response.mimetype == "multipart/byteranges"
+        boundary = response.mimetype_params["boundary"]
+        assert isinstance(response.response, FileParts)
+
+        body = self.body(response)
+
+        assert len(body) == response.content_length
+        assert body == (
+            f"--{boundary}\r\n"
+            "Content-Type: video/mp4\r\n"
+            "Content-Range: bytes 0-9/1024\r\n\r\n".encode()
+            + self.content[0:10]
+            + f"\r\n--{boundary}\r\n"
+            "Content-Type: video/mp4\r\n"
+            "Content-Range: bytes 100-109/1024\r\n\r\n".encode()
+            + self.content[100:110]
+            + f"\r\n--{boundary}--\r\n".encode()
+        )
+
+    def test_overlapping_ranges_are_merged(self):
+        response = self.respond({"Range": "bytes=0-9,5-19"})
+
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 0-19/1024"
+        assert self.body(response) == self.content[:20]
+
+    def test_range_ignored_for_head(self):
+        environ = EnvironBuilder(
+            method="HEAD", headers={"Range": "bytes=0-9"}
+        ).get_environ()
+
+        response = rangeResponse(self.file, environ)
+
+        assert response.status_code == 200
+        assert response.content_length == 1024
+        response.close()
+
+    @pytest.mark.parametrize("file_wrapper", [True, False])
+    def test_bytes_sent(self, file_wrapper, mocker):
+        onClose = mocker.MagicMock()
+        response = self.respond(file_wrapper=file_wrapper, onClose=onClose)
+
+        self.body(response)
+        response.close()
+
+        onClose.assert_called_once_with(1024)
+
+    def test_bytes_sent_until_client_went_away(self, mocker):
+        onClose = mocker.MagicMock()
+        body = FileParts(
+            open(self.file, "rb"), [Part(b"", 0, 1023)], block_size=100, onClose=onClose
+        )
+
+        it = iter(body)
+        next(it)
+        next(it)
+        body.close()
+
+        # The second block was handed over but never asked past
+        onClose.assert_called_once_with(100)
+
+    def test_bytes_sent_with_sendfile(self, mocker):
+        onClose = mocker.MagicMock()
+        response = self.respond(
+            {"Range": "bytes=10-19"}, server="gunicorn/23.0.0", onClose=onClose
+        )
+        filelike = response.response.file
+        assert isinstance(filelike, SentFile)
+
+        # What gunicorn does with the file_wrapper's file
+        offset = os.lseek(filelike.fileno(), 0, os.SEEK_CUR)
+        sock, peer = socket.socketpair()
+        with sock, peer:
+            sock.sendfile(filelike, offset=offset, count=10)
+            assert peer.recv(100) == self.content[10:20]
+        os.lseek(filelike.fileno(), offset, os.SEEK_SET)
+        response.close()
+
+        onClose.assert_called_once_with(10)
+
+    def test_empty_file(self):
+        self.file.write_bytes(b"")
+
+        response = self.respond()
+
+        assert response.status_code == 200
+        assert response.content_length == 0
+        assert self.body(response) == b""
@@ -0,0 +1,119 @@
+import pytest
+from timing import (
+    Timings,
+    span,
+    timed,
+    startTimings,
+    endTimings,
+    currentTimings,
+    serverTimingHeader,
+)
+from waiter import app
+
+
+class TestTimings:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_perf_counter = mocker.patch("timing.time.perf_counter")
+        self.mock_perf_counter.return_value = 10
+
+    def test_durations(self):
+        timings = Timings()
+        timings.record("token", 0.0123)
+        timings.record("token", 0.001)
+        timings.record("render", 0.002)
+        self.mock_perf_counter.return_value = 10.05
+
+        assert timings.durations() == {"token": 13.3, "render": 2.0, "total": 50.0}
+
+    def test_header(self):
+        assert (
+            serverTimingHeader({"token": 13.3, "total": 50.0})
+            == "token;dur=13.3, total;dur=50.0"
+        )
+
+    def test_span(self):
+        timings, token = startTimings()
+        with span("entry"):
+            self.mock_perf_counter.return_value = 10.004
+        endTimings(token)
+
+        assert currentTimings() is None
+        assert timings.durations()["entry"] == 4.0
+
+    def test_span_without_request(self):
+        with span("entry"):
+            pass
+
+        assert currentTimings() is None
+
+    def test_timed_generator(self):
+        @timed("entries")
+        def entries():
+            yield 1
+            self.mock_perf_counter.return_value = 10.003
+            yield 2
+
+        timings, token = startTimings()
+        assert list(entries()) == [1, 2]
+        endTimings(token)
+
+        assert timings.durations()["entries"] == 3.0
+
+    def test_timed_exception(self):
+        @timed("token")
+        def getToken():
+            self.mock_perf_counter.return_value = 10.001
+            raise ValueError("unavailable")
+
+        timings, token = startTimings()
+        with pytest.raises(ValueError):
+            getToken()
+        endTimings(token)
+
+        assert timings.durations()["token"] == 1.0
+
+
+class TestServerTimingHeader:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_requestTokenByGUID = mocker.patch("waiter._requestTokenByGUID")
+        self.mock_requestTokenByGUID.return_value = {
+            "isvalid": False,
+            "theme": "dark",
+        }
+        self.mock_logTimings = mocker.patch("waiter.logTimings")
+        self.client = app.test_client()
+
+    def test_page(self):
+        response = self.client.get("/waiter/file/guid/hash")
+
+        names = [
+            entry.split(";")[0]
+            for entry in response.headers["Server-Timing"].split(", ")
+        ]
+        assert names == ["token", "render", "total"]
+        assert not self.mock_logTimings.called
+
+    def test_disabled(self, mocker):
+        mocker.patch("waiter.SERVER_TIMING", False)
+
+        response = self.client.get("/waiter/status/")
+
+        assert "Server-Timing" not in response.headers
+
+    def test_log(self, mocker):
+        mocker.patch("waiter.SERVER_TIMING_LOG", True)
+
+        response = self.client.get("/waiter/file/guid/hash")
+
+        self.mock_logTimings.assert_called_once_with(
+            mocker.ANY,
+            method="GET",
+            path="/waiter/file/guid/hash",
+            route="file",
+            status=200,
+        )
+        durations = self.mock_logTimings.call_args[0][0]
+        assert list(durations) == ["token", "render", "total"]
+        assert response.headers["Server-Timing"]
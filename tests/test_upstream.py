@@ -0,0 +1,348 @@
+import pytest
+import mock
+import requests
+from upstream import (
+    UpstreamClient,
+    client,
+    BudgetExhausted,
+    CircuitBreaker,
+    CircuitOpen,
+    RetryPolicy,
+    isTransient,
+    isUnavailable,
+    startBudget,
+    endBudget,
+    remainingBudget,
+)
+
+
+@pytest.fixture
+def budget():
+    tokens = []
+
+    def _budget(seconds):
+        tokens.append(startBudget(seconds))
+
+    yield _budget
+
+    for token in reversed(tokens):
+        endBudget(token)
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+class TestUpstreamClient:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("upstream.WAITER_USERNAME", "TEST_WAITER_USERNAME")
+        mocker.patch("upstream.WAITER_PASSWORD", "TEST_WAITER_PASSWORD")
+        mocker.patch("upstream.VERIFY_REQUESTS", "TEST_VERIFY_REQUESTS")
+        mocker.patch("upstream.REQUESTS_TIMEOUT", 3)
+
+        self.client = UpstreamClient(pool_connections=2, pool_maxsize=5)
+        self.mock_request = mocker.patch.object(self.client.session, "request")
+
+    def test_shared_auth(self):
+        assert self.client.session.auth == (
+            "TEST_WAITER_USERNAME",
+            "TEST_WAITER_PASSWORD",
+        )
+        assert self.client.session.verify == "TEST_VERIFY_REQUESTS"
+
+    def test_pool_size(self):
+        assert self.client.adapter._pool_connections == 2
+        assert self.client.adapter._pool_maxsize == 5
+
+    def test_get(self):
+        actual = self.client.get("url")
+
+        assert actual == self.mock_request.return_value
+        self.mock_request.assert_called_once_with("GET", "url", timeout=3)
+
+    def test_post_with_timeout(self):
+        self.client.post("url", data={"a": 1}, timeout=1)
+
+        self.mock_request.assert_called_once_with(
+            "POST", "url", data={"a": 1}, timeout=1
+        )
+
+    def test_delete(self):
+        self.client.delete("url")
+
+        self.mock_request.assert_called_once_with("DELETE", "url", timeout=3)
+
+    def test_stats(self):
+        self.mock_request.side_effect = [
+            mock.MagicMock(status_code=200),
+            requests.ConnectionError(),
+        ]
+
+        self.client.get("url")
+        with pytest.raises(requests.ConnectionError):
+            self.client.get("url")
+
+        expected = {
+            "requests": 2,
+            "errors": 1,
+            "budget_exhausted": 0,
+            "breaker": {
+                "state": "closed",
+                "consecutive_failures": 1,
+                "retry_in": None,
+                "opened": 0,
+                "rejected": 0,
+            },
+            "pools": [],
+        }
+        assert expected == self.client.stats()
+
+    def test_budget_caps_timeout(self, budget):
+        budget(1)
+
+        self.client.get("url")
+
+        timeout = self.mock_request.call_args[1]["timeout"]
+        assert 0 < timeout <= 1
+
+    def test_budget_caps_connect_and_read_timeouts(self, budget):
+        budget(1)
+
+        self.client.get("url", timeout=(0.5, 5))
+
+        connect, read = self.mock_request.call_args[1]["timeout"]
+        assert connect == 0.5
+        assert 0 < read <= 1
+
+    def test_budget_exhausted(self, budget):
+        budget(0)
+
+        with pytest.raises(BudgetExhausted):
+            self.client.get("url")
+
+        assert not self.mock_request.called
+        assert self.client.stats()["budget_exhausted"] == 1
+
+    def test_breaker_opens_on_failures(self):
+        self.client.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        self.mock_request.side_effect = requests.ConnectionError()
+
+        for i in range(2):
+            with pytest.raises(requests.ConnectionError):
+                self.client.get("url")
+        with pytest.raises(CircuitOpen):
+            self.client.get("url")
+
+        assert self.mock_request.call_count == 2
+
+    def test_breaker_counts_server_errors(self):
+        self.client.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        self.mock_request.return_value = mock.MagicMock(status_code=502)
+
+        self.client.get("url")
+
+        assert self.client.breaker.state == CircuitBreaker.OPEN
+
+    def test_breaker_ignores_client_errors(self):
+        self.client.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        self.mock_request.return_value = mock.MagicMock(status_code=404)
+
+        self.client.get("url")
+
+        assert self.client.breaker.state == CircuitBreaker.CLOSED
+
+
+class TestCircuitBreaker:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.now = 1000
+        mocker.patch("upstream.time.monotonic", side_effect=lambda: self.now)
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+    def test_closed(self):
+        assert self.breaker.allow()
+        assert self.breaker.state == CircuitBreaker.CLOSED
+
+    def test_success_resets_failures(self):
+        for i in range(2):
+            self.breaker.recordFailure()
+        self.breaker.recordSuccess()
+        self.breaker.recordFailure()
+
+        assert self.breaker.state == CircuitBreaker.CLOSED
+
+    def test_opens_after_threshold(self):
+        for i in range(3):
+            self.breaker.recordFailure()
+
+        assert self.breaker.state == CircuitBreaker.OPEN
+        assert not self.breaker.allow()
+        assert self.breaker.stats()["rejected"] == 1
+        assert self.breaker.stats()["retry_in"] == 30
+
+    def test_half_open_allows_one_probe(self):
+        for i in range(3):
+            self.breaker.recordFailure()
+        self.now += 30
+
+        assert self.breaker.state == CircuitBreaker.HALF_OPEN
+        assert self.breaker.allow()
+        assert not self.breaker.allow()
+
+    def test_probe_success_closes(self):
+        for i in range(3):
+            self.breaker.recordFailure()
+        self.now += 30
+        self.breaker.allow()
+
+        self.breaker.recordSuccess()
+
+        assert self.breaker.state == CircuitBreaker.CLOSED
+        assert self.breaker.allow()
+
+    def test_probe_failure_reopens(self):
+        for i in range(3):
+            self.breaker.recordFailure()
+        self.now += 30
+        self.breaker.allow()
+
+        self.breaker.recordFailure()
+
+        assert self.breaker.state == CircuitBreaker.OPEN
+        assert self.breaker.stats()["opened"] == 1
+
+        self.now += 30
+        assert self.breaker.allow()
+
+    def test_release_frees_probe(self):
+        for i in range(3):
+            self.breaker.recordFailure()
+        self.now += 30
+        self.breaker.allow()
+
+        self.breaker.release()
+
+        assert self.breaker.allow()
+
+
+class TestBudget:
+    def test_no_budget(self):
+        assert remainingBudget() is None
+
+    def test_remaining(self, budget):
+        budget(5)
+
+        assert 4 < remainingBudget() <= 5
+
+    def test_end_restores_previous(self):
+        outer = startBudget(5)
+        inner = startBudget(1)
+        endBudget(inner)
+
+        assert remainingBudget() > 1
+
+        endBudget(outer)
+        assert remainingBudget() is None
+
+
+class TestIsTransient:
+    @pytest.mark.parametrize(
+        "exc,expected",
+        [
+            (requests.ConnectionError(), True),
+            (requests.ReadTimeout(), True),
+            (http_error(503), True),
+            (http_error(429), True),
+            (http_error(404), False),
+            (BudgetExhausted(), False),
+            (CircuitOpen(), False),
+            (requests.JSONDecodeError("msg", "doc", 0), False),
+            (ValueError(), False),
+        ],
+    )
+    def test_isTransient(self, exc, expected):
+        assert isTransient(exc) is expected
+
+    @pytest.mark.parametrize(
+        "exc,expected",
+        [
+            (CircuitOpen(), True),
+            (BudgetExhausted(), True),
+            (requests.ConnectionError(), True),
+            (http_error(404), False),
+            (ValueError(), False),
+        ],
+    )
+    def test_isUnavailable(self, exc, expected):
+        assert isUnavailable(exc) is expected
+
+
+class TestRetryPolicy:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_sleep = mocker.patch("upstream.time.sleep")
+        self.func = mocker.MagicMock(__name__="func")
+        self.policy = RetryPolicy(attempts=3, base=0.1, max_delay=1)
+
+    def test_success(self):
+        assert self.policy(self.func)("arg") == self.func.return_value
+
+        self.func.assert_called_once_with("arg")
+        assert not self.mock_sleep.called
+
+    def test_retries_transient(self):
+        self.func.side_effect = [requests.ConnectionError(), "result"]
+
+        assert self.policy(self.func)() == "result"
+
+        assert self.func.call_count == 2
+        assert self.policy.retries == 1
+        self.mock_sleep.assert_called_once()
+
+    def test_gives_up_after_attempts(self):
+        self.func.side_effect = requests.ConnectionError()
+
+        with pytest.raises(requests.ConnectionError):
+            self.policy(self.func)()
+
+        assert self.func.call_count == 3
+        assert self.mock_sleep.call_count == 2
+
+    def test_does_not_retry_permanent_errors(self):
+        self.func.side_effect = http_error(404)
+
+        with pytest.raises(requests.HTTPError):
+            self.policy(self.func)()
+
+        self.func.assert_called_once()
+        assert not self.mock_sleep.called
+
+    def test_stops_when_budget_is_spent(self, budget, mocker):
+        mocker.patch.object(self.policy, "backoff", return_value=0.5)
+        self.func.side_effect = requests.ConnectionError()
+        budget(0.1)
+
+        with pytest.raises(requests.ConnectionError):
+            self.policy(self.func)()
+
+        self.func.assert_called_once()
+        assert not self.mock_sleep.called
+
+    def test_backoff_is_capped_and_jittered(self):
+        for attempt in range(10):
+            delay = self.policy.backoff(attempt)
+            assert 0 <= delay <= min(1, 0.1 * 2**attempt)
+
+
+class TestClient:
+    def test_one_client_per_process(self):
+        assert client() is client()
+
+    def test_new_client_after_fork(self, mocker):
+        first = client()
+        mocker.patch("upstream.os.getpid", return_value=-1)
+
+        assert client() is not first
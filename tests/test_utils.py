@@ -1,11 +1,15 @@
 import pytest
 import mock
+import threading
+from concurrent.futures import TimeoutError
 from utils import (
     humansize,
     checkForValidToken,
     getMediaGenres,
+    Lookups,
 )
 from settings import REQUESTS_TIMEOUT
+from upstream import startBudget, endBudget, remainingBudget
 
 
 class TestHumanSize:
@@ -109,7 +113,7 @@ class TestGetMediaGenres:
     def setUp(self, mocker):
         mocker.patch("utils.MEDIAVIEWER_BASE_URL", "base_url")
 
-        self.mock_get = mocker.patch("utils.requests.get")
+        self.mock_get = mocker.patch("utils.client").return_value.get
 
         self.mock_resp = mock.MagicMock()
         self.mock_resp.json.return_value = {
@@ -147,3 +151,71 @@ class TestGetMediaGenres:
             "base_url/ajaxgenres/test_guid/", timeout=REQUESTS_TIMEOUT
         )
         assert expected == actual
+
+    def test_cached(self):
+        first = getMediaGenres(self.test_guid)
+        second = getMediaGenres(self.test_guid)
+
+        assert first == second
+        self.mock_get.assert_called_once_with(
+            "base_url/ajaxgenres/test_guid/", timeout=REQUESTS_TIMEOUT
+        )
+
+
+class TestLookups:
+    def test_results_by_name(self):
+        lookups = Lookups(1)
+        lookups.submit("a", lambda x: x + 1, 1)
+        lookups.submit("b", lambda x: x * 3, 2)
+
+        assert lookups.result("a") == 2
+        assert lookups.result("b") == 6
+
+    def test_runs_concurrently(self):
+        started = threading.Event()
+
+        def first():
+            return started.wait(timeout=1)
+
+        def second():
+            started.set()
+            return True
+
+        lookups = Lookups(2)
+        lookups.submit("first", first)
+        lookups.submit("second", second)
+
+        assert lookups.result("first") is True
+        assert lookups.result("second") is True
+
+    def test_exception_is_raised(self):
+        def fail():
+            raise ValueError("bad lookup")
+
+        lookups = Lookups(1)
+        lookups.submit("fail", fail)
+
+        with pytest.raises(ValueError):
+            lookups.result("fail")
+
+    def test_shared_deadline(self):
+        release = threading.Event()
+        lookups = Lookups(0.05)
+        lookups.submit("slow", release.wait, 1)
+
+        try:
+            with pytest.raises(TimeoutError):
+                lookups.result("slow")
+            assert lookups.remaining() == 0
+        finally:
+            release.set()
+
+    def test_shares_callers_budget(self):
+        token = startBudget(5)
+        try:
+            lookups = Lookups(1)
+            lookups.submit("remaining", remainingBudget)
+
+            assert 0 < lookups.result("remaining") <= 5
+        finally:
+            endBudget(token)
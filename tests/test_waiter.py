@@ -1,17 +1,33 @@
+import os
+import time
 import pytest
+import threading
 from pathlib import Path
 from waiter import (
     isAlfredEncoding,
     getTokenByGUID,
+    invalidateToken,
     get_dirPath,
     buildEntries,
     _buildFileDictHelper,
+    _isCandidateFile,
+    _getFileEntryFromHash,
     send_file_for_download,
     get_file,
     get_status,
+    send_file_partial,
+    app,
+    tokenCache,
+    pageCache,
 )
+from upstream import remainingBudget, CircuitOpen
+from offsets import OffsetStore
+from listing import Listing, MediaFile
+from utils import hashed_filename
 from settings import REQUESTS_TIMEOUT, DEFAULT_THEME
 import mock
+import requests
+import waiter
 
 
 class TestIsAlfredEncoding:
@@ -34,12 +50,9 @@ class TestGetTokenByGUID:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
         mocker.patch("waiter.MEDIAVIEWER_GUID_URL", "TEST_GUID_URL%(guid)s")
-        mocker.patch("waiter.WAITER_USERNAME", "TEST_WAITER_USERNAME")
-        mocker.patch("waiter.WAITER_PASSWORD", "TEST_WAITER_PASSWORD")
-        mocker.patch("waiter.VERIFY_REQUESTS", "TEST_VERIFY_REQUESTS")
 
-        self.requests_patcher = mock.patch("waiter.requests")
-        self.mock_requests = self.requests_patcher.start()
+        self.mock_client = mocker.patch("waiter.client")
+        self.mock_requests = self.mock_client.return_value
         self.mock_get_result = mock.MagicMock()
         self.mock_requests.get.return_value = self.mock_get_result
 
@@ -50,21 +63,96 @@ class TestGetTokenByGUID:
 
         self.mock_requests.get.assert_called_once_with(
             "TEST_GUID_URL_url",
-            auth=("TEST_WAITER_USERNAME", "TEST_WAITER_PASSWORD"),
-            verify="TEST_VERIFY_REQUESTS",
             timeout=REQUESTS_TIMEOUT,
         )
         self.mock_get_result.json.assert_called_once_with()
         assert expected == actual
 
+    def test_cached(self):
+        self.mock_get_result.json.return_value = {"isvalid": True}
+
+        first = getTokenByGUID("guid")
+        second = getTokenByGUID("guid")
+
+        assert first == second == {"isvalid": True}
+        self.mock_requests.get.assert_called_once()
+
+    def test_invalidate(self):
+        self.mock_get_result.json.return_value = {"isvalid": True}
+
+        getTokenByGUID("guid")
+        invalidateToken("guid")
+        getTokenByGUID("guid")
+
+        assert self.mock_requests.get.call_count == 2
+
+    def test_invalid_token_uses_negative_ttl(self, mocker):
+        mock_set = mocker.patch("waiter.tokenCache.set")
+        mocker.patch("waiter.TOKEN_CACHE_NEGATIVE_TTL", 1)
+        self.mock_get_result.json.return_value = {"isvalid": False}
+
+        getTokenByGUID("guid")
+
+        mock_set.assert_called_once_with("guid", {"isvalid": False}, ttl=1)
+
+    def test_serves_last_good_token_when_unavailable(self, mocker):
+        self.mock_get_result.json.return_value = {"isvalid": True}
+        getTokenByGUID("guid")
+        tokenCache.clear()
+        self.mock_requests.get.side_effect = CircuitOpen()
+
+        assert getTokenByGUID("guid") == {"isvalid": True}
+
+    def test_unavailable_without_last_good_token(self):
+        self.mock_requests.get.side_effect = CircuitOpen()
+
+        with pytest.raises(CircuitOpen):
+            getTokenByGUID("guid")
+
+    def test_invalid_token_is_not_served_stale(self):
+        self.mock_get_result.json.return_value = {"isvalid": True}
+        getTokenByGUID("guid")
+        tokenCache.clear()
+        self.mock_get_result.json.return_value = {"isvalid": False}
+        getTokenByGUID("guid")
+        tokenCache.clear()
+        self.mock_requests.get.side_effect = CircuitOpen()
+
+        with pytest.raises(CircuitOpen):
+            getTokenByGUID("guid")
+
+    def test_retries_server_errors(self, mocker):
+        mocker.patch("upstream.time.sleep")
+        failed = mock.MagicMock(status_code=503)
+        failed.raise_for_status.side_effect = requests.HTTPError(response=failed)
+        self.mock_get_result.status_code = 200
+        self.mock_get_result.json.return_value = {"isvalid": True}
+        self.mock_requests.get.side_effect = [failed, self.mock_get_result]
+
+        assert getTokenByGUID("guid") == {"isvalid": True}
+        assert self.mock_requests.get.call_count == 2
+
+    def test_does_not_retry_bad_responses(self, mocker):
+        mock_sleep = mocker.patch("upstream.time.sleep")
+        self.mock_get_result.status_code = 200
+        self.mock_get_result.json.side_effect = ValueError("not json")
+
+        with pytest.raises(ValueError):
+            getTokenByGUID("guid")
+
+        self.mock_requests.get.assert_called_once()
+        assert not mock_sleep.called
+
 
 class TestGetDirPath:
     @pytest.fixture(autouse=True)
-    def setUp(self, mocker):
+    def setUp(self, mocker, request_context):
         mocker.patch("waiter.EXTERNAL_MEDIAVIEWER_BASE_URL", "BASE_URL")
         mocker.patch("waiter.WAITER_OFFSET_URL", "OFFSET_URL")
         self.mock_getTokenByGUID = mocker.patch("waiter.getTokenByGUID")
         self.mock_render_template = mocker.patch("waiter.render_template")
+        self.mock_getListing = mocker.patch("waiter._getListing")
+        self.mock_getListing.return_value = (mocker.MagicMock(), None)
         self.mock_buildEntries = mocker.patch("waiter.buildEntries")
         self.mock_buildEntries.return_value = [
             {
@@ -92,9 +180,11 @@ class TestGetDirPath:
         self.mock_getTokenByGUID.side_effect = Exception("Fake Error")
 
         expected = (self.mock_render_template.return_value, 400)
-        actual = get_dirPath(self.test_guid)
+        # As Flask calls it
+        actual = get_dirPath(guid=self.test_guid)
 
         assert expected == actual
+        self.mock_getTokenByGUID.assert_called_once_with(self.test_guid)
         self.mock_render_template.assert_called_once_with(
             "error.html",
             title="Error",
@@ -141,6 +231,9 @@ class TestGetDirPath:
         self.mock_checkForValidToken.assert_called_once_with(
             self.mock_getTokenByGUID.return_value, self.test_guid
         )
+        self.mock_buildEntries.assert_called_once_with(
+            self.mock_getTokenByGUID.return_value, self.mock_getListing.return_value
+        )
         self.mock_getMediaGenres.assert_called_once_with(self.test_guid)
         self.mock_render_template.assert_called_once_with(
             "display.html",
@@ -205,13 +298,13 @@ class TestGetDirPath:
 class TestBuildMovieEntries:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
-        self.mock_os = mocker.patch("waiter.os")
+        self.mock_listingCache = mocker.patch("waiter.listingCache")
         self.mock_buildFileDictHelper = mocker.patch("waiter._buildFileDictHelper")
         mocker.patch("waiter.BASE_PATH", "/base/path")
 
-        self.mock_os.path.join.side_effect = ["path/to/movie", "/base/path/to/movie"]
-        self.mock_os.walk.return_value = [
-            ("some_dir/path", [], ["file1", "file2", "file3"])
+        self.mock_listingCache.get.return_value.files = [
+            MediaFile(Path("some_dir/path"), filename, 100, ())
+            for filename in ("file1", "file2", "file3")
         ]
 
         self.token = {
@@ -228,15 +321,18 @@ class TestBuildMovieEntries:
         ]
         actual = list(buildEntries(self.token))
         assert expected == actual
+        self.mock_listingCache.get.assert_called_once_with(
+            Path("a/movie/path"), _isCandidateFile
+        )
 
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("some_dir/path"), "file1", self.token
+            Path("some_dir/path"), "file1", self.token, size=100, subtitles=()
         )
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("some_dir/path"), "file2", self.token
+            Path("some_dir/path"), "file2", self.token, size=100, subtitles=()
         )
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("some_dir/path"), "file3", self.token
+            Path("some_dir/path"), "file3", self.token, size=100, subtitles=()
         )
 
     def test_no_valid_files(self):
@@ -245,18 +341,80 @@ class TestBuildMovieEntries:
         expected = []
         actual = list(buildEntries(self.token))
         assert expected == actual
+        self.mock_listingCache.get.assert_called_once_with(
+            Path("a/movie/path"), _isCandidateFile
+        )
 
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("some_dir/path"), "file1", self.token
+            Path("some_dir/path"), "file1", self.token, size=100, subtitles=()
         )
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("some_dir/path"), "file2", self.token
+            Path("some_dir/path"), "file2", self.token, size=100, subtitles=()
         )
         self.mock_buildFileDictHelper.assert_any_call(
-            Path("some_dir/path"), "file3", self.token
+            Path("some_dir/path"), "file3", self.token, size=100, subtitles=()
         )
 
 
+class TestBuildTvEntries:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.dir = temp_directory
+        mocker.patch("waiter.BASE_PATH", str(self.dir))
+        mocker.patch("waiter.MINIMUM_FILE_SIZE", 10)
+
+        self.season = self.dir / "tv" / "Some.Show"
+        self.season.mkdir(parents=True)
+        for episode in ("S01E01", "S01E02"):
+            (self.season / f"Some.Show.{episode}.mv-encoded.mp4").write_bytes(
+                b"x" * 100
+            )
+        (self.season / "Some.Show.S01E02.mv-encoded.en.vtt").write_text("WEBVTT")
+
+        self.token = {
+            "path": "/mnt/tv/Some.Show",
+            "filename": "Some.Show.S01E02.mv-encoded.mp4",
+            "guid": "guid",
+            "ismovie": False,
+            "displayname": "Some Show",
+            "videoprogresses": [],
+        }
+
+    def test_single_episode(self):
+        entries = list(buildEntries(self.token))
+
+        assert len(entries) == 1
+        assert entries[0]["unhashedPath"] == self.season / self.token["filename"]
+        assert entries[0]["rawSize"] == 100
+        assert [s.path for s in entries[0]["subtitleFiles"]] == [
+            self.season / "Some.Show.S01E02.mv-encoded.en.vtt"
+        ]
+
+    def test_missing_episode(self):
+        self.token["filename"] = "Some.Show.S01E03.mv-encoded.mp4"
+
+        with pytest.raises(FileNotFoundError):
+            list(buildEntries(self.token))
+
+    def test_episode_missing_from_listing(self, mocker):
+        episode = "Some.Show.S01E03.mv-encoded.mp4"
+        (self.season / episode).write_bytes(b"x" * 100)
+        (self.season / "Some.Show.S01E03.mv-encoded.en.vtt").write_text("WEBVTT")
+        (self.season / "Some.Show.S01E03.mv-encoded-extras.vtt").write_text("WEBVTT")
+        (self.season / "Other.Some.Show.S01E03.mv-encoded.vtt").write_text("WEBVTT")
+        self.token["filename"] = episode
+        mocker.patch(
+            "waiter._getListing", return_value=(Listing(self.season, [], {}), episode)
+        )
+
+        entries = list(buildEntries(self.token))
+
+        assert entries[0]["unhashedPath"] == self.season / episode
+        assert [s.path for s in entries[0]["subtitleFiles"]] == [
+            self.season / "Some.Show.S01E03.mv-encoded.en.vtt"
+        ]
+
+
 class TestBuildFileDictHelper:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
@@ -300,7 +458,7 @@ class TestBuildFileDictHelper:
 
 class TestSendFileForDownload:
     @pytest.fixture(autouse=True)
-    def setUp(self, mocker):
+    def setUp(self, mocker, request_context):
         mocker.patch("waiter.EXTERNAL_MEDIAVIEWER_BASE_URL", "BASE_URL")
         mocker.patch("waiter.BASE_PATH", "BASE_PATH")
         self.mock_getTokenByGUID = mocker.patch("waiter.getTokenByGUID")
@@ -309,6 +467,8 @@ class TestSendFileForDownload:
         self.mock_buildEntries = mocker.patch("waiter.buildEntries")
         self.mock_hashed_filename = mocker.patch("waiter.hashed_filename")
         self.mock_send_file_partial = mocker.patch("waiter.send_file_partial")
+        self.mock_getListing = mocker.patch("waiter._getListing")
+        self.mock_buildFileDictHelper = mocker.patch("waiter._buildFileDictHelper")
 
         self.token = {
             "path": "test_path",
@@ -317,14 +477,16 @@ class TestSendFileForDownload:
         }
         self.mock_getTokenByGUID.return_value = self.token
         self.mock_checkForValidToken.return_value = None
-        self.mock_buildEntries.return_value = [
-            {
-                "hashedWaiterPath": "hashPath",
-                "unhashedPath": Path("unhashed/path/to/file"),
-                "rawSize": 100,
-            }
-        ]
-        self.mock_hashed_filename.return_value = "hashPath"
+
+        self.media_file = MediaFile(Path("unhashed/path/to"), "file", 100, ())
+        self.mock_listing = mock.MagicMock()
+        self.mock_listing.hashIndex.return_value = {"hashPath": (self.media_file, None)}
+        self.mock_getListing.return_value = (self.mock_listing, "file")
+        self.mock_buildFileDictHelper.return_value = {
+            "hashedWaiterPath": "hashPath",
+            "unhashedPath": Path("unhashed/path/to/file"),
+            "rawSize": 100,
+        }
 
     def test_handle_exception(self):
         self.mock_checkForValidToken.side_effect = Exception("some error")
@@ -358,23 +520,28 @@ class TestSendFileForDownload:
 
     def test_movie_file(self):
         self.token["ismovie"] = True
+        self.mock_getListing.return_value = (self.mock_listing, None)
 
         expected = self.mock_send_file_partial.return_value
         actual = send_file_for_download("guid", "hashPath")
         assert expected == actual
-        self.mock_buildEntries.assert_called_once_with(self.token)
+        self.mock_getListing.assert_called_once_with(self.token)
+        self.mock_listing.hashIndex.assert_called_once_with("test_filename")
+        assert not self.mock_buildEntries.called
         assert not self.mock_hashed_filename.called
         self.mock_send_file_partial.assert_called_once_with(
-            Path("unhashed/path/to/file"), "file", 100
+            Path("unhashed/path/to/file"), "file"
         )
 
     def test_bad_movie_file(self):
         self.token["ismovie"] = True
+        self.mock_getListing.return_value = (self.mock_listing, None)
 
         expected = self.mock_render_template.return_value, 400
         actual = send_file_for_download("guid", "badHashPath")
         assert expected == actual
-        self.mock_buildEntries.assert_called_once_with(self.token)
+        self.mock_getListing.assert_called_once_with(self.token)
+        assert not self.mock_buildEntries.called
         assert not self.mock_hashed_filename.called
         assert not self.mock_send_file_partial.called
         self.mock_render_template.assert_called_once_with(
@@ -390,16 +557,84 @@ class TestSendFileForDownload:
         expected = self.mock_send_file_partial.return_value
         actual = send_file_for_download("guid", "hashPath")
         assert expected == actual
-        assert self.mock_buildEntries.called
+        assert self.mock_getListing.called
+        assert not self.mock_buildEntries.called
         assert not self.mock_hashed_filename.called
         self.mock_send_file_partial.assert_called_once_with(
-            Path("unhashed/path/to/file"), "file", 100
+            Path("unhashed/path/to/file"), "file"
         )
 
+    def test_tv_file_from_other_episode(self):
+        self.mock_getListing.return_value = (self.mock_listing, "other_episode")
+
+        expected = self.mock_render_template.return_value, 400
+        actual = send_file_for_download("guid", "hashPath")
+        assert expected == actual
+        assert not self.mock_send_file_partial.called
+
+
+class TestGetFileEntryFromHash:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.dir = temp_directory
+        mocker.patch("waiter.MINIMUM_FILE_SIZE", 10)
+
+        self.movie = self.dir / "Some.Movie.mv-encoded.mp4"
+        self.movie.write_bytes(b"x" * 100)
+        self.subtitle = self.dir / "Some.Movie.mv-encoded.en.vtt"
+        self.subtitle.write_text("WEBVTT")
+        (self.dir / "Small.mv-encoded.mp4").write_bytes(b"x")
+        (self.dir / "Small.mv-encoded.vtt").write_text("WEBVTT")
+        past = time.time() - 60
+        os.utime(self.dir, (past, past))
+
+        self.token = {
+            "path": str(self.dir),
+            "filename": "Some.Movie",
+            "guid": "guid",
+            "ismovie": True,
+            "displayname": "Some Movie",
+            "videoprogresses": [],
+        }
+
+    def test_media_file(self):
+        hashPath = hashed_filename("Some.Movie/Some.Movie.mv-encoded.mp4")
+
+        entry = _getFileEntryFromHash(self.token, hashPath)
+
+        assert entry["unhashedPath"] == self.movie
+        assert entry["hashedWaiterPath"] == hashPath
+        assert entry["rawSize"] == 100
+
+    def test_subtitle_file(self):
+        hashPath = hashed_filename("Some.Movie/Some.Movie.mv-encoded.en.vtt")
+
+        entry = _getFileEntryFromHash(self.token, hashPath)
+
+        assert entry == {"unhashedPath": self.subtitle, "rawSize": 6}
+
+    def test_reuses_index(self, mocker):
+        hashPath = hashed_filename("Some.Movie/Some.Movie.mv-encoded.mp4")
+        _getFileEntryFromHash(self.token, hashPath)
+        mock_hashed_filename = mocker.patch("listing.hashed_filename")
+
+        _getFileEntryFromHash(self.token, hashPath)
+
+        assert not mock_hashed_filename.called
+
+    def test_small_file_not_found(self):
+        for name in ("Small.mv-encoded.mp4", "Small.mv-encoded.vtt"):
+            with pytest.raises(Exception):
+                _getFileEntryFromHash(self.token, hashed_filename(f"Some.Movie/{name}"))
+
+    def test_unknown_hash(self):
+        with pytest.raises(Exception):
+            _getFileEntryFromHash(self.token, "not_a_hash")
+
 
 class TestGetFile:
     @pytest.fixture(autouse=True)
-    def setUp(self, mocker):
+    def setUp(self, mocker, request_context):
         self.EXTERNAL_MEDIAVIEWER_BASE_URL_patcher = mocker.patch(
             "waiter.EXTERNAL_MEDIAVIEWER_BASE_URL", "BASE_URL"
         )
@@ -596,3 +831,364 @@ class TestGetStatus:
         expected = ({"status": False}, 500)
         actual = get_status()
         assert expected == actual
+
+
+class TestXSendFile:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        mocker.patch("waiter.USE_NGINX", True)
+        self.file = temp_directory / "movie.mp4"
+        self.file.write_bytes(b"x" * 1024)
+
+    def get(self, headers=None):
+        with app.test_request_context(headers=headers):
+            return send_file_partial(self.file, "movie.mp4")
+
+    def test_redirect(self):
+        response = self.get({"Range": "bytes=0-1,10-19"})
+
+        assert response.status_code == 200
+        assert response.headers["X-Accel-Redirect"] == (
+            f"/download/{str(self.file).split('/', 3)[-1]}"
+        )
+        assert response.headers["X-Accel-Buffering"] == "no"
+        assert response.mimetype == "video/mp4"
+        assert "ETag" in response.headers
+        assert "Content-Range" not in response.headers
+
+    def test_not_modified(self):
+        etag = self.get().headers["ETag"]
+
+        response = self.get({"If-None-Match": etag})
+
+        assert response.status_code == 304
+        assert "X-Accel-Redirect" not in response.headers
+
+    def test_validators_match_nginx(self):
+        os.utime(self.file, (1700000000.5, 1700000000.5))
+
+        response = self.get()
+
+        # What nginx sends for the redirected file
+        assert response.headers["ETag"] == '"6553f100-400"'
+        assert response.headers["Last-Modified"] == "Tue, 14 Nov 2023 22:13:20 GMT"
+
+    def test_not_modified_by_nginx_etag(self):
+        os.utime(self.file, (1700000000.5, 1700000000.5))
+
+        response = self.get({"If-None-Match": '"6553f100-400"'})
+
+        assert response.status_code == 304
+
+    def test_unsatisfiable(self):
+        response = self.get({"Range": "bytes=5000-"})
+
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == "bytes */1024"
+        assert "X-Accel-Redirect" not in response.headers
+
+
+class TestUpstreamBudget:
+    def test_budget_lasts_for_one_request(self, mocker):
+        mocker.patch("waiter.UPSTREAM_REQUEST_BUDGET", 5)
+        seen = []
+        mock_client = mocker.patch("waiter.client")
+        mock_client.return_value.stats.side_effect = lambda: seen.append(
+            remainingBudget()
+        )
+
+        app.test_client().get("/waiter/status/upstream")
+
+        assert 4 < seen[0] <= 5
+        assert remainingBudget() is None
+
+
+class TestVideoOffset:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.reader = mocker.MagicMock(return_value={"offset": 1, "date_edited": None})
+        self.writer = mocker.MagicMock()
+        self.deleter = mocker.MagicMock()
+        self.store = OffsetStore(
+            temp_directory / "offsets.db",
+            reader=self.reader,
+            writer=self.writer,
+            deleter=self.deleter,
+            sync_interval=60,
+        )
+        mocker.patch("waiter.offsetStore", self.store)
+        self.client = app.test_client()
+        yield
+        self.store.stop()
+
+    def test_post_is_stored_locally(self):
+        resp = self.client.post("/waiter/offset/guid/file/", data={"offset": "12"})
+
+        assert resp.json == {"msg": "success"}
+        assert not self.writer.called
+
+    def test_get_reads_own_write(self):
+        self.client.post("/waiter/offset/guid/file/", data={"offset": "12"})
+
+        resp = self.client.get("/waiter/offset/guid/file/")
+
+        assert resp.json["offset"] == 12
+        assert not self.reader.called
+
+    def test_get_falls_through(self):
+        resp = self.client.get("/waiter/offset/guid/file/")
+
+        assert resp.json == {"offset": 1, "date_edited": None}
+        self.reader.assert_called_once_with("file", "guid")
+
+    def test_posts_within_window_sent_once(self):
+        for offset in ("12", "27", "42", "57"):
+            self.client.post("/waiter/offset/guid/file/", data={"offset": offset})
+            self.store.sync()
+
+        self.writer.assert_called_once_with("file", "guid", 12)
+        self.store.stop()
+        self.writer.assert_called_with("file", "guid", 57)
+        assert self.writer.call_count == 2
+
+    def test_pending_synced_without_new_write(self):
+        synced = threading.Event()
+        self.writer.side_effect = lambda *args: synced.set()
+        # Left behind by an earlier worker
+        self.store._saveLocal("guid", "file", 12, deleted=False)
+        self.store.sync_interval = 0.01
+
+        self.client.get("/waiter/status/")
+
+        assert synced.wait(timeout=1)
+        self.writer.assert_called_once_with("file", "guid", 12)
+
+    def test_delete(self, mocker):
+        mock_invalidateToken = mocker.patch("waiter.invalidateToken")
+        self.client.post("/waiter/offset/guid/file/", data={"offset": "12"})
+
+        resp = self.client.delete("/waiter/offset/guid/file/")
+        self.store.sync()
+
+        assert resp.json == {"msg": "deleted"}
+        self.deleter.assert_called_once_with("file", "guid")
+        assert not self.writer.called
+        assert not mock_invalidateToken.called
+
+    def test_delete_invalidates_token_showing_progress(self, mocker):
+        mock_invalidateToken = mocker.patch("waiter.invalidateToken")
+        tokenCache.set("guid", {"isvalid": True, "videoprogresses": ["file"]})
+        tokenCache.set("other", {"isvalid": True, "videoprogresses": []})
+
+        self.client.delete("/waiter/offset/guid/file/")
+        self.client.delete("/waiter/offset/other/file/")
+
+        mock_invalidateToken.assert_called_once_with("guid")
+
+
+class TestAjaxViewed:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, viewed_outbox):
+        mocker.patch("waiter.MEDIAVIEWER_VIEWED_URL", "VIEWED_URL")
+        self.mock_client = mocker.patch("waiter.client")
+        self.mock_invalidateToken = mocker.patch("waiter.invalidateToken")
+        self.outbox = viewed_outbox
+        self.client = app.test_client()
+
+    def test_acknowledged_immediately(self):
+        resp = self.client.post("/waiter/viewed/guid/")
+
+        assert resp.json == {"msg": "Viewed set successfully"}
+        assert not self.mock_client.called
+        assert self.outbox.stats()["depth"] == 1
+
+    def test_delivered(self):
+        self.client.post("/waiter/viewed/guid/")
+
+        self.outbox.send()
+
+        self.mock_client.return_value.post.assert_called_once_with(
+            "VIEWED_URL",
+            data={"viewed": True, "guid": "guid"},
+            timeout=REQUESTS_TIMEOUT,
+        )
+        self.mock_invalidateToken.assert_called_once_with("guid")
+
+    def test_pending_delivered_without_new_add(self):
+        delivered = threading.Event()
+        self.mock_client.return_value.post.side_effect = lambda *args, **kwargs: (
+            delivered.set()
+        )
+        # Left behind by an earlier worker
+        self.outbox._connection().execute(
+            "INSERT INTO viewed_outbox (guid, created) VALUES (?, ?)",
+            ("guid", time.time()),
+        )
+        self.outbox.send_interval = 0.01
+
+        self.client.get("/waiter/status/")
+
+        assert delivered.wait(timeout=1)
+
+    def test_sent_directly_when_outbox_fails(self, mocker):
+        mocker.patch.object(self.outbox, "add", return_value=False)
+
+        resp = self.client.post("/waiter/viewed/guid/")
+
+        assert resp.json == {"msg": "Viewed set successfully"}
+        self.mock_client.return_value.post.assert_called_once()
+
+
+class TestPageCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.dir = temp_directory
+        mocker.patch("waiter.MINIMUM_FILE_SIZE", 10)
+        (self.dir / "Some.Movie.mv-encoded.mp4").write_bytes(b"x" * 100)
+        past = time.time() - 60
+        os.utime(self.dir, (past, past))
+
+        self.token = {
+            "isvalid": True,
+            "ismovie": True,
+            "path": str(self.dir),
+            "filename": "Some.Movie",
+            "guid": "guid",
+            "displayname": "Some Movie",
+            "username": "some.user",
+            "tv_id": None,
+            "tv_name": None,
+            "videoprogresses": [],
+        }
+        self.mock_requestTokenByGUID = mocker.patch("waiter._requestTokenByGUID")
+        self.mock_requestTokenByGUID.side_effect = lambda guid: dict(self.token)
+        mocker.patch(
+            "utils._requestNavigationData",
+            return_value={"tv_genres": [], "movie_genres": [], "collections": []},
+        )
+        self.mock_render = mocker.spy(waiter, "render_template")
+        pageCache.clear()
+
+        self.client = app.test_client()
+
+    def test_etag(self):
+        response = self.client.get("/waiter/dir/guid/")
+
+        assert response.status_code == 200
+        assert response.get_etag() == (mock.ANY, False)
+        assert response.headers["Cache-Control"] == "private, no-cache"
+        assert self.mock_render.call_count == 1
+
+    def test_not_modified(self):
+        etag = self.client.get("/waiter/dir/guid/").headers["ETag"]
+
+        response = self.client.get("/waiter/dir/guid/", headers={"If-None-Match": etag})
+
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.data == b""
+        assert self.mock_render.call_count == 1
+
+    def test_served_from_cache(self):
+        first = self.client.get("/waiter/dir/guid/")
+
+        second = self.client.get("/waiter/dir/guid/")
+
+        assert second.status_code == 200
+        assert second.data == first.data
+        assert second.headers["ETag"] == first.headers["ETag"]
+        assert self.mock_render.call_count == 1
+
+    def test_token_change(self):
+        etag = self.client.get("/waiter/dir/guid/").headers["ETag"]
+        self.token["videoprogresses"] = [hashed_filename("Some.Movie/x")]
+        invalidateToken("guid")
+
+        response = self.client.get("/waiter/dir/guid/", headers={"If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert self.mock_render.call_count == 2
+
+    def test_listing_change(self):
+        etag = self.client.get("/waiter/dir/guid/").headers["ETag"]
+        (self.dir / "Other.Movie.mv-encoded.mp4").write_bytes(b"x" * 100)
+        waiter.listingCache.clear()
+
+        response = self.client.get("/waiter/dir/guid/", headers={"If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+    @pytest.mark.parametrize(
+        "path",
+        [
+            "/waiter/dir/guid/",
+            "/waiter/stream/guid/"
+            + hashed_filename("Some.Movie/Some.Movie.mv-encoded.mp4"),
+        ],
+    )
+    def test_inputs_looked_up_once(self, mocker, path):
+        mock_getTokenByGUID = mocker.spy(waiter, "getTokenByGUID")
+        mock_getListing = mocker.spy(waiter, "_getListing")
+        mock_lookups = mocker.spy(waiter, "_startNavigationLookups")
+
+        self.token["binge_mode"] = False
+
+        response = self.client.get(path)
+
+        assert response.status_code == 200
+        assert mock_getTokenByGUID.call_count == 1
+        assert mock_getListing.call_count == 1
+        assert mock_lookups.call_count == 1
+
+    def test_page_rendered_from_hashed_token(self, mocker):
+        titles = iter(["First Title", "Second Title"])
+        self.mock_requestTokenByGUID.side_effect = lambda guid: dict(
+            self.token, displayname=next(titles)
+        )
+        getListing = waiter._getListing
+
+        def expireToken(token):
+            # The token changes right after it was hashed
+            tokenCache.clear()
+            return getListing(token)
+
+        mocker.patch("waiter._getListing", side_effect=expireToken)
+
+        response = self.client.get("/waiter/dir/guid/")
+
+        assert b"First Title" in response.data
+        assert pageCache.get(response.get_etag()[0]) == response.data
+
+    def test_invalid_token_not_cached(self):
+        self.token["isvalid"] = False
+
+        response = self.client.get("/waiter/dir/guid/")
+
+        assert "ETag" not in response.headers
+        assert len(pageCache) == 0
+
+    def test_failed_token_fetched_once(self):
+        self.mock_requestTokenByGUID.side_effect = ValueError("bad response")
+
+        response = self.client.get("/waiter/dir/guid/")
+
+        assert response.status_code == 400
+        self.mock_requestTokenByGUID.assert_called_once_with("guid")
+
+    def test_error_not_cached(self):
+        response = self.client.get("/waiter/stream/guid/unknown")
+
+        assert response.status_code == 400
+        assert "ETag" not in response.headers
+        assert len(pageCache) == 0
+
+    def test_disabled(self, mocker):
+        mocker.patch("waiter.PAGE_CACHE", False)
+        self.client.get("/waiter/dir/guid/")
+
+        response = self.client.get("/waiter/dir/guid/")
+
+        assert "ETag" not in response.headers
+        assert self.mock_render.call_count == 2
@@ -0,0 +1,153 @@
+import time
+import struct
+import pytest
+import mock
+from pathlib import Path
+from watcher import (
+    Inotify,
+    InotifyUnavailable,
+    MediaWatcher,
+    parseEvents,
+    IN_CREATE,
+    IN_ISDIR,
+)
+
+
+def wait_for(condition, timeout=3):
+    expires = time.monotonic() + timeout
+    while time.monotonic() < expires:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def inotify_available():
+    try:
+        Inotify().close()
+    except InotifyUnavailable:
+        return False
+    return True
+
+
+class TestParseEvents:
+    def test_parse(self):
+        data = struct.pack("iIII", 1, IN_CREATE, 0, 8) + b"a.mp4\0\0\0"
+        data += struct.pack("iIII", 2, IN_CREATE | IN_ISDIR, 0, 0)
+
+        expected = [
+            (1, IN_CREATE, 0, "a.mp4"),
+            (2, IN_CREATE | IN_ISDIR, 0, ""),
+        ]
+        assert expected == list(parseEvents(data))
+
+
+@pytest.mark.skipif(not inotify_available(), reason="inotify is not available")
+class TestMediaWatcherInotify:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.dir = temp_directory
+        self.invalidate = mock.MagicMock()
+
+        self.watcher = MediaWatcher([self.dir], poll_interval=0.05)
+        self.watcher.subscribe(self.invalidate)
+        self.watcher.ensureStarted()
+        yield
+        self.watcher.stop()
+
+    def test_mode(self):
+        assert self.watcher.mode == "inotify"
+        assert self.watcher.covers(self.dir / "Movie")
+        assert not self.watcher.covers(Path("/somewhere/else"))
+
+    def test_new_file(self):
+        (self.dir / "movie.mp4").write_bytes(b"x")
+
+        assert wait_for(lambda: self.invalidate.called)
+        self.invalidate.assert_any_call(self.dir)
+
+    def test_new_directory_is_watched(self):
+        sub = self.dir / "Movie"
+        sub.mkdir()
+        assert wait_for(lambda: len(self.watcher._watches) == 2)
+
+        (sub / "movie.mp4").write_bytes(b"x")
+
+        assert wait_for(lambda: mock.call(sub) in self.invalidate.call_args_list)
+
+
+@pytest.mark.skipif(not inotify_available(), reason="inotify is not available")
+class TestMediaWatcherRoots:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.root = temp_directory / "Movies"
+        self.root.mkdir()
+        self.invalidate = mock.MagicMock()
+
+        self.watcher = MediaWatcher([self.root], poll_interval=0.05)
+        self.watcher.subscribe(self.invalidate)
+        self.watcher.ensureStarted()
+        yield
+        self.watcher.stop()
+
+    def test_deleted_root_not_covered(self):
+        self.root.rmdir()
+
+        assert wait_for(lambda: not self.watcher.covers(self.root / "Movie"))
+        self.invalidate.assert_any_call(self.root)
+
+    def test_moved_root_not_covered(self):
+        self.root.rename(self.root.with_name("Elsewhere"))
+
+        assert wait_for(lambda: not self.watcher.covers(self.root))
+        assert self.watcher._watches == {}
+
+    def test_root_watched_again(self):
+        self.root.rmdir()
+        assert wait_for(lambda: not self.watcher.covers(self.root))
+        self.invalidate.reset_mock()
+
+        self.root.mkdir()
+
+        assert wait_for(lambda: self.watcher.covers(self.root))
+        assert wait_for(lambda: mock.call(self.root) in self.invalidate.call_args_list)
+        (self.root / "movie.mp4").write_bytes(b"x")
+        assert wait_for(lambda: self.invalidate.call_count >= 2)
+
+    def test_missing_root_not_covered(self, temp_directory):
+        watcher = MediaWatcher([temp_directory / "missing"], poll_interval=0.05)
+        watcher.ensureStarted()
+        try:
+            assert watcher.mode == "inotify"
+            assert not watcher.covers(temp_directory / "missing")
+        finally:
+            watcher.stop()
+
+
+class TestMediaWatcherPolling:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory, mocker):
+        mocker.patch("watcher.Inotify", side_effect=InotifyUnavailable("nope"))
+        self.dir = temp_directory
+        self.invalidate = mock.MagicMock()
+        self.poll = mock.MagicMock()
+
+        self.watcher = MediaWatcher([self.dir], poll_interval=0.01)
+        self.watcher.subscribe(self.invalidate, poll=self.poll)
+        self.watcher.ensureStarted()
+        yield
+        self.watcher.stop()
+
+    def test_polls(self):
+        assert self.watcher.mode == "poll"
+        assert self.watcher.covers(self.dir)
+        assert wait_for(lambda: self.poll.call_count >= 2)
+
+
+class TestMediaWatcherDisabled:
+    def test_not_started(self, temp_directory):
+        watcher = MediaWatcher([temp_directory], enabled=False)
+        watcher.ensureStarted()
+
+        assert watcher.mode is None
+        assert not watcher.covers(temp_directory)
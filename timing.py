@@ -0,0 +1,115 @@
+import json
+import time
+import inspect
+import threading
+import contextvars
+
+from functools import wraps
+from contextlib import contextmanager
+from log import logger
+
+_current = contextvars.ContextVar("timings", default=None)
+
+
+class Timings:
+    """Time spent in each stage of one request, for the Server-Timing header.
+
+    Spans with the same name add up, e.g. every token lookup made while
+    serving the request. Stages run by Lookups overlap the rest of the
+    request, so the spans can add up to more than the total.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._spans[name] = self._spans.get(name, 0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def durations(self):
+        """Return the duration of every span and of the request so far, in ms"""
+        with self._lock:
+            spans = dict(self._spans)
+        spans["total"] = self.total()
+        return {name: round(seconds * 1000, 1) for name, seconds in spans.items()}
+
+
+def serverTimingHeader(durations):
+    """Format the result of Timings.durations() as a Server-Timing header"""
+    return ", ".join(f"{name};dur={duration}" for name, duration in durations.items())
+
+
+def logTimings(durations, **fields):
+    """Log the result of Timings.durations() with fields as one JSON line"""
+    logger().info("Request timing %s", json.dumps({**fields, "timings": durations}))
+
+
+def startTimings():
+    """Begin timing the request handled in the current context.
+
+    Returns the Timings and a token to hand back to endTimings().
+    """
+    timings = Timings()
+    return timings, _current.set(timings)
+
+
+def endTimings(token):
+    _current.reset(token)
+
+
+def currentTimings():
+    """The Timings of the current request or None outside of one"""
+    return _current.get()
+
+
+@contextmanager
+def span(name):
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.record(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """Record every call of the decorated function as a span called name.
+
+    Generator functions are timed until they are exhausted or closed.
+    """
+
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+
+            @wraps(func)
+            def gen_wrapper(*args, **kwargs):
+                with span(name):
+                    yield from func(*args, **kwargs)
+
+            return gen_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # Inlined span(), these wrap calls made on every request
+            timings = _current.get()
+            if timings is None:
+                return func(*args, **kwargs)
+
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.record(name, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
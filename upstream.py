@@ -0,0 +1,409 @@
+import os
+import time
+import random
+import functools
+import threading
+import contextvars
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from log import logger
+from metrics import upstreamLatency, upstreamErrors
+from settings import (
+    WAITER_USERNAME,
+    WAITER_PASSWORD,
+    VERIFY_REQUESTS,
+    REQUESTS_TIMEOUT,
+    UPSTREAM_POOL_CONNECTIONS,
+    UPSTREAM_POOL_MAXSIZE,
+    RETRY_ATTEMPTS,
+    RETRY_BACKOFF_BASE,
+    RETRY_BACKOFF_MAX,
+    UPSTREAM_BREAKER_THRESHOLD,
+    UPSTREAM_BREAKER_RESET,
+    MEDIAVIEWER_BASE_URL,
+)
+
+TRANSIENT_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Monotonic deadline shared by every upstream call made for the current
+# request. Lookups run on other threads inherit it through copy_context().
+_deadline = contextvars.ContextVar("upstream_deadline", default=None)
+
+
+class BudgetExhausted(requests.Timeout):
+    """The request's upstream time budget was spent before the call was made"""
+
+
+class CircuitOpen(requests.ConnectionError):
+    """MediaViewer is failing and calls are not being attempted"""
+
+
+def startBudget(seconds):
+    """Give the current context seconds to spend on upstream calls.
+
+    Returns a token to hand back to endBudget().
+    """
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def endBudget(token):
+    _deadline.reset(token)
+
+
+def remainingBudget():
+    """Seconds left in the current budget or None if there is no budget"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def _capTimeout(timeout, remaining):
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(_capTimeout(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+def isTransient(exc):
+    """Whether a failed upstream call is worth retrying"""
+    if isinstance(exc, (BudgetExhausted, CircuitOpen)):
+        return False
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, requests.HTTPError):
+        return (
+            exc.response is not None
+            and exc.response.status_code in TRANSIENT_STATUS_CODES
+        )
+    return False
+
+
+def isUnavailable(exc):
+    """Whether exc means MediaViewer could not answer, as opposed to it
+    answering with something we did not expect"""
+    return isinstance(exc, (BudgetExhausted, CircuitOpen)) or isTransient(exc)
+
+
+class CircuitBreaker:
+    """Stops calling MediaViewer while it is failing.
+
+    The breaker is closed while calls succeed. After failure_threshold
+    consecutive failures it opens and every call fails fast with CircuitOpen.
+    Once reset_timeout seconds have passed it is half-open: a single probe call
+    is let through, closing the breaker if it succeeds and opening it again if
+    it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        failure_threshold=UPSTREAM_BREAKER_THRESHOLD,
+        reset_timeout=UPSTREAM_BREAKER_RESET,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+        self.opened = 0
+        self.rejected = 0
+
+    def _currentState(self):
+        if (
+            self._state == self.OPEN
+            and time.monotonic() - self._opened_at >= self.reset_timeout
+        ):
+            return self.HALF_OPEN
+        return self._state
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._currentState()
+
+    def allow(self):
+        """Whether a call may be made now. A True in half-open state makes the
+        caller the probe, which must be followed by a record call."""
+        with self._lock:
+            state = self._currentState()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def recordSuccess(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self._state != self.CLOSED:
+                logger().info("MediaViewer recovered, closing circuit breaker")
+                self._state = self.CLOSED
+
+    def recordFailure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == self.OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger().warning(
+                        "MediaViewer failed %s times, opening circuit breaker",
+                        self._failures,
+                    )
+                    self.opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """End a call that says nothing about MediaViewer's health"""
+        with self._lock:
+            self._probing = False
+
+    def reset(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def stats(self):
+        with self._lock:
+            state = self._currentState()
+            retry_in = None
+            if state == self.OPEN:
+                retry_in = max(
+                    self.reset_timeout - (time.monotonic() - self._opened_at), 0
+                )
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "retry_in": retry_in,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+class RetryPolicy:
+    """Retry transient upstream failures with exponential backoff.
+
+    Delays use full jitter, a random wait between 0 and
+    min(max_delay, base * 2 ** attempt), so workers that failed together do
+    not retry together. No retry is attempted once its delay would not fit in
+    the remaining request budget.
+    """
+
+    _random = random.SystemRandom()
+
+    def __init__(
+        self,
+        attempts=RETRY_ATTEMPTS,
+        base=RETRY_BACKOFF_BASE,
+        max_delay=RETRY_BACKOFF_MAX,
+    ):
+        self.attempts = attempts
+        self.base = base
+        self.max_delay = max_delay
+        self.retries = 0
+
+    def backoff(self, attempt):
+        return self._random.uniform(0, min(self.max_delay, self.base * 2**attempt))
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrap(*args, **kwargs):
+            for attempt in range(self.attempts):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if not isTransient(e) or attempt == self.attempts - 1:
+                        raise
+
+                    delay = self.backoff(attempt)
+                    remaining = remainingBudget()
+                    if remaining is not None and delay >= remaining:
+                        logger().warning(
+                            "%s failed, no budget left to retry", func.__name__
+                        )
+                        raise
+
+                    logger().warning(
+                        "%s failed (%s), retrying in %.2fs", func.__name__, e, delay
+                    )
+                    self.retries += 1
+                    time.sleep(delay)
+
+        return wrap
+
+
+def endpointName(url):
+    """Name of the MediaViewer endpoint called by url, used to label metrics"""
+    path = urlsplit(url).path
+    base = urlsplit(MEDIAVIEWER_BASE_URL).path.rstrip("/")
+    if base and path.startswith(base + "/"):
+        path = path[len(base) :]
+    segments = [segment for segment in path.split("/") if segment]
+    if segments and segments[0] == "api":
+        segments = segments[1:]
+    return segments[0] if segments else "root"
+
+
+def _errorReason(exc):
+    if isinstance(exc, requests.Timeout):
+        return "timeout"
+    if isinstance(exc, requests.ConnectionError):
+        return "connection"
+    return "error"
+
+
+class UpstreamClient:
+    """Keep-alive HTTP client for every call made to MediaViewer.
+
+    All requests share one requests.Session so TCP/TLS connections are pooled
+    and reused instead of being set up for every call. Every call goes
+    through a CircuitBreaker; connection errors, timeouts and 429/5xx
+    responses count as failures.
+    """
+
+    def __init__(
+        self,
+        pool_connections=UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+        breaker=None,
+    ):
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=0,
+        )
+
+        self.session = requests.Session()
+        self.session.auth = (WAITER_USERNAME, WAITER_PASSWORD)
+        self.session.verify = VERIFY_REQUESTS
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.budget_exhausted = 0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", REQUESTS_TIMEOUT)
+
+        endpoint = endpointName(url)
+        remaining = remainingBudget()
+        if remaining is not None:
+            if remaining <= 0:
+                with self._lock:
+                    self.budget_exhausted += 1
+                upstreamErrors.inc(endpoint=endpoint, reason="budget_exhausted")
+                raise BudgetExhausted(f"No time left to {method} {url}")
+            kwargs["timeout"] = _capTimeout(kwargs["timeout"], remaining)
+
+        if not self.breaker.allow():
+            upstreamErrors.inc(endpoint=endpoint, reason="circuit_open")
+            raise CircuitOpen(
+                f"Not calling {method} {url} while MediaViewer is failing"
+            )
+
+        with self._lock:
+            self.requests += 1
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            upstreamLatency.observe(time.perf_counter() - start, endpoint=endpoint)
+            upstreamErrors.inc(endpoint=endpoint, reason=_errorReason(e))
+            with self._lock:
+                self.errors += 1
+            if isTransient(e):
+                self.breaker.recordFailure()
+            else:
+                self.breaker.release()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+
+        upstreamLatency.observe(time.perf_counter() - start, endpoint=endpoint)
+        if not response.ok:
+            upstreamErrors.inc(endpoint=endpoint, reason=str(response.status_code))
+        if response.status_code in TRANSIENT_STATUS_CODES:
+            self.breaker.recordFailure()
+        else:
+            self.breaker.recordSuccess()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def stats(self):
+        pools = []
+        poolmanager = self.adapter.poolmanager
+        for key in list(poolmanager.pools.keys()):
+            pool = poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append(
+                {
+                    "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                    "connections_opened": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "idle": pool.pool.qsize() if pool.pool else 0,
+                    "maxsize": pool.pool.maxsize if pool.pool else 0,
+                }
+            )
+
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "budget_exhausted": self.budget_exhausted,
+            "breaker": self.breaker.stats(),
+            "pools": pools,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class Upstream:
+    """Holds one UpstreamClient per worker process"""
+
+    _client = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def getClient(cls):
+        # Pooled sockets must not be shared with a forked child
+        if cls._client is None or cls._pid != os.getpid():
+            with cls._lock:
+                if cls._client is None or cls._pid != os.getpid():
+                    cls._client = UpstreamClient()
+                    cls._pid = os.getpid()
+        return cls._client
+
+
+def client():
+    return Upstream.getClient()
@@ -1,20 +1,27 @@
+import os
 import time
-import requests
+import threading
+import contextvars
 
+from concurrent.futures import ThreadPoolExecutor
 from log import logger
+from upstream import client
 from settings import (
     APP_NAME,
     MEDIAVIEWER_BASE_URL,
     MEDIAVIEWER_GUID_OFFSET_URL,
-    WAITER_USERNAME,
-    WAITER_PASSWORD,
-    VERIFY_REQUESTS,
     SECRET_KEY,
     MEDIAWAITER_PROTOCOL,
     HOST,
     PORT,
     REQUESTS_TIMEOUT,
+    NAVIGATION_CACHE_TTL,
+    NAVIGATION_CACHE_SIZE,
+    NAVIGATION_CACHE_MAX_AGE,
+    LOOKUP_POOL_SIZE,
 )
+from cache import StaleWhileRevalidateCache, sharedCache
+from timing import timed
 import hashlib
 
 
@@ -34,38 +41,71 @@ def humansize(nbytes):
     return f"{val} {suffixes[i]}"
 
 
-class delayedRetry:
-    def __init__(self, attempts=5, interval=1):
-        self.attempts = attempts
-        self.interval = interval
-
-    def __call__(self, func):
-        def wrap(*args, **kwargs):
-            logger().debug(f"Attempting {func.__name__}")
-            last_exc = None
-            for i in range(self.attempts):
-                try:
-                    logger().debug(f"Attempt {i}")
-                    res = func(*args, **kwargs)
-                    logger().debug("Success")
-                    return res
-                except Exception as e:
-                    logger().error(e)
-                    last_exc = e
-                time.sleep(self.interval)
-            else:
-                logger().error(f"Failure after {self.attempts} attempts")
-                raise last_exc
-
-        return wrap
+class LookupPool:
+    """Holds one bounded thread pool per worker process for upstream lookups"""
+
+    _executor = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def getExecutor(cls):
+        # Threads do not survive a fork so each worker builds its own pool
+        if cls._executor is None or cls._pid != os.getpid():
+            with cls._lock:
+                if cls._executor is None or cls._pid != os.getpid():
+                    cls._executor = ThreadPoolExecutor(
+                        max_workers=LOOKUP_POOL_SIZE,
+                        thread_name_prefix="lookup",
+                    )
+                    cls._pid = os.getpid()
+        return cls._executor
+
+
+navigationCache = StaleWhileRevalidateCache(
+    maxsize=NAVIGATION_CACHE_SIZE,
+    ttl=NAVIGATION_CACHE_TTL,
+    max_age=NAVIGATION_CACHE_MAX_AGE,
+    name="navigation",
+    shared=sharedCache("navigation", ttl=NAVIGATION_CACHE_MAX_AGE),
+    executor=LookupPool.getExecutor,
+)
+
+
+class Lookups:
+    """Run independent lookups concurrently and collect them by name.
+
+    All results share one deadline so the time spent waiting is bounded by the
+    slowest lookup instead of the sum of all of them. A lookup that has not
+    finished by the deadline raises concurrent.futures.TimeoutError.
+
+    Lookups run in a copy of the caller's context so they spend the caller's
+    upstream request budget.
+    """
+
+    def __init__(self, timeout):
+        self.expires = time.monotonic() + timeout
+        self._futures = {}
+
+    def submit(self, name, func, *args, **kwargs):
+        context = contextvars.copy_context()
+        self._futures[name] = LookupPool.getExecutor().submit(
+            context.run, func, *args, **kwargs
+        )
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0)
+
+    def result(self, name):
+        return self._futures[name].result(timeout=self.remaining())
 
 
 def checkForValidToken(token, guid):
     if not token:
-        logger().warn(f"Token is invalid GUID: {guid}")
+        logger().warning("Token is invalid GUID: %s", guid)
         return "This token is invalid! Return to Movie or TV Show tab to generate a new one."
     if not token["isvalid"]:
-        logger().warn(f"Token Expired GUID: {guid}")
+        logger().warning("Token Expired GUID: %s", guid)
         return "This token has expired! Return to Movie or TV Show tab to generate a new one."
 
 
@@ -86,10 +126,8 @@ def buildWaiterPath(place, guid, filePath, includeLastSlash=True):
 def getVideoOffset(filename, guid):
     data = {"offset": 0, "date_edited": None}
     try:
-        resp = requests.get(
+        resp = client().get(
             MEDIAVIEWER_GUID_OFFSET_URL % {"guid": guid, "filename": filename},
-            auth=(WAITER_USERNAME, WAITER_PASSWORD),
-            verify=VERIFY_REQUESTS,
             timeout=REQUESTS_TIMEOUT,
         )
         resp.raise_for_status()
@@ -106,10 +144,8 @@ def getVideoOffset(filename, guid):
 def setVideoOffset(filename, guid, offset):
     data = {"offset": offset}
     try:
-        resp = requests.post(
+        resp = client().post(
             MEDIAVIEWER_GUID_OFFSET_URL % {"guid": guid, "filename": filename},
-            auth=(WAITER_USERNAME, WAITER_PASSWORD),
-            verify=VERIFY_REQUESTS,
             data=data,
             timeout=REQUESTS_TIMEOUT,
         )
@@ -121,10 +157,8 @@ def setVideoOffset(filename, guid, offset):
 
 def deleteVideoOffset(filename, guid):
     try:
-        resp = requests.delete(
+        resp = client().delete(
             MEDIAVIEWER_GUID_OFFSET_URL % {"guid": guid, "filename": filename},
-            auth=(WAITER_USERNAME, WAITER_PASSWORD),
-            verify=VERIFY_REQUESTS,
             timeout=REQUESTS_TIMEOUT,
         )
         resp.raise_for_status()
@@ -133,17 +167,25 @@ def deleteVideoOffset(filename, guid):
         raise
 
 
-def getMediaGenres(guid):
-    genre_url = MEDIAVIEWER_BASE_URL + f"/ajaxgenres/{guid}/"
+def _getNavigationData(url):
+    return navigationCache.get(url, _requestNavigationData)
 
+
+def _requestNavigationData(url):
     try:
-        resp = requests.get(genre_url, timeout=REQUESTS_TIMEOUT)
+        resp = client().get(url, timeout=REQUESTS_TIMEOUT)
         resp.raise_for_status()
     except Exception as e:
         logger().error(e)
         raise
 
-    data = resp.json()
+    return resp.json()
+
+
+@timed("genres")
+def getMediaGenres(guid):
+    genre_url = MEDIAVIEWER_BASE_URL + f"/ajaxgenres/{guid}/"
+    data = _getNavigationData(genre_url)
     tv_genres = [
         (mg[1], MEDIAVIEWER_BASE_URL + f"/tvshows/genre/{mg[0]}/")
         for mg in data["tv_genres"]
@@ -155,16 +197,10 @@ def getMediaGenres(guid):
     return tv_genres, movie_genres
 
 
+@timed("collections")
 def get_collections(guid):
-    genre_url = MEDIAVIEWER_BASE_URL + f"/ajaxcollections/{guid}/"
-    try:
-        resp = requests.get(genre_url, timeout=REQUESTS_TIMEOUT)
-        resp.raise_for_status()
-    except Exception as e:
-        logger().error(e)
-        raise
-
-    data = resp.json()
+    collections_url = MEDIAVIEWER_BASE_URL + f"/ajaxcollections/{guid}/"
+    data = _getNavigationData(collections_url)
     collections = [
         (collection[1], MEDIAVIEWER_BASE_URL + f"/collections/{collection[0]}/")
         for collection in data["collections"]
@@ -1,14 +1,27 @@
 import os
+import json
+import time
+import atexit
+import hashlib
+import mimetypes
 import secure
 import jwt
 import random
 import string
-import re
 
 from collections import namedtuple
 from pathlib import Path
 from functools import wraps
-from flask import Flask, request, send_file, render_template, jsonify, Response
+from flask import (
+    Flask,
+    request,
+    render_template,
+    jsonify,
+    Response,
+    g,
+    before_render_template,
+    template_rendered,
+)
 from werkzeug.middleware.proxy_fix import ProxyFix
 from settings import (
     BASE_PATH,
@@ -17,12 +30,9 @@ from settings import (
     MEDIAVIEWER_GUID_URL,
     MEDIAVIEWER_VIEWED_URL,
     USE_NGINX,
-    WAITER_USERNAME,
-    WAITER_PASSWORD,
     MEDIAVIEWER_SUFFIX,
     WAITER_VIEWED_URL,
     WAITER_OFFSET_URL,
-    VERIFY_REQUESTS,
     MINIMUM_FILE_SIZE,
     EXTERNAL_MEDIAVIEWER_BASE_URL,
     GOOGLE_CAST_APP_ID,
@@ -31,10 +41,27 @@ from settings import (
     JITSI_JWT_APP_ID,
     JITSI_JWT_APP_SECRET,
     JITSI_JWT_SUB,
+    TOKEN_CACHE_TTL,
+    TOKEN_CACHE_NEGATIVE_TTL,
+    TOKEN_CACHE_SIZE,
+    TOKEN_STALE_MAX_AGE,
+    PAGE_LOOKUP_TIMEOUT,
+    WATCH_MEDIA_DIRS,
+    MEDIA_WATCH_POLL_INTERVAL,
+    UPSTREAM_REQUEST_BUDGET,
+    OFFSET_STORE_PATH,
+    OUTBOX_PATH,
+    SERVER_TIMING,
+    SERVER_TIMING_LOG,
+    PAGE_CACHE,
+    PAGE_CACHE_SIZE,
+    PAGE_CACHE_TTL,
+    MEDIAWAITER_PROTOCOL,
+    HOST,
+    PORT,
 )
 from utils import (
     humansize,
-    delayedRetry,
     checkForValidToken,
     buildWaiterPath,
     getVideoOffset,
@@ -43,9 +70,33 @@ from utils import (
     hashed_filename,
     getMediaGenres,
     get_collections,
+    Lookups,
 )
+from cache import TTLCache, MISSING, sharedCache
+from listing import ListingCache, SUBTITLE_SUFFIX, _groupSubtitles
+from watcher import MediaWatcher
+from offsets import OffsetStore
+from outbox import ViewedOutbox
+from ranges import rangeResponse, planResponse, nginxETag
+from mp4 import fastStartLayout
 from log import logger
-import requests
+from metrics import registry, requestLatency, requestCount, fileSends, fileBytesSent
+from timing import (
+    timed,
+    startTimings,
+    endTimings,
+    currentTimings,
+    serverTimingHeader,
+    logTimings,
+)
+from upstream import (
+    client,
+    RetryPolicy,
+    TRANSIENT_STATUS_CODES,
+    isUnavailable,
+    startBudget,
+    endBudget,
+)
 
 rand = random.SystemRandom()
 
@@ -55,11 +106,266 @@ ROOM_NAME_LENGTH = 20
 Subtitle = namedtuple("Subtitle", "path,hashed_filename,waiter_path")
 STREAMABLE_FILE_TYPES = (".mp4",)
 
+tokenCache = TTLCache(
+    maxsize=TOKEN_CACHE_SIZE,
+    ttl=TOKEN_CACHE_TTL,
+    name="token",
+    shared=sharedCache("token", ttl=TOKEN_CACHE_TTL),
+)
+# Last known good tokens, only used when MediaViewer cannot be reached
+staleTokenCache = TTLCache(
+    maxsize=TOKEN_CACHE_SIZE,
+    ttl=TOKEN_STALE_MAX_AGE,
+    name="token-stale",
+    shared=sharedCache("token-stale", ttl=TOKEN_STALE_MAX_AGE),
+)
+offsetStore = OffsetStore(
+    OFFSET_STORE_PATH,
+    reader=getVideoOffset,
+    writer=setVideoOffset,
+    deleter=deleteVideoOffset,
+)
+atexit.register(offsetStore.stop)
+mediaWatcher = MediaWatcher(
+    [Path(BASE_PATH) / media_dir for media_dir in MEDIA_DIRS] or [Path(BASE_PATH)],
+    poll_interval=MEDIA_WATCH_POLL_INTERVAL,
+    enabled=WATCH_MEDIA_DIRS,
+)
+listingCache = ListingCache(watcher=mediaWatcher)
+# Rendered pages keyed by their ETag, see pageETag
+pageCache = TTLCache(maxsize=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL, name="page")
+mediaWatcher.subscribe(listingCache.invalidate, poll=listingCache.revalidate)
+
 app = Flask(__name__, static_url_path="/static", static_folder="/var/static")
 
 
 secure_headers = secure.Secure()
 
+# Endpoints whose pages only depend on the inputs hashed by pageETag
+CACHED_PAGES = ("get_dirPath", "get_file", "autoplay", "video")
+
+
+def _pageVersion():
+    """Digest of the templates and settings every page is rendered with"""
+    digest = hashlib.sha256()
+    for template in sorted(Path(app.root_path, app.template_folder).glob("*.html")):
+        digest.update(template.name.encode("utf-8"))
+        digest.update(template.read_bytes())
+    digest.update(
+        repr(
+            (
+                EXTERNAL_MEDIAVIEWER_BASE_URL,
+                MEDIAWAITER_PROTOCOL,
+                HOST,
+                PORT,
+                GOOGLE_CAST_APP_ID,
+                WAITER_VIEWED_URL,
+                WAITER_OFFSET_URL,
+                bool(JITSI_JWT_APP_ID and JITSI_JWT_APP_SECRET and JITSI_JWT_SUB),
+            )
+        ).encode("utf-8")
+    )
+    return digest.hexdigest()
+
+
+PAGE_VERSION = _pageVersion()
+
+
+@app.before_request
+def start_media_watcher():
+    mediaWatcher.ensureStarted()
+
+
+@app.before_request
+def start_write_behind():
+    # Rows left behind by an earlier worker are sent without waiting for
+    # this one to take a new write
+    offsetStore.ensureStarted()
+    viewedOutbox.ensureStarted()
+
+
+@app.before_request
+def start_request_timer():
+    registry.ensureStarted()
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def start_upstream_budget():
+    g.upstream_budget = startBudget(UPSTREAM_REQUEST_BUDGET)
+
+
+@app.teardown_request
+def end_upstream_budget(exc):
+    budget = g.pop("upstream_budget", None)
+    if budget is not None:
+        endBudget(budget)
+
+
+def routeName(rule):
+    """Group a URL rule under its first path segment, e.g. "dir" or "file" """
+    if rule is None:
+        return "unmatched"
+    return rule.rule[len(APP_NAME) :].strip("/").split("/")[0] or "index"
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    route = routeName(request.url_rule)
+    if started is not None:
+        requestLatency.observe(time.perf_counter() - started, route=route)
+    requestCount.inc(route=route, status=response.status_code)
+    return response
+
+
+@app.before_request
+def start_server_timing():
+    if SERVER_TIMING or SERVER_TIMING_LOG:
+        g.timings, g.timings_token = startTimings()
+
+
+@app.after_request
+def add_server_timing(response):
+    timings = g.get("timings")
+    if timings is None:
+        return response
+
+    durations = timings.durations()
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = serverTimingHeader(durations)
+    if SERVER_TIMING_LOG:
+        logTimings(
+            durations,
+            method=request.method,
+            path=request.path,
+            route=routeName(request.url_rule),
+            status=response.status_code,
+        )
+    return response
+
+
+@app.teardown_request
+def end_server_timing(exc):
+    token = g.pop("timings_token", None)
+    if token is not None:
+        endTimings(token)
+
+
+@before_render_template.connect_via(app)
+def start_render_span(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def end_render_span(sender, template, context, **extra):
+    started = g.pop("render_started", None)
+    timings = currentTimings()
+    if started is not None and timings is not None:
+        timings.record("render", time.perf_counter() - started)
+
+
+class PageInputs:
+    """The token, listing and navigation lookups a page for guid is rendered
+    from. pageETag keeps them on g so the view renders from exactly what was
+    hashed, and neither looks anything up twice."""
+
+    def __init__(self, guid):
+        self.guid = guid
+        self.lookups = _startNavigationLookups(guid)
+        self.token = _requestToken(guid)
+        self._listing = None
+
+    def listing(self):
+        """The result of _getListing for the token"""
+        if self._listing is None:
+            self._listing = _getListing(self.token)
+        return self._listing
+
+
+def _pageInputs(guid):
+    inputs = g.get("page_inputs")
+    if inputs is None or inputs.guid != guid:
+        inputs = PageInputs(guid)
+    return inputs
+
+
+def pageETag(endpoint, view_args):
+    """Return the ETag of the page endpoint renders for view_args, or None
+    when the page is not cached.
+
+    The tag is a digest of everything the page is rendered from: the token,
+    the version of the directory listing, the navigation data, the templates
+    and the settings. Equal tags mean byte-identical pages, in any worker.
+    Everything it reads comes from the token, listing and navigation caches,
+    so an unchanged page costs a few lookups and a hash instead of a render.
+    """
+    page = PageInputs(view_args["guid"])
+    g.page_inputs = page
+    token = page.token
+    if not token or not token.get("isvalid"):
+        return None
+
+    listing, _ = page.listing()
+    inputs = [
+        PAGE_VERSION,
+        endpoint,
+        view_args,
+        # Views fill in the donation fields of the cached token
+        _extract_donation_info(dict(token)),
+        listing.version,
+        page.lookups.result("genres"),
+        page.lookups.result("collections"),
+    ]
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:32]
+
+
+@app.before_request
+def serve_cached_page():
+    if (
+        not PAGE_CACHE
+        or request.method not in ("GET", "HEAD")
+        or request.endpoint not in CACHED_PAGES
+    ):
+        return None
+
+    try:
+        etag = pageETag(request.endpoint, request.view_args)
+    except Exception as e:
+        # Leave it to the view to report
+        logger().debug("Not caching %s: %s", request.path, e)
+        return None
+    if etag is None:
+        return None
+
+    g.page_etag = etag
+    if request.if_none_match.contains(etag):
+        return Response(status=304)
+    body = pageCache.get(etag)
+    if body is not MISSING:
+        return Response(body, mimetype="text/html")
+    return None
+
+
+@app.after_request
+def store_rendered_page(response):
+    etag = g.pop("page_etag", None)
+    if etag is None:
+        return response
+
+    if response.status_code == 200 and response.mimetype == "text/html":
+        if pageCache.get(etag) is MISSING:
+            pageCache.set(etag, response.get_data())
+    elif response.status_code != 304:
+        return response
+
+    response.set_etag(etag)
+    # Pages change with the viewer's progress, so always revalidate
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
 
 @app.after_request
 def set_secure_headers(response):
@@ -81,7 +387,7 @@ def _extract_donation_info(token):
 def logErrorsAndContinue(func):
     @wraps(func)
     def func_wrapper(*args, **kwargs):
-        logger().debug(f"Attempting {func.__name__}")
+        logger().debug("Attempting %s", func.__name__)
         token = None
         try:
             res = func(*args, **kwargs)
@@ -90,7 +396,7 @@ def logErrorsAndContinue(func):
             logger().error(e, exc_info=True)
             errorText = "An error has occurred"
             try:
-                token = getTokenByGUID(kwargs.get("guid"))
+                token = _requestToken(kwargs.get("guid"))
             except Exception as e:
                 logger().error(e)
 
@@ -111,19 +417,83 @@ def logErrorsAndContinue(func):
     return func_wrapper
 
 
+def _startNavigationLookups(guid):
+    """Begin fetching the navigation bar data for guid in the background"""
+    lookups = Lookups(PAGE_LOOKUP_TIMEOUT)
+    lookups.submit("genres", getMediaGenres, guid)
+    lookups.submit("collections", get_collections, guid)
+    return lookups
+
+
 def isAlfredEncoding(filename):
     return MEDIAVIEWER_SUFFIX.lower() in filename.lower()
 
 
-@delayedRetry(attempts=5, interval=1)
+@timed("token")
 def getTokenByGUID(guid):
+    token = tokenCache.get(guid)
+    if token is not MISSING:
+        return token
+
     try:
-        resp = requests.get(
+        token = _requestTokenByGUID(guid)
+    except Exception as e:
+        if not isUnavailable(e):
+            raise
+        token = staleTokenCache.get(guid)
+        if token is MISSING:
+            raise
+        logger().warning(
+            "MediaViewer unavailable, using last good token GUID: %s", guid
+        )
+        return token
+
+    if token and token.get("isvalid"):
+        tokenCache.set(guid, token)
+        staleTokenCache.set(guid, token)
+    else:
+        tokenCache.set(guid, token, ttl=TOKEN_CACHE_NEGATIVE_TTL)
+        staleTokenCache.invalidate(guid)
+    return token
+
+
+def _requestToken(guid):
+    """getTokenByGUID for the current request. A failed fetch is kept on g
+    and raised again rather than retried, so a request that fails its ETag
+    check, view and error page still asks MediaViewer only once."""
+    failed = g.setdefault("failed_tokens", {})
+    if guid in failed:
+        raise failed[guid]
+
+    try:
+        return getTokenByGUID(guid)
+    except Exception as e:
+        failed[guid] = e
+        raise
+
+
+def invalidateToken(guid):
+    tokenCache.invalidate(guid)
+
+
+def _tokenShowsProgress(guid, hashedFilename):
+    """Whether the cached token lists progress for hashedFilename, which is
+    stale once its offset is deleted"""
+    token = tokenCache.get(guid)
+    if token is MISSING or not token:
+        return False
+    return hashedFilename in (token.get("videoprogresses") or ())
+
+
+@RetryPolicy()
+def _requestTokenByGUID(guid):
+    try:
+        resp = client().get(
             MEDIAVIEWER_GUID_URL % {"guid": guid},
-            auth=(WAITER_USERNAME, WAITER_PASSWORD),
-            verify=VERIFY_REQUESTS,
             timeout=REQUESTS_TIMEOUT,
         )
+        if resp.status_code in TRANSIENT_STATUS_CODES:
+            resp.raise_for_status()
         data = resp.json()
         return data
     except Exception as e:
@@ -135,7 +505,8 @@ def getTokenByGUID(guid):
 @logErrorsAndContinue
 def get_dirPath(guid):
     """Display a page that lists all media files in a given directory"""
-    token = getTokenByGUID(guid)
+    inputs = _pageInputs(guid)
+    token = inputs.token
     errorStr = checkForValidToken(token, guid)
     if errorStr:
         return render_template(
@@ -146,17 +517,18 @@ def get_dirPath(guid):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
+    lookups = inputs.lookups
     files = []
     if token["ismovie"]:
-        files.extend(buildEntries(token))
+        files.extend(buildEntries(token, inputs.listing()))
     else:
         raise ValueError(
             f"Only movies are allowed to display contents of directories. GUID = {guid}"
         )
     files.sort(key=lambda x: x["filename"])
 
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    tv_genres, movie_genres = lookups.result("genres")
+    collections = lookups.result("collections")
     token = _extract_donation_info(token)
     return render_template(
         "display.html",
@@ -186,26 +558,59 @@ def get_dirPath(guid):
     )
 
 
-def buildEntries(token):
+def _isCandidateFile(filename):
+    return Path(filename).suffix.lower() in STREAMABLE_FILE_TYPES and isAlfredEncoding(
+        filename
+    )
+
+
+def _getListing(token):
+    """Return the cached listing for token and, for TV, the episode filename"""
     if token["ismovie"]:
-        fullMoviePath = Path(token["path"])
+        return listingCache.get(Path(token["path"]), _isCandidateFile), None
 
-        for root, subFolders, filenames in os.walk(fullMoviePath):
-            for filename in filenames:
-                filesDict = _buildFileDictHelper(Path(root), filename, token)
-                if filesDict:
-                    yield filesDict
-    else:
-        fullMoviePath = (
-            Path(BASE_PATH).joinpath(*Path(token["path"]).parts[-2:])
-            / token["filename"]
-        )
-        yield _buildFileDictHelper(fullMoviePath.parent, fullMoviePath.parts[-1], token)
+    fullPath = (
+        Path(BASE_PATH).joinpath(*Path(token["path"]).parts[-2:]) / token["filename"]
+    )
+    listing = listingCache.get(fullPath.parent, _isCandidateFile, recursive=False)
+    return listing, fullPath.name
 
 
-def _buildFileDictHelper(root, filename, token):
+@timed("entries")
+def buildEntries(token, listing=None):
+    """Yield the file entries of token. listing is the result of _getListing
+    if the caller already has it."""
+    listing, episode = listing or _getListing(token)
+    if token["ismovie"]:
+        for mediaFile in listing.files:
+            filesDict = _buildFileDictHelper(
+                mediaFile.root,
+                mediaFile.filename,
+                token,
+                size=mediaFile.size,
+                subtitles=mediaFile.subtitles,
+            )
+            if filesDict:
+                yield filesDict
+    else:
+        for mediaFile in listing.files:
+            if mediaFile.filename == episode:
+                yield _buildFileDictHelper(
+                    mediaFile.root,
+                    mediaFile.filename,
+                    token,
+                    size=mediaFile.size,
+                    subtitles=mediaFile.subtitles,
+                )
+                break
+        else:
+            yield _buildFileDictHelper(listing.path, episode, token)
+
+
+def _buildFileDictHelper(root, filename, token, size=None, subtitles=None):
     path = Path(root) / filename
-    size = os.path.getsize(path)
+    if size is None:
+        size = os.path.getsize(path)
     ext = path.suffix.lower()
 
     # Files smaller than 10MB probably aren't video files
@@ -223,18 +628,23 @@ def _buildFileDictHelper(root, filename, token):
         "stream", token["guid"], hashedWaiterPath, includeLastSlash=True
     )
 
+    if subtitles is None:
+        # Match subtitles the same way directory listings do
+        subtitles = _groupSubtitles(
+            sorted(path.parent.glob("*" + SUBTITLE_SUFFIX))
+        ).get(path.stem, ())
+
     subtitle_files = []
-    for subtitle_file in path.parent.glob("*.vtt"):
-        if str(Path(filename).stem) in str(subtitle_file):
-            hashedSubtitleFile = hashed_filename(
-                str(Path(token["filename"]) / subtitle_file.name)
-            )
-            subtitle = Subtitle(
-                path=subtitle_file,
-                hashed_filename=hashedSubtitleFile,
-                waiter_path=buildWaiterPath("file", token["guid"], hashedSubtitleFile),
-            )
-            subtitle_files.append(subtitle)
+    for subtitle_file in subtitles:
+        hashedSubtitleFile = hashed_filename(
+            str(Path(token["filename"]) / subtitle_file.name)
+        )
+        subtitle = Subtitle(
+            path=subtitle_file,
+            hashed_filename=hashedSubtitleFile,
+            waiter_path=buildWaiterPath("file", token["guid"], hashedSubtitleFile),
+        )
+        subtitle_files.append(subtitle)
 
     fileDict = {
         "path": buildWaiterPath(
@@ -256,26 +666,35 @@ def _buildFileDictHelper(root, filename, token):
     return fileDict
 
 
-def _getFileEntryFromHash(token, hashPath):
-    entries = buildEntries(token)
-    for entry in entries:
-        if entry["hashedWaiterPath"] == hashPath:
-            return entry
+@timed("entry")
+def _getFileEntryFromHash(token, hashPath, listing=None):
+    listing, episode = listing or _getListing(token)
+    match = listing.hashIndex(token["filename"]).get(hashPath)
+    if match is not None:
+        mediaFile, subtitle = match
+        # A TV token only grants access to its own episode
+        if episode is None or mediaFile.filename == episode:
+            entry = _buildFileDictHelper(
+                mediaFile.root,
+                mediaFile.filename,
+                token,
+                size=mediaFile.size,
+                subtitles=mediaFile.subtitles,
+            )
+            if entry and subtitle is None:
+                return entry
+            elif entry:
+                size = Path(subtitle).stat().st_size
+                return {"unhashedPath": subtitle, "rawSize": size}
 
-        for subtitle in entry["subtitleFiles"]:
-            if subtitle.hashed_filename == hashPath:
-                unhashed_path = Path(subtitle.path)
-                size = unhashed_path.stat().st_size
-                return {"unhashedPath": subtitle.path, "rawSize": size}
-    else:
-        raise Exception("Unable to find matching path")
+    raise Exception("Unable to find matching path")
 
 
 @app.route(APP_NAME + "/file/<guid>/<path:hashPath>")
 @logErrorsAndContinue
 def send_file_for_download(guid, hashPath):
     """Send the file specified at dirPath"""
-    token = getTokenByGUID(guid)
+    token = _requestToken(guid)
 
     errorStr = checkForValidToken(token, guid)
     if errorStr:
@@ -289,14 +708,16 @@ def send_file_for_download(guid, hashPath):
 
     entry = _getFileEntryFromHash(token, hashPath)
     fullPath = entry["unhashedPath"]
-    return send_file_partial(fullPath, fullPath.name, entry["rawSize"])
+    return send_file_partial(fullPath, fullPath.name)
 
 
 @app.route(APP_NAME + "/file/<guid>/")
 @logErrorsAndContinue
 def get_file(guid):
     """Display a page that lists a single file"""
-    token = getTokenByGUID(guid)
+    inputs = _pageInputs(guid)
+    lookups = inputs.lookups
+    token = inputs.token
 
     errorStr = checkForValidToken(token, guid)
     if errorStr or token["ismovie"]:
@@ -308,9 +729,9 @@ def get_file(guid):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
-    files = list(buildEntries(token))
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    files = list(buildEntries(token, inputs.listing()))
+    tv_genres, movie_genres = lookups.result("genres")
+    collections = lookups.result("collections")
     token = _extract_donation_info(token)
     return render_template(
         "display.html",
@@ -352,7 +773,9 @@ def get_file(guid):
 @logErrorsAndContinue
 def autoplay(guid):
     """Autoplay a single file"""
-    token = getTokenByGUID(guid)
+    inputs = _pageInputs(guid)
+    lookups = inputs.lookups
+    token = inputs.token
 
     errorStr = checkForValidToken(token, guid)
     if errorStr or token["ismovie"]:
@@ -364,10 +787,10 @@ def autoplay(guid):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
-    files = list(buildEntries(token))
+    files = list(buildEntries(token, inputs.listing()))
     file_entry = files[0]
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    tv_genres, movie_genres = lookups.result("genres")
+    collections = lookups.result("collections")
     token = _extract_donation_info(token)
 
     watch_party_url = get_watch_party_url(
@@ -472,85 +895,111 @@ def get_status():
         for dir in MEDIA_DIRS:
             media_path = base_path / dir
             if media_path.exists():
-                logger().debug(f"{media_path} directory is good")
+                logger().debug("%s directory is good", media_path)
             else:
-                logger().debug(f"{media_path} directory failed")
+                logger().debug("%s directory failed", media_path)
                 linked = False
 
-        logger().debug(f"Result is {linked}")
+        logger().debug("Result is %s", linked)
 
         res["status"] = linked
     except Exception as e:
         logger().error(e, exc_info=True)
         res["status"] = False
 
-    logger().debug(f"status: {res['status']}")
+    logger().debug("status: %s", res["status"])
     return res, 200 if res["status"] else 500
 
 
+@app.route(APP_NAME + "/status/upstream/", methods=["GET"])
+@app.route(APP_NAME + "/status/upstream", methods=["GET"])
+def get_upstream_status():
+    return {
+        "client": client().stats(),
+        "offsets": offsetStore.stats(),
+        "outbox": viewedOutbox.stats(),
+    }, 200
+
+
+@app.route(APP_NAME + "/metrics", methods=["GET"])
+def get_metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.after_request
 def after_request(response):
     response.headers.add("Accept-Ranges", "bytes")
     return response
 
 
-def xsendfile(path, filename, size):
+def xsendfile(path, filename):
     path = str(path)
 
-    logger().debug(f"path: {path}")
-    logger().debug(f"filename: {filename}")
+    logger().debug("path: %s", path)
+    logger().debug("filename: %s", filename)
     redirected_path = f"/download/{path.split('/', 3)[-1]}"
-    logger().debug(f"redirected_path is {redirected_path}")
-    # resp = send_file(path, conditional=True)
-
-    range_header = request.headers.get("Range", "0-")
-
-    # Look up for ranges
-    m = re.search(r"(\d+)-(\d*)", range_header)
-    g = m.groups()
-    byte1, byte2 = 0, None
-    if g[0]:
-        byte1 = int(g[0])
-    if g[1]:
-        byte2 = int(g[1])
-    else:
-        byte2 = size - 1
-
-    if size < byte2:
-        byte2 = size - 1
-
-    length = byte2 - byte1 + 1
-
-    resp = Response(None, 206)
-    resp.headers.add(
-        "Content-Range",
-        "bytes {0}-{1}/{2}".format(byte1, byte1 + length - 1, size),
+    logger().debug("redirected_path is %s", redirected_path)
+
+    mimetype = mimetypes.guess_type(path)[0] or "video/mp4"
+    # nginx drops the ETag and Last-Modified of the response on the internal
+    # redirect and sends its own for the file. Use the same validators, so
+    # the tags clients get from nginx match the ones checked here and by
+    # nginx's own If-Range handling, without any nginx configuration.
+    stat = os.stat(path)
+    plan = planResponse(
+        stat,
+        request.headers,
+        method=request.method,
+        mimetype=mimetype,
+        etag=nginxETag(stat),
     )
-
-    resp.headers["Content-Length"] = str(length)
-    resp.headers["Content-Type"] = "video/mp4"
+    if plan.status in (304, 416):
+        # Answered without handing the request to nginx
+        return Response(None, plan.status, headers=plan.headers)
+
+    # nginx works out the status, Content-Range and multipart/byteranges body
+    # of the redirected file itself from the request's Range and If-Range
+    # headers, so only the validators and the file's type are passed on.
+    resp = Response(None, 200, mimetype=mimetype)
+    resp.headers["ETag"] = plan.headers["ETag"]
+    resp.headers["Last-Modified"] = plan.headers["Last-Modified"]
     resp.headers["X-Accel-Redirect"] = redirected_path
     resp.headers["X-Accel-Buffering"] = "no"
 
-    logger().debug(f"X-Accel-Redirect: {resp.headers['X-Accel-Redirect']}")
-    logger().debug(f"X-Accel-Buffering: {resp.headers['X-Accel-Buffering']}")
+    logger().debug("X-Accel-Redirect: %s", resp.headers["X-Accel-Redirect"])
+    logger().debug("X-Accel-Buffering: %s", resp.headers["X-Accel-Buffering"])
     return resp
 
 
-def send_file_partial(path, filename, size):
+def send_file_partial(path, filename):
     if USE_NGINX:
-        logger().debug(f"Using NGINX to send {filename}")
-        return xsendfile(path, filename, size)
-    else:
-        logger().debug(f"Using Flask to send {filename}")
-        return send_file(path, conditional=True)
+        logger().debug("Using NGINX to send %s", filename)
+        response = xsendfile(path, filename)
+        fileSends.inc(mode="nginx", status=response.status_code)
+        return response
+
+    logger().debug("Using Flask to send %s", filename)
+    response = rangeResponse(
+        path,
+        request.environ,
+        layout=fastStartLayout(path),
+        onClose=_countBytesSent,
+    )
+    fileSends.inc(mode="wsgi", status=response.status_code)
+    return response
+
+
+def _countBytesSent(sent):
+    fileBytesSent.inc(sent, mode="wsgi")
 
 
 @app.route(APP_NAME + "/stream/<guid>/<path:hashPath>")
 @logErrorsAndContinue
 def video(guid, hashPath):
     """Display streaming page"""
-    token = getTokenByGUID(guid)
+    inputs = _pageInputs(guid)
+    lookups = inputs.lookups
+    token = inputs.token
 
     errorStr = checkForValidToken(token, guid)
     if errorStr:
@@ -562,10 +1011,10 @@ def video(guid, hashPath):
             theme=token.get("theme", DEFAULT_THEME),
         )
 
-    file_entry = _getFileEntryFromHash(token, hashPath)
-    files = list(buildEntries(token))
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    file_entry = _getFileEntryFromHash(token, hashPath, inputs.listing())
+    files = list(buildEntries(token, inputs.listing()))
+    tv_genres, movie_genres = lookups.result("genres")
+    collections = lookups.result("collections")
 
     token = _extract_donation_info(token)
 
@@ -626,7 +1075,8 @@ def get_jitsi_room_name():
 @app.route(APP_NAME + "/watch-party/<guid>/<path:hashPath>")
 @logErrorsAndContinue
 def watch_party(guid, hashPath):
-    token = getTokenByGUID(guid)
+    lookups = _startNavigationLookups(guid)
+    token = _requestToken(guid)
 
     errorStr = checkForValidToken(token, guid)
     if errorStr:
@@ -640,8 +1090,8 @@ def watch_party(guid, hashPath):
 
     file_entry = _getFileEntryFromHash(token, hashPath)
     files = list(buildEntries(token))
-    tv_genres, movie_genres = getMediaGenres(guid)
-    collections = get_collections(guid)
+    tv_genres, movie_genres = lookups.result("genres")
+    collections = lookups.result("collections")
 
     token = _extract_donation_info(token)
 
@@ -710,19 +1160,15 @@ def watch_party(guid, hashPath):
     )
 
 
-@app.route(APP_NAME + "/viewed/<guid>", methods=["POST"])
-@app.route(APP_NAME + "/viewed/<guid>/", methods=["POST"])
-def ajaxviewed(guid):
+def sendViewed(guid):
     values = {
         "viewed": True,
         "guid": guid,
     }
     try:
-        req = requests.post(
+        req = client().post(
             MEDIAVIEWER_VIEWED_URL,
             data=values,
-            auth=(WAITER_USERNAME, WAITER_PASSWORD),
-            verify=VERIFY_REQUESTS,
             timeout=REQUESTS_TIMEOUT,
         )
 
@@ -731,6 +1177,18 @@ def ajaxviewed(guid):
         logger().error(e)
         raise
 
+    invalidateToken(guid)
+
+
+viewedOutbox = ViewedOutbox(OUTBOX_PATH, sender=sendViewed)
+atexit.register(viewedOutbox.stop)
+
+
+@app.route(APP_NAME + "/viewed/<guid>", methods=["POST"])
+@app.route(APP_NAME + "/viewed/<guid>/", methods=["POST"])
+def ajaxviewed(guid):
+    if not viewedOutbox.add(guid):
+        sendViewed(guid)
     return jsonify({"msg": "Viewed set successfully"})
 
 
@@ -740,17 +1198,23 @@ def ajaxviewed(guid):
 )
 def videoOffset(guid, hashedFilename):
     if request.method == "GET":
-        print("GET-ing video offset")
-        data = getVideoOffset(hashedFilename, guid)
+        logger().debug("GET-ing video offset for %s %s", guid, hashedFilename)
+        data = offsetStore.read(guid, hashedFilename)
         return jsonify(data)
     elif request.method == "POST":
-        print("POST-ing video offset:")
-        print(f"offset: {request.form['offset']}")
-        setVideoOffset(hashedFilename, guid, request.form["offset"])
+        logger().debug(
+            "POST-ing video offset for %s %s: %s",
+            guid,
+            hashedFilename,
+            request.form["offset"],
+        )
+        offsetStore.write(guid, hashedFilename, request.form["offset"])
         return jsonify({"msg": "success"})
     elif request.method == "DELETE":
-        print("DELETE-ing video offset:")
-        deleteVideoOffset(hashedFilename, guid)
+        logger().debug("DELETE-ing video offset for %s %s", guid, hashedFilename)
+        offsetStore.delete(guid, hashedFilename)
+        if _tokenShowsProgress(guid, hashedFilename):
+            invalidateToken(guid)
         return jsonify({"msg": "deleted"})
     else:
         raise Exception("Method not supported")
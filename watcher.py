@@ -0,0 +1,296 @@
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+
+from pathlib import Path
+from log import logger
+from background import BackgroundLoop
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyUnavailable(Exception):
+    pass
+
+
+def parseEvents(data):
+    """Yield (wd, mask, cookie, name) for each inotify_event in data"""
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = data[offset : offset + length].rstrip(b"\0")
+        offset += length
+        yield wd, mask, cookie, os.fsdecode(name)
+
+
+class Inotify:
+    """Minimal ctypes binding to the Linux inotify API"""
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise InotifyUnavailable(e)
+
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = init(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise InotifyUnavailable(os.strerror(ctypes.get_errno()))
+
+    def addWatch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+        return wd
+
+    def rmWatch(self, wd):
+        # Fails harmlessly if the watch is already gone
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        return list(parseEvents(data))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MediaWatcher(BackgroundLoop):
+    """Pushes media directory changes into the caches that subscribe to it.
+
+    Uses inotify when available. Otherwise, or when the kernel runs out of
+    watches, it falls back to calling each subscriber's poll function every
+    poll_interval seconds. The watcher runs in a daemon thread per worker
+    process and is started lazily by ensureStarted().
+
+    Every worker watches each media root and all of its subdirectories
+    itself, so a host uses its number of gunicorn workers (8 by default)
+    times the total number of directories under the roots out of the
+    fs.inotify.max_user_watches of the user running waiter. Raise that
+    sysctl to match, or the watcher falls back to polling.
+
+    A root only counts as covered while it is watched. When it is deleted or
+    moved away its listings go back to per-request checks, and it is watched
+    again, every poll_interval seconds, once it reappears.
+    """
+
+    LOOP_NAME = "media-watcher"
+
+    def __init__(self, roots, poll_interval=10, enabled=True):
+        self.roots = [Path(root) for root in roots]
+        self.poll_interval = poll_interval
+        self.enabled = enabled
+
+        self.mode = None
+        self.events = 0
+
+        self._subscribers = []
+        self._initLoop()
+        self._inotify = None
+        self._watches = {}
+        # Replaced rather than changed, covers() reads it from request threads
+        self._watchedRoots = frozenset()
+        self._lastRewatch = 0
+
+    def subscribe(self, invalidate, poll=None):
+        """Register invalidate(path) for pushed changes (path is None for
+        everything) and poll() to revalidate when inotify is unavailable."""
+        self._subscribers.append((invalidate, poll))
+
+    def covers(self, path):
+        if self.mode is None or self._pid != os.getpid():
+            return False
+        roots = self._watchedRoots if self.mode == "inotify" else self.roots
+        path = Path(path)
+        return any(path == root or root in path.parents for root in roots)
+
+    def _loopEnabled(self):
+        return self.enabled
+
+    def _loopInterval(self):
+        return self.poll_interval
+
+    def _loopStart(self):
+        self._watches = {}
+        self._watchedRoots = frozenset()
+
+        try:
+            self._inotify = Inotify()
+            for root in self.roots:
+                self._watchTree(root)
+            self.mode = "inotify"
+            return self._runInotify
+        except (InotifyUnavailable, OSError) as e:
+            logger().warning("inotify unavailable, polling media dirs: %s", e)
+            self._closeInotify()
+            self.mode = "poll"
+            return self._runLoop
+
+    def _loopFinish(self):
+        self._closeInotify()
+        self.mode = None
+
+    def _closeInotify(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _watchTree(self, root):
+        for directory, subFolders, filenames in os.walk(root):
+            try:
+                wd = self._inotify.addWatch(directory)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # Out of watches; a partial view would silently go stale
+                    raise
+                # The directory went away while we were walking it
+                continue
+            self._watches[wd] = Path(directory)
+            if Path(directory) in self.roots:
+                self._watchedRoots = self._watchedRoots | {Path(directory)}
+
+    def _unwatch(self, wd):
+        directory = self._watches.pop(wd, None)
+        if directory in self._watchedRoots:
+            self._watchedRoots = self._watchedRoots - {directory}
+
+    def _rewatchRoots(self):
+        """Watch roots that have reappeared since their watch went away"""
+        now = time.monotonic()
+        if now - self._lastRewatch < self.poll_interval:
+            return
+        self._lastRewatch = now
+
+        for root in self.roots:
+            if root in self._watchedRoots or not root.is_dir():
+                continue
+            self._watchTree(root)
+            if root in self._watchedRoots:
+                self._notify(root)
+
+    def _notify(self, path):
+        for invalidate, poll in self._subscribers:
+            try:
+                invalidate(path)
+            except Exception as e:
+                logger().error(e, exc_info=True)
+
+    def _runInotify(self):
+        while not self._stop.is_set():
+            try:
+                events = self._inotify.read(timeout=min(self.poll_interval, 1))
+            except OSError as e:
+                logger().error(e)
+                self._notify(None)
+                self._switchToPolling()
+                return
+
+            changed = set()
+            for wd, mask, cookie, name in events:
+                self.events += 1
+                if mask & IN_Q_OVERFLOW:
+                    changed.add(None)
+                    continue
+
+                directory = self._watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    self._unwatch(wd)
+                    continue
+
+                changed.add(directory)
+                if mask & IN_MOVE_SELF:
+                    # The watch follows the directory to wherever it went
+                    self._inotify.rmWatch(wd)
+                    self._unwatch(wd)
+                    continue
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._watchTree(directory / name)
+                    except OSError as e:
+                        logger().error(e)
+                        self._notify(None)
+                        self._switchToPolling()
+                        return
+
+            if None in changed:
+                self._notify(None)
+            else:
+                for directory in changed:
+                    self._notify(directory)
+
+            try:
+                self._rewatchRoots()
+            except OSError as e:
+                logger().error(e)
+                self._notify(None)
+                self._switchToPolling()
+                return
+
+    def _switchToPolling(self):
+        logger().warning("inotify failed, polling media dirs")
+        self._closeInotify()
+        self.mode = "poll"
+        self._runLoop()
+
+    def _loopTick(self):
+        for invalidate, poll in self._subscribers:
+            if poll is None:
+                continue
+            try:
+                poll()
+            except Exception as e:
+                logger().error(e, exc_info=True)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "watches": len(self._watches),
+            "watched_roots": len(self._watchedRoots),
+            "events": self.events,
+        }